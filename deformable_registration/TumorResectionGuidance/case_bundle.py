@@ -0,0 +1,435 @@
+from pathlib import Path
+import os
+import re
+import json
+import fnmatch
+import argparse
+import logging
+
+import numpy as np
+
+from data_cache import DEFAULT_CACHE, SIDECAR_PATTERNS, cachedArraySidecar
+from vtk_points_io import mmapVTKPolyDataPointsParser
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_SUFFIXES = (".npz", ".h5", ".hdf5")
+
+# Named artifacts of a case, relative to the case directory. {pre} is the preop id
+# (0022), {intra} the intraop id (1022), as used by pipe.sh and the evaluation script.
+ARTIFACT_ROLES = {
+    "bel": "PreOperative/{pre}_bel.vtk",
+    "mesh": "PreOperative/{pre}_mesh.vtk",
+    "preop_fids": "PreOperative/{pre}_fids.vtk",
+    "preop_fids_mm": "PreOperative/{pre}_fids_mm.vtk",
+    "preop_tgt_mm": "PreOperative/{pre}_tgt_mm.vtk",
+    "boundary_node_ids": "PreOperative/{pre}_GlobalBdryNodeIds.out",
+    "control_points": "PreOperative/{pre}_KControlPoints.out",
+    "intraop_fids": "IntraOperative/{intra}_fids.vtk",
+    "intraop_fids_transformed": "IntraOperative/{intra}_fids_transformed.vtk",
+    "intraop_tgt": "IntraOperative/{intra}_tgt.vtk",
+    "intraop_tgt_transformed": "IntraOperative/{intra}_tgt_transformed.vtk",
+    "sparsedata": "IntraOperative/{intra}_sparsedata.vtk",
+    "sparsedata_transformed": "IntraOperative/{intra}_sparsedata_transformed.vtk",
+    "bel_deformed_initial": "IntraOperative/{pre}_bel_deformed_initial.vtk",
+    "displacement": "IntraOperative/{pre}_displacement.out",
+    "fids_mm_deformed": "IntraOperative/PreOperative/{pre}_fids_mm_Deformed.vtk",
+    "tgt_mm_deformed": "IntraOperative/PreOperative/{pre}_tgt_mm_Deformed.vtk",
+}
+
+# First match wins. Units follow the comments in evalAllTRE3FidsOrScaling.py and pipe.sh.
+_UNIT_RULES = [
+    (re.compile(r"NodeIds\.out$|ControlPoints\.out$"), ""),
+    (re.compile(r"_mm(_Deformed)?(_\d+)?\.vtk$"), "mm"),
+    (re.compile(r"_bel\.vtk$"), "mm"),
+    (re.compile(r"\.(vtk|vtp|out)$"), "m"),
+]
+_UNIT_SCALE = {"m": 1.0, "mm": 1e-3}
+
+
+def guessUnit(name):
+    for pattern, unit in _UNIT_RULES:
+        if pattern.search(name):
+            return unit
+    return ""
+
+
+def caseIdFromName(name):
+    # Pt_0000022 -> 22, same convention as extractInteger in the evaluation script
+    match = re.search(r"(\d+)$", Path(name).stem)
+    return int(match.group(1)) if match else None
+
+
+def convertUnits(points, from_unit, to_unit):
+    if to_unit is None or from_unit == to_unit:
+        return points
+    if from_unit not in _UNIT_SCALE or to_unit not in _UNIT_SCALE:
+        raise ValueError(f"Cannot convert from '{from_unit}' to '{to_unit}'")
+    return points * (_UNIT_SCALE[from_unit] / _UNIT_SCALE[to_unit])
+
+
+def _parseVTKPolyData(raw):
+    import vtk
+    reader = vtk.vtkPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetBinaryInputString(raw, len(raw))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def _parseVTKUnstructuredGrid(raw):
+    import vtk
+    reader = vtk.vtkUnstructuredGridReader()
+    reader.ReadFromInputStringOn()
+    reader.SetBinaryInputString(raw, len(raw))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def _readRaw(file_name):
+    with open(file_name, "rb") as f:
+        return f.read()
+
+
+def _decodeArtifact(file_name):
+    """Return (kind, array) for a case file; array is None when it is stored raw only."""
+    suffix = Path(file_name).suffix.lower()
+    if suffix == ".vtk":
+        try:
+            return "points", mmapVTKPolyDataPointsParser(file_name)
+        except (ValueError, AssertionError):
+            return "raw", None
+    if suffix == ".out":
+        try:
+            table = np.loadtxt(file_name, ndmin=2)
+        except ValueError:
+            return "raw", None
+        if np.all(table == np.round(table)) and "NodeIds" in Path(file_name).name:
+            table = table.astype(np.int64)
+        return "table", table
+    return "raw", None
+
+
+class _CaseArtifacts:
+    """Shared lookups for case directories and bundles."""
+
+    case_id = None
+
+    def keys(self):
+        raise NotImplementedError
+
+    def resolve(self, name):
+        """
+        Map an artifact reference to a key of this case.
+
+        Args:
+            name (str): a role from ARTIFACT_ROLES ("bel", "preop_fids", ...), an exact
+                key ("PreOperative/0022_bel.vtk"), or a unique key suffix ("_bel.vtk")
+
+        Returns:
+            str: the artifact key
+        """
+        keys = self.keys()
+        candidates = [name]
+        if name in ARTIFACT_ROLES and self.case_id is not None:
+            role_key = ARTIFACT_ROLES[name].format(pre=f"{self.case_id:04d}", intra=f"1{self.case_id:03d}")
+            candidates = [role_key, role_key.rsplit("/", 1)[-1]]
+        for candidate in candidates:
+            if candidate in keys:
+                return candidate
+            if "/" in candidate:
+                matches = [key for key in keys if key.endswith("/" + candidate)]
+            else:
+                matches = [key for key in keys if key.rsplit("/", 1)[-1].endswith(candidate)]
+            if len(matches) == 1:
+                return matches[0]
+            if len(matches) > 1:
+                raise KeyError(f"'{name}' is ambiguous in {self}: {matches}")
+        raise KeyError(f"'{name}' not found in {self}")
+
+    def __contains__(self, name):
+        try:
+            self.resolve(name)
+        except KeyError:
+            return False
+        return True
+
+    def unit(self, name):
+        return guessUnit(self.resolve(name))
+
+
+class CaseDirectory(_CaseArtifacts):
+    """
+    Loader API over an unpacked case directory (Pt_XXXX with PreOperative/IntraOperative).
+
+    Has the same interface as CaseBundle so tools can take either. Reads go through the
+    process-wide file cache, so arrays are read-only.
+    """
+
+    def __init__(self, case_dir, case_id=None):
+        self.root = Path(case_dir)
+        self.case_id = case_id if case_id is not None else caseIdFromName(self.root.name)
+        self._keys = None
+
+    def __repr__(self):
+        return f"CaseDirectory('{self.root}')"
+
+    def keys(self):
+        if self._keys is None:
+            keys = []
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith("Results_"))
+                rel = Path(dirpath).relative_to(self.root)
+                keys += [(rel / f).as_posix() for f in sorted(filenames) if not any(fnmatch.fnmatch(f, p) for p in SIDECAR_PATTERNS)]
+            self._keys = keys
+        return self._keys
+
+    def path(self, name):
+        return self.root / self.resolve(name)
+
+    def points(self, name, unit=None):
+        key = self.resolve(name)
+        return convertUnits(DEFAULT_CACHE.get(self.root / key, mmapVTKPolyDataPointsParser), guessUnit(key), unit)
+
+    def table(self, name):
+        # Parsed once, then memory-mapped from its .npy sidecar (e.g. large displacement fields)
+        return cachedArraySidecar([self.path(name)], _decodeTable)
+
+    def raw(self, name):
+        return _readRaw(self.path(name))
+
+    def refresh(self):
+        # Pick up files written after the first lookup (e.g. by MATLAB or pipe.sh)
+        self._keys = None
+
+    def polydata(self, name):
+        return DEFAULT_CACHE.get(self.path(name), _readPolyDataFile)
+
+    def grid(self, name):
+        return DEFAULT_CACHE.get(self.path(name), _readUnstructuredGridFile)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _decodeTable(sources):
+    kind, table = _decodeArtifact(sources[0])
+    if kind != "table":
+        raise KeyError(f"{sources[0]} is not a numeric table")
+    return table
+
+
+def _readPolyDataFile(file_name):
+    return _parseVTKPolyData(_readRaw(file_name))
+
+
+def _readUnstructuredGridFile(file_name):
+    return _parseVTKUnstructuredGrid(_readRaw(file_name))
+
+
+class CaseBundle(_CaseArtifacts):
+    """
+    Single-file, compressed container holding every artifact of one case.
+
+    Datasets are read lazily on first access and kept for the lifetime of the bundle.
+    Each artifact keeps its original bytes (for unpacking and VTK parsing) plus a
+    decoded array: (N, 3) points for .vtk files, a numeric table for .out files.
+    """
+
+    def __init__(self, bundle_path):
+        self.path_on_disk = Path(bundle_path)
+        self._is_h5 = self.path_on_disk.suffix.lower() in (".h5", ".hdf5")
+        if self._is_h5:
+            if h5py is None:
+                raise ImportError(f"h5py is required to read {bundle_path}")
+            self._store = h5py.File(self.path_on_disk, "r")
+            meta = json.loads(self._store.attrs["meta"])
+        else:
+            self._store = np.load(self.path_on_disk, allow_pickle=False)
+            meta = json.loads(self._store["__meta__"].tobytes().decode("utf-8"))
+        if meta["version"] > BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"{bundle_path} was written by a newer bundle format ({meta['version']})")
+        self.case_id = meta["case_id"]
+        self.case_name = meta["case_name"]
+        self.artifacts = meta["artifacts"]  # key -> {"kind", "unit", "size", "mtime"}
+        self._loaded = {}
+
+    def __repr__(self):
+        return f"CaseBundle('{self.path_on_disk}')"
+
+    def keys(self):
+        return list(self.artifacts)
+
+    def _dataset(self, key, field):
+        cache_key = (key, field)
+        if cache_key not in self._loaded:
+            if self._is_h5:
+                value = self._store[f"{key}/{field}"][()]
+            else:
+                value = self._store[f"{key}::{field}"]
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            self._loaded[cache_key] = value
+        return self._loaded[cache_key]
+
+    def unit(self, name):
+        return self.artifacts[self.resolve(name)]["unit"]
+
+    def points(self, name, unit=None):
+        key = self.resolve(name)
+        if self.artifacts[key]["kind"] != "points":
+            raise KeyError(f"{key} has no point data")
+        return convertUnits(self._dataset(key, "points"), self.artifacts[key]["unit"], unit)
+
+    def table(self, name):
+        key = self.resolve(name)
+        if self.artifacts[key]["kind"] != "table":
+            raise KeyError(f"{key} is not a numeric table")
+        return self._dataset(key, "table")
+
+    def raw(self, name):
+        return self._dataset(self.resolve(name), "raw").tobytes()
+
+    def polydata(self, name):
+        return _parseVTKPolyData(self.raw(name))
+
+    def grid(self, name):
+        return _parseVTKUnstructuredGrid(self.raw(name))
+
+    def unpack(self, out_dir, names=None):
+        """Write the original files (all of them, or only `names`) under out_dir; returns out_dir."""
+        out_dir = Path(out_dir)
+        keys = self.keys() if names is None else [self.resolve(n) for n in names]
+        for key in keys:
+            out_path = out_dir / key
+            os.makedirs(out_path.parent, exist_ok=True)
+            with open(out_path, "wb") as f:
+                f.write(self.raw(key))
+            mtime = self.artifacts[key]["mtime"]
+            os.utime(out_path, (mtime, mtime))
+        return out_dir
+
+    def close(self):
+        self._store.close()
+        self._loaded.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def packCase(case_dir, out_path=None, case_id=None, compression_level=4):
+    """
+    Pack every file of a case (except Results_* run outputs) into one compressed file.
+
+    Besides the PreOperative/IntraOperative artifacts this keeps case-level inputs such
+    as tissue.prop, so an unpacked bundle can be fed straight to pipe.sh.
+
+    Args:
+        case_dir (str | Path): the Pt_XXXX directory
+        out_path (str | Path, optional): .npz (default, numpy only) or .h5 (needs h5py);
+            defaults to <case_dir>.npz next to the case directory
+        case_id (int, optional): defaults to the trailing digits of the directory name
+        compression_level (int): gzip level for HDF5 datasets
+
+    Returns:
+        Path: the written bundle
+
+    Raises:
+        FileNotFoundError: case_dir is not a directory, or has no PreOperative or
+            IntraOperative folder
+    """
+    case_dir = Path(case_dir)
+    if not case_dir.is_dir():
+        raise FileNotFoundError(f"{case_dir} is not a case directory")
+    missing = [name for name in ("PreOperative", "IntraOperative") if not (case_dir / name).is_dir()]
+    if missing:
+        raise FileNotFoundError(f"{case_dir} has no {' or '.join(missing)} folder")
+    case = CaseDirectory(case_dir, case_id)
+    out_path = Path(out_path) if out_path is not None else case.root.with_suffix(".npz")
+    is_h5 = out_path.suffix.lower() in (".h5", ".hdf5")
+    if is_h5 and h5py is None:
+        raise ImportError("h5py is required to write HDF5 bundles; use a .npz path instead")
+
+    keys = case.keys()
+    meta = {"version": BUNDLE_FORMAT_VERSION, "case_id": case.case_id, "case_name": case.root.name, "artifacts": {}}
+    datasets = {}
+    for key in keys:
+        file_name = case.root / key
+        raw = _readRaw(file_name)
+        kind, array = _decodeArtifact(file_name)
+        meta["artifacts"][key] = {"kind": kind, "unit": guessUnit(key), "size": len(raw), "mtime": os.stat(file_name).st_mtime}
+        datasets[(key, "raw")] = np.frombuffer(raw, dtype=np.uint8)
+        if array is not None:
+            datasets[(key, kind)] = array
+
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    if is_h5:
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["meta"] = json.dumps(meta)
+            for (key, field), array in datasets.items():
+                f.create_dataset(f"{key}/{field}", data=array, chunks=True if array.size else None,
+                                 compression="gzip" if array.size else None,
+                                 compression_opts=compression_level if array.size else None,
+                                 shuffle=array.dtype != np.uint8 and array.size > 0)
+    else:
+        arrays = {f"{key}::{field}": array for (key, field), array in datasets.items()}
+        arrays["__meta__"] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, out_path)
+    logging.info(f"Packed {len(keys)} files of {case.root.name} into {out_path}")
+    return out_path
+
+
+def openCase(path, case_id=None):
+    """Open a case as a CaseBundle (.npz/.h5 file) or a CaseDirectory (Pt_XXXX directory)."""
+    path = Path(path)
+    if path.is_file() and path.suffix.lower() in BUNDLE_SUFFIXES:
+        return CaseBundle(path)
+    return CaseDirectory(path, case_id)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Pack/unpack per-case artifacts into a single bundle file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack one or more Pt_XXXX case directories")
+    pack_parser.add_argument("caseDirs", type=str, nargs="+")
+    pack_parser.add_argument("--outDir", type=str, default=None, help="Where to write the bundles (default: next to each case)")
+    pack_parser.add_argument("--format", choices=["npz", "h5"], default="npz")
+    unpack_parser = subparsers.add_parser("unpack", help="Restore the original files of a bundle")
+    unpack_parser.add_argument("bundle", type=str)
+    unpack_parser.add_argument("outDir", type=str)
+    list_parser = subparsers.add_parser("ls", help="List the artifacts of a bundle")
+    list_parser.add_argument("bundle", type=str)
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        for case_dir in args.caseDirs:
+            case_dir = Path(case_dir)
+            out_dir = Path(args.outDir) if args.outDir is not None else case_dir.parent
+            os.makedirs(out_dir, exist_ok=True)
+            try:
+                packCase(case_dir, out_dir / f"{case_dir.name}.{args.format}")
+            except FileNotFoundError as e:
+                parser.error(str(e))
+    elif args.command == "unpack":
+        with CaseBundle(args.bundle) as bundle:
+            bundle.unpack(Path(args.outDir) / bundle.case_name)
+    else:
+        with CaseBundle(args.bundle) as bundle:
+            for key, info in bundle.artifacts.items():
+                print(f"{key:60s} {info['kind']:7s} {info['unit'] or '-':3s} {info['size']:>12d} B")
@@ -0,0 +1,293 @@
+from pathlib import Path
+import os
+import re
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import logging
+
+# (kind, pattern) tried in order on every output line; the first match is the line's
+# progress. LIBR, MATLAB and pipe.sh print no common format, so these are generic:
+# percentages, "iteration 12/50"-style counters, bare iteration numbers, and the
+# "Running ...", "Deforming targets:" phase lines echoed by pipe.sh.
+PROGRESS_PATTERNS = (
+    ("percent", re.compile(r"(\d+(?:\.\d+)?)\s*%")),
+    ("fraction", re.compile(r"\b(?:[Ii]ter(?:ation)?|[Ss]tep|[Ee]poch)\s*[:#]?\s*(\d+)\s*(?:/|of)\s*(\d+)")),
+    ("iteration", re.compile(r"\b[Ii]ter(?:ation)?\s*[:#=]?\s*(\d+)")),
+    ("phase", re.compile(r"^\s*([A-Z][^:]*?)\s*(?:\.\.\.|:)\s*$")),
+)
+# Lines kept per stream in the result, for error messages
+TAIL_LINES = 20
+
+
+class CommandError(RuntimeError):
+    """A command exited with a non-zero code; `result` holds its run (see runCommandAsync)."""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class CommandTimeout(CommandError):
+    pass
+
+
+def parseProgress(line, patterns=PROGRESS_PATTERNS):
+    """
+    Progress reported by an output line, or None.
+
+    Returns:
+        dict: "kind" ("percent", "fraction", "iteration" or "phase") and "value", plus
+        "total" for fractions; percentages and fractions also give "fraction" in [0, 1]
+    """
+    for kind, pattern in patterns:
+        match = pattern.search(line)
+        if match is None:
+            continue
+        if kind == "percent":
+            value = float(match.group(1))
+            return {"kind": kind, "value": value, "fraction": min(value / 100, 1.0)}
+        if kind == "fraction":
+            value, total = int(match.group(1)), int(match.group(2))
+            return {"kind": kind, "value": value, "total": total, "fraction": min(value / total, 1.0) if total else None}
+        if kind == "iteration":
+            return {"kind": kind, "value": int(match.group(1))}
+        return {"kind": kind, "value": match.group(1)}
+    return None
+
+
+def jobLogName(name):
+    # File-name friendly job name
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "command"
+
+
+async def _readLines(stream, chunk_size=1 << 16):
+    # Lines split on \n or \r, so that progress bars redrawn with \r are seen as they come
+    pending = b""
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = re.split(rb"\r\n|\r|\n", pending)
+        for line in lines:
+            yield line.decode(errors="replace")
+    if pending:
+        yield pending.decode(errors="replace")
+
+
+def _killProcessGroup(process, sig):
+    # The shell's children (MATLAB, LIBR, tee) share its session, see start_new_session below
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, sig)
+        elif sig == signal.SIGTERM:
+            process.terminate()
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _stopProcess(process, grace):
+    # SIGTERM, then SIGKILL if the command outlives the grace period
+    if process.returncode is not None:
+        return
+    _killProcessGroup(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        _killProcessGroup(process, signal.SIGKILL if os.name == "posix" else signal.SIGTERM)
+        await process.wait()
+
+
+async def runCommandAsync(cmd, name=None, timeout=None, cwd=None, env=None, log_dir=None, tee_path=None,
+                          on_progress=None, check=True, progress_patterns=PROGRESS_PATTERNS, progress_interval=5.0,
+                          kill_grace=5.0):
+    """
+    Run a shell command, streaming its stdout and stderr line by line.
+
+    Every line is logged (debug level, prefixed with the job name) and, with log_dir,
+    appended to <log_dir>/<name>.jsonl as a JSON record with its stream and time since
+    the start, between a "start" and an "end" record. Lines matching progress_patterns
+    (see parseProgress) are also logged at info level, at most every progress_interval
+    seconds except for phase changes, and passed to on_progress(name, progress).
+
+    A command running longer than timeout, or whose task is cancelled, is stopped with
+    its whole process group: SIGTERM, then SIGKILL after kill_grace seconds.
+
+    Args:
+        cmd (str): shell command
+        name (str, optional): job name used in logs, the first word of cmd by default
+        tee_path (str | Path, optional): file that also receives the raw stdout, as `| tee`
+        check (bool): raise CommandError for a non-zero exit code
+
+    Returns:
+        dict: "name", "cmd", "returncode", "status" ("ok", "failed", "timeout" or
+        "cancelled"), "seconds", "progress" (last parsed), "stdout_tail", "stderr_tail"
+        (last lines) and "log_path"
+
+    Raises:
+        CommandTimeout: on timeout (always, whatever check)
+        CommandError: on a non-zero exit code, if check
+    """
+    name = name or cmd.split()[0]
+    log_path = None if log_dir is None else Path(log_dir) / f"{jobLogName(name)}.jsonl"
+    result = {"name": name, "cmd": cmd, "returncode": None, "status": None, "seconds": None, "progress": None,
+              "stdout_tail": [], "stderr_tail": [], "log_path": log_path}
+    if log_path is not None:
+        os.makedirs(log_path.parent, exist_ok=True)
+    log_f = open(log_path, "a") if log_path is not None else None
+    tee_f = open(tee_path, "w") if tee_path is not None else None
+    start = time.perf_counter()
+    last_progress_log = [-float("inf"), None]  # time and phase of the last progress logged at info level
+
+    def record(**fields):
+        if log_f is not None:
+            log_f.write(json.dumps(dict(fields, job=name, time=time.time(), elapsed_s=round(time.perf_counter() - start, 6)), default=str) + "\n")
+            log_f.flush()
+
+    async def pump(stream, stream_name):
+        tail = result[f"{stream_name}_tail"]
+        async for line in _readLines(stream):
+            if tee_f is not None and stream_name == "stdout":
+                tee_f.write(line + "\n")
+                tee_f.flush()
+            tail.append(line)
+            del tail[:-TAIL_LINES]
+            logging.debug(f"[{name}] {line}")
+            progress = parseProgress(line, progress_patterns) if progress_patterns else None
+            record(stream=stream_name, line=line, **({"progress": progress} if progress is not None else {}))
+            if progress is None:
+                continue
+            result["progress"] = progress
+            now = time.perf_counter()
+            new_phase = progress["kind"] == "phase" and progress["value"] != last_progress_log[1]
+            if new_phase or now - last_progress_log[0] >= progress_interval:
+                last_progress_log[:] = [now, progress["value"] if progress["kind"] == "phase" else last_progress_log[1]]
+                logging.info(f"[{name}] {line.strip()} ({now - start:.1f} s)")
+            if on_progress is not None:
+                on_progress(name, progress)
+
+    try:
+        process = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                        cwd=cwd, env=env, start_new_session=(os.name == "posix"))
+        record(event="start", cmd=cmd, pid=process.pid, cwd=cwd)
+        running = asyncio.gather(pump(process.stdout, "stdout"), pump(process.stderr, "stderr"), process.wait())
+        try:
+            await asyncio.wait_for(asyncio.shield(running), timeout)
+            result["status"] = "ok" if process.returncode == 0 else "failed"
+        except asyncio.TimeoutError:
+            result["status"] = "timeout"
+            await _stopProcess(process, kill_grace)
+        except asyncio.CancelledError:
+            result["status"] = "cancelled"
+            await _stopProcess(process, kill_grace)
+            raise
+        finally:
+            if result["status"] in ("timeout", "cancelled"):
+                # The pipes close with the process group; a child that left the group may hold them open
+                try:
+                    await asyncio.wait_for(asyncio.shield(running), 1.0)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    running.cancel()
+                await asyncio.gather(running, return_exceptions=True)
+            result["returncode"] = process.returncode
+            result["seconds"] = time.perf_counter() - start
+            record(event="end", status=result["status"], returncode=process.returncode, seconds=result["seconds"])
+    finally:
+        if log_f is not None:
+            log_f.close()
+        if tee_f is not None:
+            tee_f.close()
+
+    logging.info(f"[{name}] {result['status']} in {result['seconds']:.2f} s (exit code {result['returncode']})")
+    if result["status"] == "timeout":
+        raise CommandTimeout(f"Timed out after {timeout} s: {cmd}", result)
+    if check and result["status"] == "failed":
+        stderr = "\n".join(result["stderr_tail"][-5:])
+        raise CommandError(f"Exit code {result['returncode']}: {cmd}" + (f"\n{stderr}" if stderr else ""), result)
+    return result
+
+
+def runCommand(cmd, **kwargs):
+    """Blocking runCommandAsync (same arguments), e.g. from a solver's worker thread."""
+    return asyncio.run(runCommandAsync(cmd, **kwargs))
+
+
+class CommandRunner:
+    """
+    Runs commands with runCommandAsync, at most max_concurrency at once.
+
+        runner = CommandRunner(max_concurrency=2, log_dir="logs", timeout=3600)
+        results = runner.runAll(["bash pipe.sh ... nonrigidRegisterTumorCavity", ...])
+
+    Keyword arguments given here (timeout, log_dir, ...) are the defaults of every
+    command; a command can be a string or a dict of runCommandAsync arguments with
+    "cmd". durations() lists the run time of every finished command.
+    """
+
+    def __init__(self, max_concurrency=1, **defaults):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.defaults = defaults
+        self.results = []
+
+    async def run(self, cmd, semaphore, **kwargs):
+        async with semaphore:
+            try:
+                result = await runCommandAsync(cmd, **dict(self.defaults, **kwargs))
+            except CommandError as e:
+                result = e.result
+                result["error"] = str(e)
+            self.results.append(result)
+            return result
+
+    async def runAllAsync(self, commands):
+        """
+        Run every command, never raising for failed or timed out ones; cancelling this
+        coroutine stops all running commands.
+
+        Returns:
+            list of dict: runCommandAsync results in the order of commands, with an
+            "error" message for the failed and timed out ones
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        commands = [{"cmd": command} if isinstance(command, str) else dict(command) for command in commands]
+        tasks = [asyncio.ensure_future(self.run(command.pop("cmd"), semaphore, **command)) for command in commands]
+        try:
+            return await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def runAll(self, commands):
+        """Blocking runAllAsync; Ctrl+C stops (and kills) the running commands."""
+        return asyncio.run(self.runAllAsync(commands))
+
+    def durations(self):
+        return [(result["name"], result["status"], result["seconds"]) for result in self.results]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run shell commands (e.g. pipe.sh steps of several cases) with bounded concurrency, timeouts and streamed JSON-lines logs")
+    parser.add_argument("commands", type=str, nargs="+", help="Shell commands, each quoted as one argument")
+    parser.add_argument("--jobs", type=int, default=1, help="Commands run at once")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds allowed per command (default: no limit)")
+    parser.add_argument("--logDir", type=str, default=None, help="Where the <job>.jsonl logs are written")
+    parser.add_argument("--verbose", action="store_true", help="Also echo every output line")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    runner = CommandRunner(args.jobs, timeout=args.timeout, log_dir=args.logDir)
+    commands = [{"cmd": cmd, "name": f"{idx}_{cmd.split()[0]}"} for idx, cmd in enumerate(args.commands)]
+    results = runner.runAll(commands)
+    for name, status, seconds in runner.durations():
+        logging.info(f"{name:40s} {status:10s} {seconds:10.2f} s")
+    sys.exit(0 if all(result["status"] == "ok" for result in results) else 1)
@@ -0,0 +1,216 @@
+from pathlib import Path
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024  # 1 GiB
+# Binary copies of parsed text files, next to them: <file>.cache.npy, with the source
+# stamps it was built from in <file>.cache.json (see cachedArraySidecar)
+SIDECAR_SUFFIX = ".cache.npy"
+SIDECAR_META_SUFFIX = ".cache.json"
+SIDECAR_PATTERNS = (f"*{SIDECAR_SUFFIX}", f"*{SIDECAR_META_SUFFIX}")
+
+
+def _sizeOf(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "GetActualMemorySize"):  # vtkDataObject, reported in KiB
+        return value.GetActualMemorySize() * 1024
+    raise TypeError(f"Cannot cache values of type {type(value).__name__}")
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    return value
+
+
+def _view(value):
+    # Arrays are already read-only; VTK objects get a fresh shallow copy so that
+    # callers can swap points/cells without touching the cached instance.
+    if isinstance(value, np.ndarray):
+        return value
+    copy = value.NewInstance()
+    copy.ShallowCopy(value)
+    return copy
+
+
+class FileCache:
+    """
+    Process-wide LRU cache for parsed mesh and point-set files.
+
+    Entries are keyed by absolute path and loader, and are validated against the
+    file's mtime and size on every lookup, so a rewritten file is re-read. The
+    total size of the cached values is kept under `max_bytes` by evicting the
+    least recently used entries.
+
+    Cached NumPy arrays are returned read-only. VTK objects are returned as shallow
+    copies: their points and cells are shared with the cache, so deep copy them
+    before modifying coordinates in place.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (path, loader) -> (stamp, value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0  # size on disk of the files that had to be parsed
+        self.bytes_saved = 0  # size on disk of the files served from memory
+
+    def get(self, file_name, loader):
+        """
+        Return `loader(file_name)`, parsing the file only if it changed since it was cached.
+
+        Args:
+            file_name (str | Path): file to load
+            loader (callable): parser taking the file name; its qualified name is part
+                of the key so that the entry survives importlib.reload of its module
+
+        Returns:
+            read-only np.ndarray or a shallow copy of the cached VTK object
+        """
+        path = os.path.abspath(file_name)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        key = (path, f"{loader.__module__}.{loader.__qualname__}")
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += st.st_size
+                return _view(entry[1])
+
+        value = _freeze(loader(file_name))
+        nbytes = _sizeOf(value)
+
+        with self._lock:
+            self.misses += 1
+            self.bytes_read += st.st_size
+            self._discard(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (stamp, value, nbytes)
+                self._nbytes += nbytes
+                while self._nbytes > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+                    self.evictions += 1
+        return _view(value)
+
+    def invalidate(self, file_name):
+        """Drop every entry of `file_name`; called by writers after rewriting a file."""
+        path = os.path.abspath(file_name)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "cached_bytes": self._nbytes,
+            "bytes_read": self.bytes_read,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def logStats(self, level=logging.INFO):
+        s = self.stats()
+        logging.log(level, f"File cache: {s['hits']} hits, {s['misses']} misses ({100 * s['hit_rate']:.1f}% hit rate), "
+                           f"{s['evictions']} evictions, {s['bytes_saved'] / 2**20:.1f} MiB of reads avoided, "
+                           f"{s['cached_bytes'] / 2**20:.1f} MiB held in {s['entries']} entries")
+
+
+DEFAULT_CACHE = FileCache(int(os.environ.get("TRG_FILE_CACHE_MB", DEFAULT_CACHE_BYTES // 2**20)) * 2**20)
+
+
+def cachedLoad(file_name, loader):
+    return DEFAULT_CACHE.get(file_name, loader)
+
+
+def sidecarPath(file_name):
+    return Path(str(file_name) + SIDECAR_SUFFIX)
+
+
+def sidecarMetaPath(sidecar_path):
+    # <file>.cache.npy -> <file>.cache.json; any other sidecar name gets the meta suffix appended
+    name = Path(sidecar_path).name
+    if name.endswith(SIDECAR_SUFFIX):
+        name = name[:-len(SIDECAR_SUFFIX)]
+    return Path(sidecar_path).with_name(name + SIDECAR_META_SUFFIX)
+
+
+def _sourceStamps(sources, sidecar_path):
+    stamps = []
+    for source in sources:
+        st = os.stat(source)
+        # By path relative to the sidecar, so that it stays valid when its tree is moved or copied
+        # with its times, while same-named sources of different folders (folds) stay distinct
+        stamps.append([Path(os.path.relpath(source, Path(sidecar_path).parent)).as_posix(), st.st_mtime_ns, st.st_size])
+    return stamps
+
+
+def cachedArraySidecar(sources, build, sidecar_path=None, mmap_mode="r"):
+    """
+    `build(sources)` kept on disk as an .npy sidecar and memory-mapped on later loads.
+
+    The sidecar is valid while every source keeps the mtime and size it had when the
+    sidecar was built (kept next to it, see sidecarMetaPath), so a rewritten source is
+    re-parsed. Several sources (e.g. the displacement fields of all folds) can share
+    one sidecar at sidecar_path. When the sidecar cannot be written (read-only
+    folder), the built array is returned as is.
+
+    Args:
+        sources (list of str | Path): files the array is built from
+        build (callable): parser taking the list of sources, returning an np.ndarray
+        sidecar_path (str | Path, optional): defaults to sidecarPath(sources[0])
+
+    Returns:
+        np.ndarray: read-only memory map of the sidecar (or the built array)
+    """
+    sources = [Path(source) for source in sources]
+    sidecar_path = Path(sidecar_path) if sidecar_path is not None else sidecarPath(sources[0])
+    meta_path = sidecarMetaPath(sidecar_path)
+    stamps = _sourceStamps(sources, sidecar_path)
+    try:
+        if json.loads(meta_path.read_text())["sources"] == stamps:
+            return np.load(sidecar_path, mmap_mode=mmap_mode)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    array = np.ascontiguousarray(build(sources))
+    # The array goes in before the stamps, so a reader never pairs new stamps with an old array
+    tmp_path = sidecar_path.with_name(f".{sidecar_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, sidecar_path)
+        tmp_meta_path = meta_path.with_name(f".{meta_path.name}.{os.getpid()}.tmp")
+        tmp_meta_path.write_text(json.dumps({"sources": stamps, "shape": array.shape, "dtype": array.dtype.str}))
+        os.replace(tmp_meta_path, meta_path)
+    except OSError as e:
+        logging.debug(f"Could not write the sidecar {sidecar_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return _freeze(array)
+    return np.load(sidecar_path, mmap_mode=mmap_mode)
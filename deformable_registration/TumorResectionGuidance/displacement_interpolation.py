@@ -0,0 +1,319 @@
+from pathlib import Path
+import os
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+from scipy.spatial import cKDTree
+
+from case_bundle import convertUnits, guessUnit
+from data_cache import DEFAULT_CACHE, cachedArraySidecar
+from vtk_points_io import cachedVTKPolyDataPointsParser, simpleVTKPolyDataPointsWriter
+
+# Tetrahedra (by nearest centroid) tried per query point, in two passes, before falling back to the cell locator
+N_CANDIDATE_CELLS = (8, 64)
+# A point is inside a tetrahedron if none of its barycentric coordinates is below -BARYCENTRIC_TOLERANCE
+BARYCENTRIC_TOLERANCE = 1e-9
+# Query points handled per vectorized pass, bounds the (chunk, N_CANDIDATE_CELLS, 3, 3) temporaries
+_CHUNK_POINTS = 65536
+
+
+def _readUnstructuredGrid(file_name):
+    reader = vtk.vtkUnstructuredGridReader()
+    reader.SetFileName(str(file_name))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def _tetrahedra(grid):
+    # (M, 4) node ids of the cells of grid, which must all be linear tetrahedra
+    cell_types = vtk_to_numpy(grid.GetDistinctCellTypesArray()).tolist()
+    if cell_types != [vtk.VTK_TETRA]:
+        raise ValueError(f"Expected a mesh of linear tetrahedra, got cell types {cell_types}")
+    return vtk_to_numpy(grid.GetCells().GetConnectivityArray()).reshape(-1, 4).astype(np.int64)
+
+
+def pointsKey(points):
+    # Content hash of a point set, key of the weight cache
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    return hashlib.sha1(points.tobytes()).hexdigest() + str(points.shape)
+
+
+class DisplacementInterpolator:
+    """
+    Interpolates nodal displacement fields of a tetrahedral mesh at arbitrary points,
+    as LIBR_DeformIntraOpTarget does for the fids and target files.
+
+    The containing tetrahedron and barycentric weights of all query points are found
+    in one vectorized pass: the tetrahedra with the nearest centroids (cKDTree) are
+    tested at once with precomputed inverse edge matrices, and a second pass with
+    more candidates takes the few points missed (next to large or sliver cells).
+    Points still not found go to a vtkStaticCellLocator, built on first use; points
+    outside the mesh are extrapolated from the closest cell.
+
+    The weights only depend on the mesh and the points, so with cache_weights they are
+    kept (per point set, by content) and later fields, e.g. one per fold or sweep
+    point, cost one gather and a weighted sum:
+
+        interpolator = meshInterpolator(case_dir / "PreOperative" / "0022_mesh.vtk")
+        deformed_mm = interpolator.deform(margin_mm, displacement, unit="mm")
+    """
+
+    def __init__(self, grid, cache_weights=True, max_cached_weights=16):
+        self.grid = grid
+        self.nodes = vtk_to_numpy(grid.GetPoints().GetData()).astype(np.float64)  # m
+        self.tets = _tetrahedra(grid)
+        v0 = self.nodes[self.tets[:, 0]]
+        edges = np.stack([self.nodes[self.tets[:, i]] - v0 for i in (1, 2, 3)], axis=2)  # (M, 3, 3), edges as columns
+        det = np.linalg.det(edges)
+        flat = np.abs(det) <= 1e-12 * np.abs(edges).max() ** 3
+        edges[flat] = np.eye(3)
+        self.inv_edges = np.linalg.inv(edges)
+        # Degenerate cells get NaN weights, so they never contain a point
+        self.inv_edges[flat] = np.nan
+        self.v0 = v0
+        self.centroid_tree = cKDTree(self.nodes[self.tets].mean(axis=1))
+        self.cache_weights = cache_weights
+        self.max_cached_weights = max_cached_weights
+        self._weights = OrderedDict()  # pointsKey -> (cells, weights, inside)
+        self._locator = None
+        self._lock = threading.Lock()
+        self.stats = {"points": 0, "locator_points": 0, "outside_points": 0, "weight_hits": 0}
+
+    @classmethod
+    def fromFile(cls, mesh_file, **kwargs):
+        return cls(DEFAULT_CACHE.get(mesh_file, _readUnstructuredGrid), **kwargs)
+
+    def locator(self):
+        """vtkStaticCellLocator of the mesh, built on first use."""
+        if self._locator is None:
+            locator = vtk.vtkStaticCellLocator()
+            locator.SetDataSet(self.grid)
+            locator.BuildLocator()
+            self._locator = locator
+        return self._locator
+
+    def barycentric(self, cells, points):
+        """(N, 4) barycentric coordinates of points in their cells (unclamped, so outside points extrapolate)."""
+        b = np.einsum("nij,nj->ni", self.inv_edges[cells], points - self.v0[cells])
+        return np.concatenate([1 - b.sum(axis=1, keepdims=True), b], axis=1)
+
+    def _locate(self, points, n_candidates):
+        # Vectorized candidate test, chunked; -1 where no candidate contains the point
+        cells = np.full(len(points), -1, dtype=np.int64)
+        k = min(n_candidates, len(self.tets))
+        for start in range(0, len(points), _CHUNK_POINTS):
+            chunk = points[start:start + _CHUNK_POINTS]
+            _, candidates = self.centroid_tree.query(chunk, k=k, workers=-1)
+            candidates = candidates.reshape(len(chunk), k)
+            b = np.einsum("nkij,nkj->nki", self.inv_edges[candidates], chunk[:, None, :] - self.v0[candidates])
+            with np.errstate(invalid="ignore"):
+                inside = (b.min(axis=2) >= -BARYCENTRIC_TOLERANCE) & (b.sum(axis=2) <= 1 + BARYCENTRIC_TOLERANCE)
+            found = inside.any(axis=1)
+            cells[start:start + len(chunk)][found] = candidates[found, inside[found].argmax(axis=1)]
+        return cells
+
+    def _locateWithLocator(self, points):
+        # Per-point fallback, with VTK's weights (also defined in sliver cells); the
+        # closest cell, without weights, for points outside the mesh
+        locator = self.locator()
+        cells = np.empty(len(points), dtype=np.int64)
+        weights = np.full((len(points), 4), np.nan)
+        inside = np.ones(len(points), dtype=bool)
+        cell = vtk.vtkGenericCell()
+        pcoords, cell_weights = [0.0] * 3, [0.0] * 4
+        closest, cell_id, sub_id, dist2 = [0.0] * 3, vtk.reference(0), vtk.reference(0), vtk.reference(0.0)
+        for i, point in enumerate(points):
+            cells[i] = locator.FindCell(point, 0.0, cell, pcoords, cell_weights)
+            if cells[i] >= 0:
+                weights[i] = cell_weights
+            else:
+                locator.FindClosestPoint(point, closest, cell, cell_id, sub_id, dist2)
+                cells[i] = int(cell_id)
+                inside[i] = False
+        return cells, weights, inside
+
+    def _barycentricOrNearestNode(self, cells, points):
+        # Degenerate cells have no barycentric coordinates: all the weight goes to their nearest node
+        weights = self.barycentric(cells, points)
+        flat = np.flatnonzero(np.isnan(weights).any(axis=1))
+        if len(flat):
+            distances = np.linalg.norm(self.nodes[self.tets[cells[flat]]] - points[flat, None, :], axis=2)
+            weights[flat] = 0
+            weights[flat, distances.argmin(axis=1)] = 1
+        return weights
+
+    def weights(self, points):
+        """
+        Containing cells and barycentric weights of points (m, the mesh's units).
+
+        Returns:
+            tuple: (N,) cell indices, (N, 4) weights of the cells' nodes and (N,) bool,
+            False for points outside the mesh (weights extrapolated from the closest cell)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        key = pointsKey(points) if self.cache_weights else None
+        if key is not None:
+            with self._lock:
+                entry = self._weights.get(key)
+                if entry is not None:
+                    self._weights.move_to_end(key)
+                    self.stats["weight_hits"] += 1
+                    return entry
+
+        cells = self._locate(points, N_CANDIDATE_CELLS[0])
+        missed = np.flatnonzero(cells < 0)
+        if len(missed):
+            cells[missed] = self._locate(points[missed], N_CANDIDATE_CELLS[1])
+            missed = missed[cells[missed] < 0]
+        inside = np.ones(len(points), dtype=bool)
+        if len(missed):
+            cells[missed], locator_weights, inside[missed] = self._locateWithLocator(points[missed])
+        weights = self._barycentricOrNearestNode(cells, points)
+        if len(missed):
+            weights[missed[inside[missed]]] = locator_weights[inside[missed]]
+        entry = (cells, weights, inside)
+        for array in entry:
+            array.setflags(write=False)
+
+        with self._lock:
+            self.stats["points"] += len(points)
+            self.stats["locator_points"] += len(missed)
+            self.stats["outside_points"] += int((~inside).sum())
+            if key is not None:
+                self._weights[key] = entry
+                while len(self._weights) > self.max_cached_weights:
+                    self._weights.popitem(last=False)
+        if not inside.all():
+            logging.debug(f"{(~inside).sum()} of {len(points)} points are outside the mesh, their displacement is extrapolated")
+        return entry
+
+    def interpolate(self, points, displacement):
+        """
+        Displacement at points (both in m).
+
+        Args:
+            points: (N, 3) query points
+            displacement: (n_nodes, 3) nodal displacement, or (F, n_nodes, 3) for F
+                fields at once (then returns (F, N, 3))
+        """
+        cells, weights, _ = self.weights(points)
+        displacement = np.asarray(displacement, dtype=np.float64)
+        if displacement.shape[-2:] != self.nodes.shape:
+            raise ValueError(f"Displacement of shape {displacement.shape} does not match the {len(self.nodes)} mesh nodes")
+        return np.einsum("...nkj,nk->...nj", displacement[..., self.tets[cells], :], weights)
+
+    def deform(self, points, displacement, unit="m"):
+        """Points moved by the displacement field; unit ("m" or "mm") is the points' unit, also that of the result."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        points_m = convertUnits(points, unit, "m")
+        return points + convertUnits(self.interpolate(points_m, displacement), "m", unit)
+
+
+_INTERPOLATORS = OrderedDict()  # (path, mtime, size) -> DisplacementInterpolator
+_INTERPOLATORS_LOCK = threading.Lock()
+MAX_CACHED_INTERPOLATORS = 4
+
+
+def meshInterpolator(mesh_file, **kwargs):
+    """
+    DisplacementInterpolator of a tetrahedral mesh file (m), kept per process and
+    rebuilt only when the file changes, so its centroid tree, locator and cached
+    weights serve every fold of a case.
+    """
+    st = os.stat(mesh_file)
+    key = (os.path.abspath(mesh_file), st.st_mtime_ns, st.st_size)
+    with _INTERPOLATORS_LOCK:
+        interpolator = _INTERPOLATORS.get(key)
+        if interpolator is not None:
+            _INTERPOLATORS.move_to_end(key)
+            return interpolator
+    interpolator = DisplacementInterpolator.fromFile(mesh_file, **kwargs)
+    with _INTERPOLATORS_LOCK:
+        _INTERPOLATORS[key] = interpolator
+        while len(_INTERPOLATORS) > MAX_CACHED_INTERPOLATORS:
+            _INTERPOLATORS.popitem(last=False)
+    return interpolator
+
+
+def _readDisplacement(sources):
+    return np.loadtxt(sources[0], ndmin=2)
+
+
+def _stackDisplacements(sources):
+    return np.stack([np.loadtxt(source, ndmin=2) for source in sources])
+
+
+def loadDisplacement(file_name, n_nodes=None):
+    """
+    <case>_displacement.out: (n_nodes, 3) nodal displacement, m. The text is parsed
+    once into an .npy sidecar (see data_cache.cachedArraySidecar), which later loads
+    memory-map. A file holding several fields one after the other (e.g. time steps)
+    comes back as (F, n_nodes, 3) when n_nodes is given.
+    """
+    field = cachedArraySidecar([file_name], _readDisplacement)
+    if n_nodes is not None and len(field) != n_nodes:
+        if len(field) % n_nodes:
+            raise ValueError(f"{file_name} has {len(field)} rows, not a multiple of the {n_nodes} mesh nodes")
+        field = field.reshape(-1, n_nodes, 3)
+    return field
+
+
+def loadDisplacementStack(file_names, stack_path):
+    """
+    Displacement fields of several files (e.g. of every fold of a case) as one
+    (F, n_nodes, 3) array, kept in stack_path (.npy) and memory-mapped; rebuilt when
+    any of the files changes. interpolate() takes the stack as is.
+    """
+    return cachedArraySidecar(file_names, _stackDisplacements, sidecar_path=stack_path)
+
+
+def deformTargets(case_dir, case_id, names=None):
+    """
+    Python counterpart of pipe.sh's deformTargetsTumorCavity: deform PreOperative/<name>.vtk
+    (mm) with IntraOperative/<id>_displacement.out on PreOperative/<id>_mesh.vtk and write
+    IntraOperative/PreOperative/<name>_Deformed.vtk (mm), for the fids and target by default.
+
+    Returns:
+        list of Path: the written files
+    """
+    case_dir = Path(case_dir)
+    names = names or [f"{case_id:04d}_fids_mm", f"{case_id:04d}_tgt_mm"]
+    interpolator = meshInterpolator(case_dir / "PreOperative" / f"{case_id:04d}_mesh.vtk")
+    displacement = loadDisplacement(case_dir / "IntraOperative" / f"{case_id:04d}_displacement.out")
+    output_dir = case_dir / "IntraOperative" / "PreOperative"
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for name in names:
+        points_mm = cachedVTKPolyDataPointsParser(case_dir / "PreOperative" / f"{name}.vtk")
+        written.append(output_dir / f"{name}_Deformed.vtk")
+        simpleVTKPolyDataPointsWriter(written[-1], interpolator.deform(points_mm, displacement, unit="mm"))
+    return written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Deform a point set (e.g. tumor margin points) with a case's displacement field")
+    parser.add_argument("mesh", type=str, help="Tetrahedral <id>_mesh.vtk (m)")
+    parser.add_argument("displacement", type=str, help="<id>_displacement.out (m)")
+    parser.add_argument("points", type=str, help="Points to deform (.vtk)")
+    parser.add_argument("output", type=str, help="Deformed points (.vtk)")
+    parser.add_argument("--unit", type=str, default=None, choices=["m", "mm"], help="Unit of the points (default: guessed from the file name)")
+    args = parser.parse_args()
+
+    unit = args.unit or guessUnit(Path(args.points).name) or "m"
+    interpolator = meshInterpolator(args.mesh)
+    deformed = interpolator.deform(cachedVTKPolyDataPointsParser(args.points), loadDisplacement(args.displacement, len(interpolator.nodes)), unit=unit)
+    if deformed.ndim == 2:
+        simpleVTKPolyDataPointsWriter(args.output, deformed)
+    else:
+        # Stacked fields: one output per field, <output>_<i>.vtk
+        output = Path(args.output)
+        for idx, step in enumerate(deformed):
+            simpleVTKPolyDataPointsWriter(output.with_name(f"{output.stem}_{idx}{output.suffix}"), step)
+    logging.info(f"{deformed.shape[-2]} points ({unit}) deformed with {1 if deformed.ndim == 2 else len(deformed)} field(s) to {args.output}: {interpolator.stats}")
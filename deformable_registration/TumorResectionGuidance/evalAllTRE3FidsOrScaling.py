@@ -5,23 +5,47 @@ import argparse
 import re
 import logging
 import shutil
+import time
+import functools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
+import numpy as np
+
+from case_bundle import BUNDLE_SUFFIXES, CaseBundle, CaseDirectory
+from data_cache import DEFAULT_CACHE
+from fold_cache import FoldResultCache, foldStamp, stampFold, toolchainStamps
+from fold_workspace import MODE_LINKED_PATTERNS, FoldWorkspace
+from point_set_registration import ROBUST_MIN_POINTS, leaveOneOutIndices, registerPointSets, robustRegisterPointSets, subsetIndices, transformPoints
+from solver_backends import DEFAULT_PIPE_PARAMETERS, SOLVER_BACKENDS, SolverPool, makeSolverBackend, pipeParameterGrid, pipeParametersTag
+from stage_trace import enableTracing, mergeWorkerTraces, saveTrace, stage, traced, tracePath, workerTracePath
+from tre_results import TREResults, concatColumns, groupStats, saveColumns, summarizeColumns, writeColumnsCSV
+from vtk_points_io import cachedVTKPolyDataPointsParser, simpleVTKPolyDataPointsWriter
+
 RUN_RIGID = True
 if RUN_RIGID:
-    import numpy as np
-    from scipy.linalg import svd
     import vtk
-
-    def perform_rigid_scaling_registration(preop_fids_dir, intraop_fids_dir):
-        preop_fids = simpleVTKPolyDataPointsParser(preop_fids_dir)
-        intraop_fids = simpleVTKPolyDataPointsParser(intraop_fids_dir)
-
-        T = compute_rigid_transform(np.array(preop_fids), np.array(intraop_fids), scaling=True)
+    from mesh_transform import scaleMatrix, scaleMeshInPlace, transformMeshInPlace, transformedMeshes
+    from surface_icp import loadICPTarget, refine_registration_with_surface_icp, refine_with_surface_icp
+
+    def perform_rigid_scaling_registration(preop_fids_dir, intraop_fids_dir, robust=True):
+        preop_fids = cachedVTKPolyDataPointsParser(preop_fids_dir)
+        intraop_fids = cachedVTKPolyDataPointsParser(intraop_fids_dir)
+        return register_fiducials(preop_fids, intraop_fids, robust, intraop_fids_dir)
+
+    def register_fiducials(preop_fids, intraop_fids, robust=True, source=""):
+        if not robust:
+            return compute_rigid_transform(preop_fids, intraop_fids, scaling=True)
+        # Mislocalized fiducials (depth holes, wrong bead) are flagged and left out instead of skewing T
+        T, outliers, residuals = robustRegisterPointSets(preop_fids, intraop_fids, scaling=True)
+        if len(outliers) > 0:
+            logging.warning(f"Fiducial(s) {outliers.tolist()} of {source} flagged as outliers "
+                            f"(residuals {np.round(residuals[outliers] * 1000, 2).tolist()} mm) and left out of the registration")
         return T
 
     def transform_and_save_target(intraop_tgt_dir, T, preop_tgt_output_dir, unit_mm=True):
-        intraop_tgt = simpleVTKPolyDataPointsParser(intraop_tgt_dir)
+        intraop_tgt = cachedVTKPolyDataPointsParser(intraop_tgt_dir)
         if unit_mm == True:
             intraop_tgt = [cur_val*0.001 for cur_val in intraop_tgt[0]]
         transformed_point = transform_point(intraop_tgt, T).squeeze()
@@ -32,18 +56,24 @@ if RUN_RIGID:
 
         simpleVTKPolyDataPointsWriter(preop_tgt_output_dir, transformed_point)
 
-    def transform_and_save_target_pretend_deformed(case_base_dir, case_id):
+    @traced("rigid transform")
+    def transform_and_save_target_pretend_deformed(case_base_dir, case_id, icp_refine=False):
         preop_fids_dir = case_base_dir / "PreOperative" / f"{case_id:04d}_fids.vtk"
         intraop_fids_dir = case_base_dir / "IntraOperative" / f"1{case_id:03d}_fids_transformed.vtk"
         T = perform_rigid_scaling_registration(preop_fids_dir, intraop_fids_dir)
+        if icp_refine:
+            fiducials = (cachedVTKPolyDataPointsParser(preop_fids_dir), cachedVTKPolyDataPointsParser(intraop_fids_dir))
+            T = refine_registration_with_surface_icp(case_base_dir, case_id, T, fiducials=fiducials)
 
         output_base_dir = case_base_dir / "IntraOperative" / "PreOperative"
         os.makedirs(output_base_dir, exist_ok=True)
         preop_tgt_output_dir = output_base_dir / f"{case_id:04d}_tgt_mm_Deformed.vtk"
         preop_tgt_dir = case_base_dir / "PreOperative" / f"{case_id:04d}_tgt_mm.vtk"
         transform_and_save_target(preop_tgt_dir, T, preop_tgt_output_dir)
+        # The fold's registration fiducials, as pipe.sh deforms them on the deformable path
         preop_fids_output_dir = output_base_dir / f"{case_id:04d}_fids_mm_Deformed.vtk"
-        transform_and_save_target(preop_tgt_dir, T, preop_fids_output_dir) # TODO: change this to actual fids
+        preop_fids_mm = np.asarray(cachedVTKPolyDataPointsParser(case_base_dir / "PreOperative" / f"{case_id:04d}_fids_mm.vtk"), dtype=np.float64) # mm
+        simpleVTKPolyDataPointsWriter(preop_fids_output_dir, transform_points(preop_fids_mm * 0.001, T) * 1000) # mm
 
         cur_mesh_dir = case_base_dir / "PreOperative" / f"{case_id:04d}_bel.vtk"
         cur_deformed_file_name = f"{case_id:04d}_bel_deformed_initial.vtk"
@@ -61,52 +91,15 @@ if RUN_RIGID:
 
 
     def scale_vtk_mesh(mesh, scale_factor):
-        points = mesh.GetPoints()
-        for i in range(points.GetNumberOfPoints()):
-            p = np.array(points.GetPoint(i))
-            scaled_p = p * scale_factor  # 每个点乘以 scale
-            points.SetPoint(i, scaled_p)
-        mesh.Modified()
-        return mesh
+        return scaleMeshInPlace(mesh, scale_factor)
 
     # rigid transform + scaling (Umeyama)
     def compute_rigid_transform(source, target, scaling=True):
-        mu_source = np.mean(source, axis=0)
-        mu_target = np.mean(target, axis=0)
-
-        source_centered = source - mu_source
-        target_centered = target - mu_target
-
-        H = source_centered.T @ target_centered
-        U, S, Vt = svd(H)
-        R = Vt.T @ U.T
-        if np.linalg.det(R) < 0:
-            Vt[-1, :] *= -1
-            R = Vt.T @ U.T
-
-        print(source_centered)
-        print(S)
-
-        T = np.eye(4)
-        if scaling:
-            scale = np.sum(S) / np.sum(source_centered ** 2)
-            T[:3, :3] = scale * R
-            t = mu_target - scale * (R @ mu_source)
-        else:
-            T[:3, :3] = R
-            t = mu_target - (R @ mu_source)
-
-        T[:3, 3] = t
+        T, _ = registerPointSets(source, target, scaling=scaling)
         return T
 
     def transform_vtk_mesh(mesh, T):
-        points = mesh.GetPoints()
-        for i in range(points.GetNumberOfPoints()):
-            p = np.array(points.GetPoint(i) + (1,))
-            p_new = T @ p
-            points.SetPoint(i, p_new[:3])
-        mesh.Modified()
-        return mesh
+        return transformMeshInPlace(mesh, T)
 
     def save_vtk_mesh(mesh, filename):
         writer = vtk.vtkPolyDataWriter()
@@ -115,82 +108,10 @@ if RUN_RIGID:
         writer.Write()
 
     def transform_point(point, T):
-        p_homogeneous = np.array([point[0], point[1], point[2], 1])  # 齐次坐标
-        p_transformed = T @ p_homogeneous
-        return p_transformed[:3]
+        return transformPoints(T, np.reshape(point, (1, 3)))[0]
 
     def transform_points(points, T):
-        p_homogeneous = np.stack(points, np.ones((points.shape[0], 1)), axis=-1) # n x 4
-        p_transformed = T @ p_homogeneous.T # 4 x n
-        return p_transformed[:3, :].T
-
-# let's keep things vanilla...
-# import numpy
-# import vtk
-
-def mean(lst):
-    return sum(lst) / len(lst)
-
-def std_dev(lst, sample=True):
-    if len(lst) < 2:
-        raise ValueError("Standard deviation requires at least two data points.")
-    
-    m = mean(lst)
-    variance = sum((x - m) ** 2 for x in lst) / (len(lst) - (1 if sample else 0))
-    return variance ** 0.5
-
-def computeDistance(point_a, point_b):
-    d = 0
-    for i in range(3):
-        d += (point_a[i] - point_b[i]) ** 2
-    d = d ** 0.5
-
-    return d
-
-def simpleVTKPolyDataPointsWriter(file_name, points, header=None):
-    if header == None:
-        headerList = ["# vtk DataFile Version 3.0\n", "vtk output\n", "ASCII\n", "DATASET POLYDATA\n", ]
-    else:
-        headerList = header.split("\n")
-
-    nPoints = len(points)
-    headerList.append(f"POINTS {nPoints} float\n")
-    for point in points:
-        headerList.append(f"{point[0]:.12f} {point[1]:.12f} {point[2]:.12f}\n")
-    headerList.append("\n")
-    headerList.append("\n")
-    headerList.append(f"VERTICES {nPoints} {nPoints * 2}\n")
-    for i, point in enumerate(points):
-        headerList.append(f"1 {i}\n")
-
-    with open(file_name, "w") as vtk_out_file:
-        vtk_out_file.writelines(headerList)
-
-
-def simpleVTKPolyDataPointsParser(file_name):
-    with open(file_name, "r") as vtkFile:
-        points_started = False
-        points_stopped = False
-        nPoints = 0
-        pts1D = []
-        for line in vtkFile:
-            if line.upper().startswith("POINTS"):
-                points_started = True
-                nPoints = int(re.search(r"POINTS (\d+) float", line).group(1))
-            elif points_started == False:
-                continue
-            else:
-                if not points_stopped:
-                    if re.match(r"^[A-Za-z\n ]", line) or len(line) == 0:
-                        points_stopped = True
-                        break
-                    else:
-                        curLineList = line.strip(" ").strip("\n").strip(" ").split(" ")
-                        for elem in curLineList:
-                            pts1D.append(float(elem))
-        assert(nPoints == len(pts1D) / 3)
-        pts = [pts1D[i:i+3] for i in range(0, len(pts1D), 3)]
-        return pts
+        return transformPoints(T, points)
 
 def extractInteger(fileName):
     return(int(fileName.split("_")[1]))
@@ -199,6 +120,531 @@ def extractInteger(fileName):
     #     return int(match.group(1))  # Convert to integer
     # return None  # Return None if pattern is not found
 
+SUBSET_TRE_HEADER = "case_id, n_fids, subset_idx, subset, heldout_fid, tre_mm\n"
+
+def intraop_prealignment(case, preop_fids):
+    # The fold-independent rigid pre-alignment tumorProcessingWTarget applies to the intraop data:
+    # the raw intraop fiducials (m) registered onto the preop ones. The case's *_transformed files
+    # are that MATLAB step's outputs, missing from fresh cases and stale once it reruns per fold.
+    T, _ = registerPointSets(case.points("intraop_fids", "m"), preop_fids)
+    return T
+
+def evaluateFiducialSubsets(case, subset_sizes):
+    """
+    Rigid-path TRE for every k-subset of the fiducials, evaluated in memory.
+
+    Each subset registers the preoperative fiducials onto the transformed intraoperative
+    ones with the robust similarity transform of the leave-one-out folds
+    (robustRegisterPointSets, as register_fiducials), and the remaining fiducials are the
+    targets; the k = nFids - 1 rows are thus the leave-one-out TREs. Subsets smaller than
+    ROBUST_MIN_POINTS, where that is the plain fit, are solved in a single batched call
+    per size. The raw intraop fiducials are pre-aligned once in memory
+    (intraop_prealignment); any initial rigid alignment is absorbed by the registration,
+    so the TREs are those of the file round-trip through tumorProcessingWTarget.
+
+    Args:
+        case (CaseDirectory | CaseBundle): case holding the preop fids (m and mm) and
+            the raw intraop fids
+        subset_sizes (iterable of int): fiducial counts k; sizes with k < 3 or with no
+            fiducial left out are skipped
+
+    Returns:
+        list of tuples: (n_fids, subset_idx, subset, heldout_fid, tre_mm) rows
+    """
+    preop_fids = case.points("preop_fids", "m")
+    preop_tgts = case.points("preop_fids_mm", "m")
+    intraop_fids = transformPoints(intraop_prealignment(case, preop_fids), case.points("intraop_fids", "m"))
+    nFids = len(preop_fids)
+    assert(len(preop_tgts) == nFids and len(intraop_fids) == nFids)
+
+    rows = []
+    for k in sorted(set(subset_sizes)):
+        if k < 3 or k >= nFids:
+            logging.warning(f"Skipping subsets of {k} fiducials: {nFids} fiducials available")
+            continue
+        subsets = subsetIndices(nFids, k)
+        if k < ROBUST_MIN_POINTS:
+            T, _ = registerPointSets(preop_fids[subsets], intraop_fids[subsets], scaling=True)
+            n_flagged = 0
+        else:
+            fits = [robustRegisterPointSets(preop_fids[subset], intraop_fids[subset], scaling=True) for subset in subsets]
+            T = np.stack([fit[0] for fit in fits])
+            n_flagged = sum(len(fit[1]) > 0 for fit in fits)
+        tre_mm = 1000 * np.linalg.norm(transformPoints(T, preop_tgts) - intraop_fids, axis=-1)  # (C, nFids)
+        heldout = np.ones(tre_mm.shape, dtype=bool)
+        heldout[np.arange(len(subsets))[:, None], subsets] = False
+        for idx_subset, idx_fid in zip(*np.nonzero(heldout)):
+            rows.append((k, idx_subset, " ".join(map(str, subsets[idx_subset])), idx_fid, tre_mm[idx_subset, idx_fid]))
+        cur_tres = tre_mm[heldout]
+        logging.info(f"{k} fiducials, {len(subsets)} subsets ({n_flagged} with flagged outliers): TRE mean {cur_tres.mean():.3f} mm, "
+                     f"median {np.median(cur_tres):.3f} mm, 95th percentile {np.percentile(cur_tres, 95):.3f} mm, max {cur_tres.max():.3f} mm")
+    return rows
+
+
+def evaluateLeaveOneOut(case, icp_refine=False):
+    """
+    Rigid-path leave-one-out folds of a case, registered and evaluated in memory.
+
+    Fold i registers the other fiducials (all of them with fewer than 4) as
+    perform_rigid_scaling_registration does, optionally refines the result with surface
+    ICP, and maps the held-out preoperative fiducial. The case's points (and the bel
+    mesh, for ICP) are read once for all folds and nothing is written.
+
+    The raw intraop fiducials (and sparse data) are pre-aligned once onto the preop
+    fiducials (intraop_prealignment) instead of reading the MATLAB step's
+    *_transformed outputs. That frame differs from the one tumorProcessingWTarget gives
+    each fold only by a rigid motion; the registration absorbs it, so the TREs are those
+    of the file-based folds (run_fold). ICP refinement rotates about the sparse data's
+    centroid, so it is frame-invariant too, up to round-off.
+
+    Args:
+        case (CaseDirectory | CaseBundle): case holding the preop and intraop fids (the
+            preop ones in m and mm) and, with icp_refine, the raw sparse data and bel mesh
+
+    Returns:
+        dict: "T" (F, 4, 4) preop -> intraop transforms, "fids" (F, K) indices of the
+        fiducials each fold registered, "gt_mm" and "tgt_mm" (F, 3)
+        ground truth and registered held-out fiducials, "seconds" (F,) per fold
+    """
+    preop_fids = case.points("preop_fids", "m")
+    preop_tgts = case.points("preop_fids_mm", "m")
+    intraop_T = intraop_prealignment(case, preop_fids)
+    intraop_fids = transformPoints(intraop_T, case.points("intraop_fids", "m"))
+    nFids = len(preop_fids)
+    assert(len(preop_tgts) == nFids and len(intraop_fids) == nFids)
+    if nFids >= 4:
+        folds = leaveOneOutIndices(nFids)
+    else:
+        logging.warning(f"Only {nFids} fiducials available in {case}, **all** are used for registration.")
+        folds = np.tile(np.arange(nFids), (nFids, 1))
+    if icp_refine:
+        sparse_data = transformPoints(intraop_T, case.points("sparsedata", "m"))
+        bel = loadICPTarget(case.path("bel"), scale=0.001)
+
+    T = np.empty((nFids, 4, 4))
+    seconds = np.empty(nFids)
+    for idx_eval in range(nFids):
+        start = time.perf_counter()
+        T[idx_eval] = register_fiducials(preop_fids[folds[idx_eval]], intraop_fids[folds[idx_eval]], source=f"{case}, fold {idx_eval}")
+        if icp_refine:
+            fiducials = (preop_fids[folds[idx_eval]], intraop_fids[folds[idx_eval]])
+            T[idx_eval] = refine_with_surface_icp(sparse_data, bel, case.case_id, T[idx_eval], fiducials=fiducials)
+        seconds[idx_eval] = time.perf_counter() - start
+    tgt_mm = 1000 * transformPoints(T, preop_tgts[:, None, :])[:, 0]
+    return {"T": T, "fids": folds, "gt_mm": 1000 * np.asarray(intraop_fids, dtype=np.float64), "tgt_mm": tgt_mm, "seconds": seconds}
+
+
+def writeLeaveOneOutResults(case, folds, cur_case_results_dir):
+    """
+    Write in-memory folds (see evaluateLeaveOneOut) as PreOperative_<idx> folders of
+    cur_case_results_dir, with the files collect_case_tres reads plus the fold's registered
+    fiducials (as the file-based folds write them) and bel mesh; the bel meshes of all
+    folds come from one batched transform.
+    """
+    case_id = case.case_id
+    preop_fids_mm = case.points("preop_fids_mm", "mm")
+    bel_meshes = transformedMeshes(case.polydata("bel"), folds["T"] @ scaleMatrix(0.001))
+    for idx_eval, (T, fids, gt_mm, tgt_mm, bel_mesh) in enumerate(zip(folds["T"], folds["fids"], folds["gt_mm"], folds["tgt_mm"], bel_meshes)):
+        fold_dir = cur_case_results_dir / f"PreOperative_{idx_eval}"
+        os.makedirs(fold_dir, exist_ok=True)
+        simpleVTKPolyDataPointsWriter(fold_dir / f"{case_id:04d}_tgt_mm_Deformed.vtk", [tgt_mm]) # mm
+        simpleVTKPolyDataPointsWriter(fold_dir / f"{case_id:04d}_fids_mm_Deformed.vtk", transformPoints(T, preop_fids_mm[fids] * 0.001) * 1000) # mm
+        simpleVTKPolyDataPointsWriter(fold_dir / f"1{case_id:03d}_tgt_transformed.vtk", [gt_mm * 0.001]) # m
+        simpleVTKPolyDataPointsWriter(fold_dir / f"{case_id:04d}_tgt_mm_{idx_eval}.vtk", preop_fids_mm[idx_eval:idx_eval + 1]) # mm
+        save_vtk_mesh(bel_mesh, str(fold_dir / f"{case_id:04d}_bel_deformed_initial.vtk"))
+
+
+def run_fold(cur_case_dir, case_id, idx_eval, cur_case_results_dir, solver, icp_refine=False):
+    """
+    Leave-one-out fold idx_eval of a case: hold out that fiducial, re-register, deform (or
+    rigidly transform) and copy everything the TRE needs to cur_case_results_dir/PreOperative_<idx_eval>.
+
+    The fold rewrites the case's fids/tgt files and the MATLAB/pipe.sh outputs in place, so
+    cur_case_dir must be a fresh FoldWorkspace of the case (see run_fold_task). The MATLAB
+    and pipe.sh steps go through solver (a SolverPool or SolverBackend).
+    """
+    prepare_fold(cur_case_dir, case_id, idx_eval, solver)
+    finish_fold(cur_case_dir, case_id, idx_eval, cur_case_results_dir, solver, RUN_RIGID, icp_refine)
+
+
+@traced()
+def prepare_fold(cur_case_dir, case_id, idx_eval, solver):
+    """
+    Parameter-independent first half of a fold: write the leave-one-out fids/tgt files
+    and run the initial rigid registration (tumorProcessingWTarget) in cur_case_dir.
+    """
+    cur_surface_dir = cur_case_dir / "IntraOperative"
+    cur_mesh_dir = cur_case_dir / "PreOperative"
+
+    preop_fid_dir = cur_mesh_dir / f"{case_id:04d}_fids.vtk" # m
+    preop_fid_mm_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm.vtk" # mm
+    intraop_fid_dir = cur_surface_dir / f"1{case_id:03d}_fids.vtk" # m?
+    # The workspace starts from the canonical files, read here before the fold rewrites them
+    preop_fid_og = cachedVTKPolyDataPointsParser(preop_fid_dir) # m
+    preop_fid_mm_og = cachedVTKPolyDataPointsParser(preop_fid_mm_dir) # mm
+    intraop_fid_og = cachedVTKPolyDataPointsParser(intraop_fid_dir) # m
+
+    preop_tgt_mm_dir = cur_mesh_dir / f"{case_id:04d}_tgt_mm.vtk"
+    intraop_tgt_dir = cur_surface_dir / f"1{case_id:03d}_tgt.vtk"
+
+    nFids = len(preop_fid_og)
+    logging.info(f"\n\nPreparing evaluation of fiducial index {idx_eval}/{nFids-1}...")
+    if nFids >= 4:
+        cur_preop_fids = [preop_fid_og[i] for i in range(nFids) if i != idx_eval]
+        cur_preop_fids_mm = [preop_fid_mm_og[i] for i in range(nFids) if i != idx_eval]
+        cur_intraop_fids = [intraop_fid_og[i] for i in range(nFids) if i != idx_eval]
+    else:
+        logging.warning(f"Only {nFids} fiducials available, **all** are used for registration.")
+        cur_preop_fids = [preop_fid_og[i] for i in range(nFids)]
+        cur_preop_fids_mm = [preop_fid_mm_og[i] for i in range(nFids)]
+        cur_intraop_fids = [intraop_fid_og[i] for i in range(nFids)]
+
+    cur_preop_tgt_mm = [preop_fid_mm_og[idx_eval]]
+    cur_intraop_tgt_gt = [intraop_fid_og[idx_eval]]
+
+    with stage("write fold files"):
+        simpleVTKPolyDataPointsWriter(preop_fid_dir, cur_preop_fids)
+        simpleVTKPolyDataPointsWriter(preop_fid_mm_dir, cur_preop_fids_mm)
+        simpleVTKPolyDataPointsWriter(intraop_fid_dir, cur_intraop_fids)
+        simpleVTKPolyDataPointsWriter(preop_tgt_mm_dir, cur_preop_tgt_mm)
+        simpleVTKPolyDataPointsWriter(intraop_tgt_dir, cur_intraop_tgt_gt)
+
+    # 1.1.1 "Re-register"
+    # tumorProcessingWTarget('D:/Projects/Head_Neck_Marker_Alignment/deformed_model_processing/deformation_models_server/for_fj/TumorResectionGuidance_new_intra_matlab_tests/Pt_0000022', '0022')
+    logging.info(f"Initial Rigid Registration for fiducial index {idx_eval}/{nFids-1}...")
+    solver.run("tumorProcessingWTarget", cur_case_dir, case_id)
+
+
+@traced()
+def finish_fold(cur_case_dir, case_id, idx_eval, cur_case_results_dir, solver, rigid, icp_refine=False, pipe_parameters=None):
+    """
+    Second half of a fold, on a case directory prepared by prepare_fold: deform with
+    pipe.sh (pipe_parameters override the solver's nCP/seWeight/kEpsilon) or, if rigid,
+    transform the target, then copy the results to cur_case_results_dir/PreOperative_<idx_eval>.
+    """
+    cur_surface_dir = cur_case_dir / "IntraOperative"
+    cur_mesh_dir = cur_case_dir / "PreOperative"
+
+    preop_fid_dir = cur_mesh_dir / f"{case_id:04d}_fids.vtk" # m
+    preop_fid_mm_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm.vtk" # mm
+    preop_tgt_mm_dir = cur_mesh_dir / f"{case_id:04d}_tgt_mm.vtk"
+    intraop_tgt_transformed_dir = cur_surface_dir / f"1{case_id:03d}_tgt_transformed.vtk"
+
+    if not rigid:
+        # # 2. Prepare bash command to run the target
+        # # bash ${BASEDIR}/pipe.sh ${BASEDIR}/Pt_0000023 45 11 0.01 nonrigidRegisterTumorCavity
+        logging.info(f"Deforming for evaluation of fiducial index {idx_eval}...")
+        solver.run("nonrigidRegisterTumorCavity", cur_case_dir, case_id, pipe_parameters)
+
+        # # bash ${BASEDIR}/pipe.sh ${BASEDIR}/Pt_0000023 45 11 0.01 deformTargetsTumorCavity
+        solver.run("deformTargetsTumorCavity", cur_case_dir, case_id, pipe_parameters)
+    else:
+        transform_and_save_target_pretend_deformed(cur_case_dir, case_id, icp_refine=icp_refine)
+
+    # Rename/move Target Files
+    cur_deformed_source_base_dir = cur_surface_dir / "PreOperative"
+
+    cur_deformed_results_base_dir = cur_case_results_dir / f"PreOperative_{idx_eval}"
+    cur_deformed_results_base_dir = cur_deformed_results_base_dir.resolve()
+    os.makedirs(cur_deformed_results_base_dir, exist_ok=True)
+    shutil.copytree(cur_deformed_source_base_dir, cur_deformed_results_base_dir, dirs_exist_ok=True)
+
+    cur_preop_fid_dir = cur_mesh_dir / f"{case_id:04d}_fids_{idx_eval}.vtk" # m
+    shutil.copy(preop_fid_dir, cur_preop_fid_dir)
+
+    cur_preop_fid_mm_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm_{idx_eval}.vtk" # m
+    shutil.copy(preop_fid_mm_dir, cur_preop_fid_mm_dir)
+
+    intraop_fid_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed.vtk" # m
+    cur_intraop_fid_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed_{idx_eval}.vtk" # m
+    shutil.copy(intraop_fid_transformed_dir, cur_intraop_fid_transformed_dir)
+
+    intraop_sparsedata_transformed_dir = cur_surface_dir / f"1{case_id:03d}_sparsedata_transformed.vtk" # m
+    cur_intraop_sparsedata_transformed_dir = cur_surface_dir / f"1{case_id:03d}_sparsedata_transformed_{idx_eval}.vtk" # m
+    shutil.copy(intraop_sparsedata_transformed_dir, cur_intraop_sparsedata_transformed_dir)
+
+    cur_preop_tgt_mm_dir = cur_mesh_dir / f"{case_id:04d}_tgt_mm_{idx_eval}.vtk"
+    shutil.copy(preop_tgt_mm_dir, cur_preop_tgt_mm_dir)
+
+    cur_intraop_tgt_dir = cur_surface_dir / f"1{case_id:03d}_tgt_transformed_{idx_eval}.vtk"
+    shutil.copy(intraop_tgt_transformed_dir, cur_intraop_tgt_dir)
+
+    # Copy all info related to current eval to the results section
+    cur_intraop_tgt_results_dir = cur_deformed_results_base_dir / f"1{case_id:03d}_tgt_transformed.vtk"
+    shutil.copy(cur_intraop_tgt_dir, cur_intraop_tgt_results_dir) # gt_tgt
+    shutil.copy(cur_preop_tgt_mm_dir, cur_deformed_results_base_dir / cur_preop_tgt_mm_dir.name) # tgt un-deformed
+    shutil.copy(cur_preop_fid_dir, cur_deformed_results_base_dir / cur_preop_fid_dir.name)
+    shutil.copy(cur_preop_fid_mm_dir, cur_deformed_results_base_dir / cur_preop_fid_mm_dir.name)
+    shutil.copy(cur_intraop_fid_transformed_dir, cur_deformed_results_base_dir / cur_intraop_fid_transformed_dir.name)
+    shutil.copy(cur_intraop_sparsedata_transformed_dir, cur_deformed_results_base_dir / cur_intraop_sparsedata_transformed_dir.name)
+    cur_deformed_file_name = f"{case_id:04d}_bel_deformed_initial.vtk"
+    cur_deformed_mesh_dir = cur_surface_dir / cur_deformed_file_name
+    shutil.copy(cur_deformed_mesh_dir, cur_deformed_results_base_dir / cur_deformed_file_name) # deformed mesh
+
+
+@traced()
+def collect_case_tres(tre_results, cur_case_results_dir, case_id, skipped_folds=(), fold_seconds=None):
+    """
+    Add the TRE of every fold folder (PreOperative_<idx>) of a case's results to
+    tre_results and write the case's legacy TRE.csv next to them (ground truth and
+    deformed target in mm, then the TRE; no header).
+
+    Args:
+        skipped_folds (iterable of int): folds left out, e.g. failed in this run
+        fold_seconds (dict, optional): fold index -> run time (s) of the folds run this time
+
+    Returns:
+        dict: groupStats of the case's TREs (a single group), or None if no fold has results
+    """
+    fold_seconds = fold_seconds or {}
+    skipped_dirs = {f"PreOperative_{idx_eval}" for idx_eval in skipped_folds}
+    cur_case_results_dir_list = sorted(os.listdir(cur_case_results_dir))
+    all_tgts_dirs = [cur_case_results_dir / cur_dir for cur_dir in cur_case_results_dir_list
+                     if cur_dir.startswith("PreOperative_") and os.path.isdir(cur_case_results_dir / cur_dir) and cur_dir not in skipped_dirs]
+    n_case_rows = len(tre_results)
+    for cur_dir in all_tgts_dirs:
+        cur_dir = cur_dir.resolve()
+        idx_eval = extractInteger(cur_dir.name)
+        cur_gt_tgt = cachedVTKPolyDataPointsParser(cur_dir / f"1{case_id:03d}_tgt_transformed.vtk")[0] * 1000 # m -> mm
+        cur_tgt = cachedVTKPolyDataPointsParser(cur_dir / f"{case_id:04d}_tgt_mm_Deformed.vtk")[0] # mm
+        tre_results.add(case_id, idx_eval, cur_gt_tgt, cur_tgt, fold_seconds.get(idx_eval))
+
+    case_columns = {name: values[n_case_rows:] for name, values in tre_results.columns().items()}
+    cur_case_tres = case_columns["tre_mm"]
+    if len(cur_case_tres) == 0:
+        if os.path.exists(cur_case_results_dir / "TRE.csv"):
+            os.remove(cur_case_results_dir / "TRE.csv")
+        return None
+    for idx_eval, cur_tre in zip(case_columns["fold"], cur_case_tres):
+        logging.info(f"TRE for fids {idx_eval} in {cur_case_results_dir}: {cur_tre} mm.")
+    write_case_tre_csv(cur_case_results_dir / "TRE.csv", case_columns)
+    return groupStats(cur_case_tres, np.zeros(len(cur_case_tres), dtype=np.intp), 1)
+
+
+def write_case_tre_csv(file_name, case_columns):
+    # Legacy per-case TRE.csv: ground truth and deformed target in mm, then the TRE; no header
+    with open(file_name, "w") as save_f:
+        save_f.writelines(f"{row[0]}, {row[1]}, {row[2]}, {row[3]}, {row[4]}, {row[5]}, {row[6]}\n" for row in zip(
+            *[case_columns[name].tolist() for name in ("gt_x_mm", "gt_y_mm", "gt_z_mm", "tgt_x_mm", "tgt_y_mm", "tgt_z_mm", "tre_mm")]))
+
+
+def run_fold_task(task):
+    """
+    Run one fold described by a task dict in its own FoldWorkspace, catching its failure.
+
+    The fold's PreOperative_<idx> folder is staged in the workspace, stamped with the
+    fold's key and promoted to the case's results folder only once complete (then
+    added to the fold cache); the case directory itself is never written.
+
+    A sweep job (task["pipe_parameters"] set) starts from a case directory already
+    prepared by prepare_fold_task and only runs the deformable half of the fold, with
+    its parameters and its own LIBR.cfg.
+
+    Returns:
+        tuple: (case folder name, idx_eval, None or the formatted traceback, seconds)
+    """
+    cur_case_dir = Path(task["case_dir"])
+    start = time.perf_counter()
+    fold_stage = stage("fold", case=cur_case_dir.name, fold=task["idx_eval"],
+                       parameters=None if task.get("pipe_parameters") is None else pipeParametersTag(task["pipe_parameters"]))
+    try:
+        with fold_stage, FoldWorkspace(cur_case_dir, task["workspace"]) as workspace:
+            if task.get("pipe_parameters") is None:
+                run_fold(workspace.case_dir, task["case_id"], task["idx_eval"], workspace.results_dir,
+                         _SOLVER_POOL, task["icp_refine"])
+            else:
+                finish_fold(workspace.case_dir, task["case_id"], task["idx_eval"], workspace.results_dir,
+                            _SOLVER_POOL, rigid=False, pipe_parameters=task["pipe_parameters"])
+            stampFold(workspace.results_dir / f"PreOperative_{task['idx_eval']}", task["key"])
+            cur_fold_results_dir = workspace.promote(f"PreOperative_{task['idx_eval']}", task["results_dir"])
+        if task["cache_dir"] is not None:
+            FoldResultCache(task["cache_dir"]).store(task["key"], cur_fold_results_dir)
+        return (cur_case_dir.name, task["idx_eval"], None, time.perf_counter() - start)
+    except Exception:
+        logging.exception(f"Fold {task['idx_eval']} of {cur_case_dir.name} failed")
+        return (cur_case_dir.name, task["idx_eval"], traceback.format_exc(), time.perf_counter() - start)
+    finally:
+        save_worker_trace()
+
+
+def mode_workspace_task(task):
+    """
+    Mode files of a case for one number of control points, shared by all folds of a
+    sweep with that nCP: pipe.sh's calcKModes in a FoldWorkspace at task["workspace"]
+    (with the mode tables and LIBR files copied, since it rewrites them) that is kept
+    for the prepare_fold_task workspaces of that nCP to start from.
+
+    Returns:
+        tuple: as run_fold_task
+    """
+    cur_case_dir = Path(task["case_dir"])
+    start = time.perf_counter()
+    try:
+        with stage("mode workspace task", case=cur_case_dir.name, nCP=task["nCP"]):
+            workspace = FoldWorkspace(cur_case_dir, task["workspace"], linked_patterns=MODE_LINKED_PATTERNS).create()
+            logging.info(f"Computing the modes of {cur_case_dir.name} for nCP {task['nCP']}...")
+            _SOLVER_POOL.run("calcKModes", workspace.case_dir, task["case_id"], {"nCP": task["nCP"]})
+        return (cur_case_dir.name, task["idx_eval"], None, time.perf_counter() - start)
+    except Exception:
+        logging.exception(f"Computing the modes of {cur_case_dir.name} for nCP {task['nCP']} failed")
+        return (cur_case_dir.name, task["idx_eval"], traceback.format_exc(), time.perf_counter() - start)
+    finally:
+        save_worker_trace()
+
+
+def prepare_fold_task(task):
+    """
+    Half of a fold shared by the points of a sweep: prepare_fold in a FoldWorkspace at
+    task["workspace"] that is kept for the sweep jobs to start from. task["case_dir"]
+    is the case or, when the sweep regenerates the modes, the case folder of a
+    mode_workspace_task workspace, whose mode files are then linked, not recomputed;
+    the workspace serves the seWeight/kEpsilon points of that nCP only.
+
+    Returns:
+        tuple: as run_fold_task
+    """
+    cur_case_dir = Path(task["case_dir"])
+    start = time.perf_counter()
+    try:
+        with stage("prepare fold task", case=cur_case_dir.name, fold=task["idx_eval"]):
+            workspace = FoldWorkspace(cur_case_dir, task["workspace"]).create()
+            prepare_fold(workspace.case_dir, task["case_id"], task["idx_eval"], _SOLVER_POOL)
+        return (cur_case_dir.name, task["idx_eval"], None, time.perf_counter() - start)
+    except Exception:
+        logging.exception(f"Preparing fold {task['idx_eval']} of {cur_case_dir.name} failed")
+        return (cur_case_dir.name, task["idx_eval"], traceback.format_exc(), time.perf_counter() - start)
+    finally:
+        save_worker_trace()
+
+
+# Solver of the folds run by this process, kept warm from one fold (and case) to the next
+_SOLVER_POOL = None
+# Set in pool workers (see _init_fold_worker)
+_IN_FOLD_WORKER = False
+
+
+def start_fold_solver(solver_options):
+    """
+    Start this process's SolverPool, if not running yet.
+
+    Args:
+        solver_options (dict): "backend" name and "backend_kwargs" for makeSolverBackend,
+            plus the pool's "timeout" and "retries"
+    """
+    global _SOLVER_POOL
+    if _SOLVER_POOL is None:
+        backend_factory = functools.partial(makeSolverBackend, solver_options["backend"], **solver_options["backend_kwargs"])
+        _SOLVER_POOL = SolverPool(backend_factory, timeout=solver_options["timeout"], retries=solver_options["retries"])
+    return _SOLVER_POOL
+
+
+def stop_fold_solver():
+    global _SOLVER_POOL
+    if _SOLVER_POOL is not None:
+        _SOLVER_POOL.close()
+        _SOLVER_POOL = None
+
+
+def save_worker_trace():
+    # Pool workers never reach atexit: they write their trace after every task. The parent,
+    # which also runs the tasks of a --jobs 1 run, saves its trace once at the end instead.
+    if _IN_FOLD_WORKER:
+        saveTrace()
+
+
+def _init_fold_worker(solver_options, trace_path=None):
+    # Pool workers live for the whole run; their solver goes down with the process.
+    # A traced run's workers write their own trace files, merged by the parent at the end.
+    global _IN_FOLD_WORKER
+    _IN_FOLD_WORKER = True
+    logging.basicConfig(level=logging.INFO)
+    if trace_path is not None:
+        enableTracing(workerTracePath(trace_path), f"fold worker {os.getpid()}")
+    start_fold_solver(solver_options)
+
+
+def run_fold_tasks(tasks, solver_options, jobs=1, on_done=None, task_function=run_fold_task):
+    """
+    Run fold tasks, one after another (jobs == 1) or in a pool of `jobs` processes.
+
+    Every process running folds keeps one warm solver (see start_fold_solver), and is
+    traced if this process is (see stage_trace). A failing fold does not stop the
+    others. on_done(task, result) is called in the parent process as each task
+    finishes, in completion order.
+
+    Returns:
+        list of tuples: task_function (run_fold_task or prepare_fold_task) results, in the order of `tasks`
+    """
+    if jobs <= 1:
+        start_fold_solver(solver_options)
+        results = []
+        try:
+            for task in tasks:
+                results.append(task_function(task))
+                if on_done is not None:
+                    on_done(task, results[-1])
+        finally:
+            stop_fold_solver()
+        return results
+
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_fold_worker, initargs=(solver_options, tracePath())) as executor:
+        futures = {executor.submit(task_function, task): idx for idx, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            task = tasks[futures[future]]
+            try:
+                results[futures[future]] = future.result()
+            except Exception:
+                # The worker itself died (e.g. killed); run_fold_task catches everything else
+                logging.exception(f"Worker running fold {task['idx_eval']} of {Path(task['case_dir']).name} failed")
+                results[futures[future]] = (Path(task["case_dir"]).name, task["idx_eval"], traceback.format_exc(), np.nan)
+            if on_done is not None:
+                on_done(task, results[futures[future]])
+    return results
+
+
+def report_case_tres(cur_case_stats, case_name, case_id, run_name, fold_note=""):
+    """Log a case's TRE statistics (groupStats of one group); returns its legacy TRE_all line."""
+    logging.info(f"TRE for {case_name}{fold_note}: mean {cur_case_stats['mean_mm'][0]} mm, std {cur_case_stats['std_mm'][0]} mm, "
+                 f"RMS {cur_case_stats['rms_mm'][0]} mm, 95th percentile {cur_case_stats['p95_mm'][0]} mm.\n")
+    # Legacy header-less mean/std/max/min per case
+    return f"{cur_case_stats['mean_mm'][0]}, {cur_case_stats['std_mm'][0]}, {cur_case_stats['max_mm'][0]}, {cur_case_stats['min_mm'][0]}, {run_name}, {case_id}\n"
+
+
+def save_run_tres(tre_dir, run_name, tre_parts, case_tre_all, sweep=False):
+    """
+    Write a run's TRE tables: TRE_all_<run>.csv (legacy lines of report_case_tres, not
+    for sweeps), TRE_<run>.npz/.csv of every fold, TRE_summary_<run>.csv per case and,
+    for a sweep, TRE_sweep_<run>.csv per point; and log the run's statistics.
+
+    Args:
+        tre_parts (list of dict): TREResults.columns() of the run (one per sweep point)
+    """
+    if not sweep:
+        with open(tre_dir / f"TRE_all_{run_name}.csv", "w") as save_f:
+            save_f.writelines(case_tre_all)
+    tre_columns = concatColumns(tre_parts)
+    with stage("save TREs"):
+        tre_paths = saveColumns(tre_columns, tre_dir / f"TRE_{run_name}")
+    logging.info(f"TREs of all folds saved at {', '.join(str(p) for p in tre_paths)}")
+    if len(tre_columns["tre_mm"]) > 0:
+        by = ("run",) + tuple(DEFAULT_PIPE_PARAMETERS) if sweep else ("run",)
+        summary_path = tre_dir / f"TRE_summary_{run_name}.csv"
+        with stage("summarize TREs"):
+            writeColumnsCSV(summarizeColumns(tre_columns, by=by + ("case_id",)), summary_path)
+            run_stats = summarizeColumns(tre_columns, by=by)
+        for i in range(len(run_stats["n"])):
+            fold_note = f" with {pipeParametersTag({name: run_stats[name][i] for name in DEFAULT_PIPE_PARAMETERS})}" if sweep else ""
+            logging.info(f"TRE over {run_stats['n'][i]} folds{fold_note}: mean {run_stats['mean_mm'][i]:.3f} mm "
+                         f"(95% CI {run_stats['ci_low_mm'][i]:.3f}-{run_stats['ci_high_mm'][i]:.3f}), RMS {run_stats['rms_mm'][i]:.3f} mm, "
+                         f"median {run_stats['p50_mm'][i]:.3f} mm, 95th percentile {run_stats['p95_mm'][i]:.3f} mm")
+        if not sweep:
+            logging.info(f"\nSummarized TREs for all cases saved at {summary_path} and {tre_dir / f'TRE_all_{run_name}.csv'}")
+        else:
+            sweep_path = tre_dir / f"TRE_sweep_{run_name}.csv"
+            writeColumnsCSV(run_stats, sweep_path)
+            logging.info(f"\nSummarized TREs per sweep point saved at {sweep_path}, and per case at {summary_path}")
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -208,6 +654,23 @@ if __name__ == "__main__":
     parser.add_argument("--DataBasePath", type=str, default=".", help="Location of the input files")
     parser.add_argument("--TREbasePath", type=str, default="./TRE", help="Where all TRE results will be saved to")
     parser.add_argument("--noDeformableRun", action="store_false", help="If set to false, will skip deformable registration, and assumes result are already present")
+    parser.add_argument("--localCasesPath", type=str, default=None, help="Where packed Pt_XXXX.npz/.h5 case bundles found in DataBasePath are unpacked (default: TREbasePath/cases)")
+    parser.add_argument("--icpRefine", action="store_true", help="Rigid path only: refine the fiducial registration with ICP of the sparse data onto the bel mesh")
+    parser.add_argument("--jobs", type=int, default=1, help="Folds run at once in a process pool (0: one per core); 1 runs the folds one after another")
+    parser.add_argument("--solver", type=str, default="subprocess", choices=sorted(SOLVER_BACKENDS), help="How the MATLAB and pipe.sh steps run: a fresh process per step (subprocess), a warm MATLAB session per job (matlab-engine), or the pure-Python stand-in (fake)")
+    parser.add_argument("--solverTimeout", type=float, default=None, help="Seconds allowed per MATLAB/pipe.sh step (default: no limit)")
+    parser.add_argument("--solverRetries", type=int, default=0, help="Extra attempts of a failed or timed out step, on a restarted solver")
+    parser.add_argument("--workspacePath", type=str, default=None, help="Where the per-fold workspaces are made (default: TREbasePath/workspaces); on the cases' file system, inputs are hardlinked instead of symlinked")
+    parser.add_argument("--resume", type=str, default=None, help="Full name of an earlier run (e.g. Default_20240101_120000) to finish: folds already done with the same inputs are kept")
+    parser.add_argument("--cachePath", type=str, default=None, help="Where fold results are cached by content hash (default: TREbasePath/fold_cache)")
+    parser.add_argument("--noCache", action="store_true", help="Neither reuse nor store cached fold results")
+    parser.add_argument("--nCP", type=int, nargs="+", default=None, help="Sweep: numbers of control points to try (pipe.sh nCP)")
+    parser.add_argument("--seWeight", type=int, nargs="+", default=None, help="Sweep: strain energy weight exponents to try (pipe.sh seWeight, weight 1e-seWeight)")
+    parser.add_argument("--kEpsilon", type=float, nargs="+", default=None, help="Sweep: Kelvinlet epsilons to try (pipe.sh kEpsilon)")
+    parser.add_argument("--trace", type=str, default=None, help="Write a Chrome trace (JSON, for chrome://tracing or ui.perfetto.dev) of the run's stages, with wall and CPU time, to this file")
+    parser.add_argument("--inMemory", action="store_true", help="Rigid path only: register and evaluate every leave-one-out fold in memory, without workspaces, the MATLAB step or per-fold files")
+    parser.add_argument("--writeFolds", action="store_true", help="With --inMemory: also write the PreOperative_<idx> result folders and TRE.csv of every case")
+    parser.add_argument("--subsetSizes", type=int, nargs="+", default=None, help="Rigid path only: evaluate every subset of this many fiducials (e.g. 3 4 5) in memory instead of the leave-one-out run")
     # parser.add_argument("--runRigid",  action="store_true", help="If set, the code will run rigid registration, which requires vtk, numpy and scipy.")
     # parser.add_argument("--startSpecimenID", type=int, default="3", help="The")
     args = parser.parse_args()
@@ -215,12 +678,24 @@ if __name__ == "__main__":
     curT = datetime.now()
     tString = curT.strftime("%Y%m%d_%H%M%S")
 
-    run_name = args.RunName + "_" + tString
+    run_name = args.RunName + "_" + tString if args.resume is None else args.resume
+    if args.trace is not None:
+        enableTracing(args.trace, f"evalAllTRE3FidsOrScaling {run_name}")
     data_base_path = Path(args.DataBasePath)
     tre_dir = Path(args.TREbasePath)
     run_deformable_flag = args.noDeformableRun
     # RUN_RIGID = args.runRigid
     os.makedirs(tre_dir, exist_ok=True)
+    if args.subsetSizes is not None and not RUN_RIGID:
+        parser.error("--subsetSizes needs the rigid path (RUN_RIGID = True)")
+    # Any of --nCP/--seWeight/--kEpsilon: deformable runs over their grid (the others at their defaults)
+    sweep = args.nCP is not None or args.seWeight is not None or args.kEpsilon is not None
+    if sweep and (args.subsetSizes is not None or args.icpRefine or args.inMemory):
+        parser.error("--nCP/--seWeight/--kEpsilon sweep the deformable path; they cannot be combined with --subsetSizes, --icpRefine or --inMemory")
+    if args.inMemory and (not RUN_RIGID or args.subsetSizes is not None):
+        parser.error("--inMemory needs the rigid path (RUN_RIGID = True) and cannot be combined with --subsetSizes")
+    if args.writeFolds and not args.inMemory:
+        parser.error("--writeFolds only applies to --inMemory runs")
 
     #### Enviornment Variables ####
     pipe_directories_dir = data_base_path / "pipe_directories.txt"
@@ -235,206 +710,232 @@ if __name__ == "__main__":
             ENV_DIRS[cur_path_name] = cur_path
     logging.debug(ENV_DIRS)
     #### Iterate through Specimens ####
-    all_cases_tres = []
     data_folders = [(data_base_path / f).absolute() for f in os.listdir(data_base_path) if os.path.isdir(data_base_path/f) and f.startswith("Pt_")]
-    data_folders.sort()
+    local_cases_path = Path(args.localCasesPath) if args.localCasesPath is not None else tre_dir / "cases"
+    data_bundles = [data_base_path / f for f in os.listdir(data_base_path) if f.startswith("Pt_") and f.lower().endswith(BUNDLE_SUFFIXES)]
+    for bundle_path in sorted(data_bundles):
+        with CaseBundle(bundle_path) as bundle:
+            if bundle.case_name in [f.name for f in data_folders]:
+                continue
+            local_case_dir = (local_cases_path / bundle.case_name).absolute()
+            if not os.path.isdir(local_case_dir):
+                logging.info(f"Unpacking {bundle_path.name} to {local_case_dir}")
+                with stage("unpack bundle", case=bundle.case_name):
+                    bundle.unpack(local_case_dir)
+            data_folders.append(local_case_dir)
+    data_folders.sort(key=lambda f: f.name)
     logging.info(f"{len(data_folders)} case(s) found: {[f.name for f in data_folders]}")
-    for idxCase, cur_case_dir in enumerate(data_folders):
+    if args.subsetSizes is not None:
+        for cur_case_dir in data_folders:
+            case_id = extractInteger(cur_case_dir.name)
+            logging.info(f"Currently processing case {case_id}, files from \n{cur_case_dir}")
+            subset_tre_path = tre_dir / f"TRE_subsets_{run_name}.csv"
+            with CaseDirectory(cur_case_dir, case_id) as case:
+                subset_rows = evaluateFiducialSubsets(case, args.subsetSizes)
+            with open(subset_tre_path, "a") as save_f:
+                if save_f.tell() == 0:
+                    save_f.write(SUBSET_TRE_HEADER)
+                save_f.writelines(f"{case_id}, {k}, {idx_subset}, {subset}, {idx_fid}, {tre}\n" for k, idx_subset, subset, idx_fid, tre in subset_rows)
+            logging.info(f"{len(subset_rows)} subset TREs for {cur_case_dir.name} saved at {subset_tre_path}")
+        DEFAULT_CACHE.logStats()
+        saveTrace()
+        sys.exit(0)
+    if args.inMemory:
+        # Every case's points are read once and its folds registered as arrays; only the TRE tables
+        # (and, with --writeFolds, the fold folders) are written
+        tre_results = TREResults(run_name, dict(DEFAULT_PIPE_PARAMETERS, solver="in-memory", rigid=True, icp_refine=args.icpRefine))
+        case_tre_all = []
+        for cur_case_dir in data_folders:
+            case_id = extractInteger(cur_case_dir.name)
+            with stage("in-memory folds", case=cur_case_dir.name), CaseDirectory(cur_case_dir, case_id) as case:
+                folds = evaluateLeaveOneOut(case, args.icpRefine)
+                for idx_eval, (gt_mm, tgt_mm, seconds) in enumerate(zip(folds["gt_mm"], folds["tgt_mm"], folds["seconds"])):
+                    tre_results.add(case_id, idx_eval, gt_mm, tgt_mm, seconds)
+                cur_case_tres = np.linalg.norm(folds["tgt_mm"] - folds["gt_mm"], axis=1)
+                case_tre_all.append(report_case_tres(groupStats(cur_case_tres, np.zeros(len(cur_case_tres), dtype=np.intp), 1),
+                                                     cur_case_dir.name, case_id, run_name))
+                if args.writeFolds:
+                    cur_case_results_dir = cur_case_dir / f"Results_{run_name}"
+                    writeLeaveOneOutResults(case, folds, cur_case_results_dir)
+                    write_case_tre_csv(cur_case_results_dir / "TRE.csv", {name: values[-len(cur_case_tres):] for name, values in tre_results.columns().items()})
+        save_run_tres(tre_dir, run_name, [tre_results.columns()], case_tre_all)
+        DEFAULT_CACHE.logStats()
+        saveTrace()
+        sys.exit(0)
+
+    # 1. Prepare data into form we want for deformable reg for each target, one task per fold
+    # Each fold runs in its own workspace, so the case directories are only read
+    workspaces_dir = (Path(args.workspacePath) if args.workspacePath is not None else tre_dir / "workspaces") / run_name
+    solver_options = {"backend": args.solver, "timeout": args.solverTimeout, "retries": args.solverRetries,
+                      "backend_kwargs": {"matlab_path": data_base_path / ".." / "MATLAB", "pipe_base_dir": ENV_DIRS.get("BASEDIR"),
+                                         "pipe_parameters": dict(DEFAULT_PIPE_PARAMETERS), "log_dir": tre_dir / "logs" / run_name}}
+    # A sweep runs the deformable half of every fold once per point of the nCP/seWeight/kEpsilon grid,
+    # on top of a single prepare_fold (leave-one-out files and rigid step) per fold shared by all points.
+    # nCP only enters through the mode files (calcKModes), which are otherwise precomputed case inputs:
+    # sweeping it computes the modes once per case and nCP value (before, and independently of, the
+    # folds), and prepares each fold once per nCP value in a workspace linking that nCP's modes.
+    sweep_grid = pipeParameterGrid(args.nCP, args.seWeight, args.kEpsilon) if sweep else None
+    regenerate_modes = args.nCP is not None
+    # A fold's outputs depend on its case's files, these settings, the code (Python, pipe.sh, MATLAB)
+    # and the LIBR/SPMESH toolchain pipe_directories.txt points to. With --noCache, only the keys
+    # (the folds' stamps) are computed and nothing is cached.
+    fold_cache_dir = Path(args.cachePath) if args.cachePath is not None else tre_dir / "fold_cache"
+    fold_cache = FoldResultCache(None if args.noCache else fold_cache_dir)
+    fold_parameters = {"solver": args.solver, "pipe_parameters": solver_options["backend_kwargs"]["pipe_parameters"],
+                       "RUN_RIGID": RUN_RIGID and not sweep, "icp_refine": args.icpRefine,
+                       "toolchain": toolchainStamps(pipe_directories_dir, ENV_DIRS)}
+    with stage("code version"):
+        code_version = fold_cache.codeVersion([Path(__file__).resolve().parent, data_base_path / ".." / "MATLAB"])
+    case_results_dirs = {}
+    fold_tasks = []
+    prepare_tasks = []
+    mode_tasks = []
+    for cur_case_dir in data_folders:
         case_id = extractInteger(cur_case_dir.name)
-        logging.info(f"Currently processing case {case_id}, files from \n{cur_case_dir}")
-        copy_back_intraop_fid_transformed = False
-        # 1. Prepare data into form we want for deformable reg for each target
-        # Check existing data...
         cur_surface_dir = cur_case_dir / "IntraOperative"
         cur_mesh_dir = cur_case_dir / "PreOperative"
         cur_case_results_dir = cur_case_dir / f"Results_{run_name}"
         cur_case_results_dir = cur_case_results_dir.resolve()
+        case_results_dirs[cur_case_dir] = cur_case_results_dir
 
         # TODO: Check all needed files...
         os.makedirs(cur_case_results_dir, exist_ok=True)
+        for pipe_parameters in sweep_grid or []:
+            os.makedirs(cur_case_results_dir / pipeParametersTag(pipe_parameters), exist_ok=True)
         assert(os.path.exists(cur_surface_dir) and os.path.exists(cur_mesh_dir))
 
         if run_deformable_flag:
             # 1.1 Prepare Fid and Tgt files
-            preop_fid_dir = cur_mesh_dir / f"{case_id:04d}_fids.vtk" # m
-            preop_fid_og_dir = cur_mesh_dir / f"{case_id:04d}_fids_og.vtk" # m
-            shutil.copy(preop_fid_dir, preop_fid_og_dir)
-
-            preop_fid_mm_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm.vtk" # mm
-            preop_fid_mm_og_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm_og.vtk"
-            shutil.copy(preop_fid_mm_dir, preop_fid_mm_og_dir)
-
-            intraop_fid_dir = cur_surface_dir / f"1{case_id:03d}_fids.vtk" # m?
-            intraop_fid_og_dir = cur_surface_dir / f"1{case_id:03d}_fids_og.vtk" # m
-            shutil.copy(intraop_fid_dir, intraop_fid_og_dir)
-            
-            intraop_fid_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed.vtk" # m?
-            intraop_fid_og_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed_og.vtk" # m
-            if (os.path.exists(intraop_fid_transformed_dir)):
-                copy_back_intraop_fid_transformed = True
-                shutil.copy(intraop_fid_transformed_dir, intraop_fid_og_transformed_dir)
-
-            preop_fid_og = simpleVTKPolyDataPointsParser(preop_fid_og_dir) # m
-            preop_fid_mm_og = simpleVTKPolyDataPointsParser(preop_fid_mm_og_dir) # mm
-            # intraop_fid_transformed_og = simpleVTKPolyDataPointsParser(intraop_fid_og_transformed_dir) # m
-            intraop_fid_og = simpleVTKPolyDataPointsParser(intraop_fid_og_dir) # m
-
-            preop_tgt_mm_dir = cur_mesh_dir / f"{case_id:04d}_tgt_mm.vtk"
-            intraop_tgt_transformed_dir = cur_surface_dir / f"1{case_id:03d}_tgt_transformed.vtk"
-            intraop_tgt_dir = cur_surface_dir / f"1{case_id:03d}_tgt.vtk"
-
-            nFids = len(preop_fid_og)
-            logging.debug(f"{nFids} Found.")
-            assert(len(preop_fid_og) == len(preop_fid_mm_og) and len(preop_fid_og) == len(intraop_fid_og))
+            preop_fid = cachedVTKPolyDataPointsParser(cur_mesh_dir / f"{case_id:04d}_fids.vtk") # m
+            preop_fid_mm = cachedVTKPolyDataPointsParser(cur_mesh_dir / f"{case_id:04d}_fids_mm.vtk") # mm
+            intraop_fid = cachedVTKPolyDataPointsParser(cur_surface_dir / f"1{case_id:03d}_fids.vtk") # m
+            nFids = len(preop_fid)
+            assert(len(preop_fid) == len(preop_fid_mm) and len(preop_fid) == len(intraop_fid))
             assert(nFids > 2)
-            logging.info(f"\n{nFids} fiducials found, now running {nFids}-fold cross validation")
+            logging.info(f"\n{nFids} fiducials found in {cur_case_dir.name}, now running {nFids}-fold cross validation")
+            case_digest = fold_cache.treeDigest(cur_case_dir)
+            mode_workspaces = {}  # nCP -> workspace of the case's modes for it
             for idx_eval in range(nFids):
-                logging.info(f"\n\nPreparing evaluation of fiducial index {idx_eval}/{nFids-1}...")
-                if nFids >= 4:
-                    cur_preop_fids = [preop_fid_og[i] for i in range(nFids) if i != idx_eval]
-                    cur_preop_fids_mm = [preop_fid_mm_og[i] for i in range(nFids) if i != idx_eval]
-                    cur_intraop_fids = [intraop_fid_og[i] for i in range(nFids) if i != idx_eval]
-                else:
-                    logging.warn(f"Only {nFids} fiducials available, **all** are used for registration.")
-                    cur_preop_fids = [preop_fid_og[i] for i in range(nFids)]
-                    cur_preop_fids_mm = [preop_fid_mm_og[i] for i in range(nFids)]
-                    cur_intraop_fids = [intraop_fid_og[i] for i in range(nFids)]
-
-                cur_preop_tgt_mm = [preop_fid_mm_og[idx_eval]]
-                cur_intraop_tgt_gt = [intraop_fid_og[idx_eval]]
-
-                simpleVTKPolyDataPointsWriter(preop_fid_dir, cur_preop_fids)
-                simpleVTKPolyDataPointsWriter(preop_fid_mm_dir, cur_preop_fids_mm)
-                simpleVTKPolyDataPointsWriter(intraop_fid_dir, cur_intraop_fids)
-                simpleVTKPolyDataPointsWriter(preop_tgt_mm_dir, cur_preop_tgt_mm)
-                simpleVTKPolyDataPointsWriter(intraop_tgt_dir, cur_intraop_tgt_gt)
-
-                # 1.1.1 "Re-register"
-                # TODO: Use Matlab Command Here.
-                # tumorProcessingWTarget('D:/Projects/Head_Neck_Marker_Alignment/deformed_model_processing/deformation_models_server/for_fj/TumorResectionGuidance_new_intra_matlab_tests/Pt_0000022', '0022')                
-                matlab_path = data_base_path / ".." / "MATLAB"
-                matlab_meshutil_path = matlab_path / "MeshUtils"
-                matlab_IO_path = matlab_path / "IO"
-
-                logging.info(f"Initial Rigid Registration for fiducial index {idx_eval}/{nFids-1}...")
-                # matlab_cmd = f"matlab -wait -r \"addpath('{matlab_path.resolve()}'); addpath('{matlab_meshutil_path.resolve()}'); addpath('{matlab_IO_path.resolve()}'); try, tumorProcessingWTarget('{cur_case_dir.resolve()}','{case_id:04d}'), catch, exit, end\""
-                # Note: nojvm is useful for stuff such as 
-                matlab_cmd = f"matlab -wait -nodisplay -nojvm -nosplash -nodesktop -r \"addpath('{matlab_path.resolve()}'); addpath('{matlab_meshutil_path.resolve()}'); addpath('{matlab_IO_path.resolve()}'); tumorProcessingWTarget('{cur_case_dir.resolve()}','{case_id:04d}'), exit\""
-                cur_matlab_result = os.system(matlab_cmd)
-                logging.info(cur_matlab_result)
-
-                if not RUN_RIGID:
-                    # # 2. Prepare bash command to run the target
-                    # # bash ${BASEDIR}/pipe.sh ${BASEDIR}/Pt_0000023 45 11 0.01 nonrigidRegisterTumorCavity
-                    logging.info(f"Deforming for evaluation of fiducial index {idx_eval}/{nFids-1}...")
-                    cur_deform_bash_cmd = f"bash {ENV_DIRS['BASEDIR']}/pipe.sh {cur_case_dir} 45 11 0.01 nonrigidRegisterTumorCavity"
-                    logging.info(cur_deform_bash_cmd)
-                    deform_process_result = os.system(cur_deform_bash_cmd)
-                    logging.info(deform_process_result)
-
-                    # # bash ${BASEDIR}/pipe.sh ${BASEDIR}/Pt_0000023 45 11 0.01 deformTargetsTumorCavity
-                    cur_tgt_deform_bash_cmd = f"bash {ENV_DIRS['BASEDIR']}/pipe.sh {cur_case_dir} 45 11 0.01 deformTargetsTumorCavity"
-                    logging.info(cur_tgt_deform_bash_cmd)
-                    deform_tgt_process_result = os.system(cur_tgt_deform_bash_cmd)
-                    logging.info(deform_tgt_process_result)
-                else:
-                    transform_and_save_target_pretend_deformed(cur_case_dir, case_id)
-
-                # Rename/move Target Files
-                cur_deformed_source_base_dir = cur_surface_dir / "PreOperative"
-
-                cur_deformed_results_base_dir = cur_case_results_dir / f"PreOperative_{idx_eval}"
-                cur_deformed_results_base_dir = cur_deformed_results_base_dir.resolve()
-                os.makedirs(cur_deformed_results_base_dir, exist_ok=True)
-                shutil.copytree(cur_deformed_source_base_dir, cur_deformed_results_base_dir, dirs_exist_ok=True)
-
-                cur_preop_fid_dir = cur_mesh_dir / f"{case_id:04d}_fids_{idx_eval}.vtk" # m
-                shutil.copy(preop_fid_dir, cur_preop_fid_dir)
-
-                cur_preop_fid_mm_dir = cur_mesh_dir / f"{case_id:04d}_fids_mm_{idx_eval}.vtk" # m
-                shutil.copy(preop_fid_mm_dir, cur_preop_fid_mm_dir)
-
-                intraop_fid_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed.vtk" # m
-                cur_intraop_fid_transformed_dir = cur_surface_dir / f"1{case_id:03d}_fids_transformed_{idx_eval}.vtk" # m
-                shutil.copy(intraop_fid_transformed_dir, cur_intraop_fid_transformed_dir)
-
-                intraop_sparsedata_transformed_dir = cur_surface_dir / f"1{case_id:03d}_sparsedata_transformed.vtk" # m
-                cur_intraop_sparsedata_transformed_dir = cur_surface_dir / f"1{case_id:03d}_sparsedata_transformed_{idx_eval}.vtk" # m
-                shutil.copy(intraop_sparsedata_transformed_dir, cur_intraop_sparsedata_transformed_dir)
-
-                cur_preop_tgt_mm_dir = cur_mesh_dir / f"{case_id:04d}_tgt_mm_{idx_eval}.vtk"
-                shutil.copy(preop_tgt_mm_dir, cur_preop_tgt_mm_dir)
-
-                cur_intraop_tgt_dir = cur_surface_dir / f"1{case_id:03d}_tgt_transformed_{idx_eval}.vtk"
-                shutil.copy(intraop_tgt_transformed_dir, cur_intraop_tgt_dir)
-
-                # Copy all info related to current eval to the results section
-                cur_intraop_tgt_results_dir = cur_deformed_results_base_dir / f"1{case_id:03d}_tgt_transformed.vtk"
-                shutil.copy(cur_intraop_tgt_dir, cur_intraop_tgt_results_dir) # gt_tgt
-                shutil.copy(cur_preop_tgt_mm_dir, cur_deformed_results_base_dir / cur_preop_tgt_mm_dir.name) # tgt un-deformed
-                shutil.copy(cur_preop_fid_dir, cur_deformed_results_base_dir / cur_preop_fid_dir.name)
-                shutil.copy(cur_preop_fid_mm_dir, cur_deformed_results_base_dir / cur_preop_fid_mm_dir.name)
-                shutil.copy(cur_intraop_fid_transformed_dir, cur_deformed_results_base_dir / cur_intraop_fid_transformed_dir.name)
-                shutil.copy(cur_intraop_sparsedata_transformed_dir, cur_deformed_results_base_dir / cur_intraop_sparsedata_transformed_dir.name)
-                cur_deformed_file_name = f"{case_id:04d}_bel_deformed_initial.vtk"
-                cur_deformed_mesh_dir = cur_surface_dir / cur_deformed_file_name
-                shutil.copy(cur_deformed_mesh_dir, cur_deformed_results_base_dir / cur_deformed_file_name) # deformed mesh
-
-            logging.info(f"Reverting changes to data... for specimen {cur_case_dir.name}")
-            shutil.copy(preop_fid_og_dir, preop_fid_dir)
-            shutil.copy(preop_fid_mm_og_dir, preop_fid_mm_dir)
-            if copy_back_intraop_fid_transformed:
-                shutil.copy(intraop_fid_og_transformed_dir, intraop_fid_transformed_dir)
-            shutil.copy(intraop_fid_og_dir, intraop_fid_dir)
-
-        # 3. Compute Target error
-        # logging.info(f"\nComputing TREs...")
-        # for idxCase, cur_case_dir in enumerate(data_folders):
-        # caseId = extractInteger(cur_case_dir.name)
-        logging.info(f"\nComupting and saving TREs for specimen {cur_case_dir.name}...")
-        # 1. Get deformed target position
-        # 2. Compute difference
-        # 3. Save
-        cur_case_tres = []
-        cur_case_results_dir_list = os.listdir(cur_case_results_dir)
-        cur_case_results_dir_list.sort()
-        all_tgts_dirs = [cur_case_results_dir / cur_dir for cur_dir in cur_case_results_dir_list if os.path.isdir(cur_case_results_dir / cur_dir)]
-        for idx_eval, cur_dir in enumerate(all_tgts_dirs):
-            cur_dir = cur_dir.resolve()
-            cur_intraop_tgt_results_dir = cur_dir / f"1{case_id:03d}_tgt_transformed.vtk"
-            cur_gt_tgt = simpleVTKPolyDataPointsParser(cur_intraop_tgt_results_dir)
-
-            cur_preop_tgt_results_dir = cur_dir / f"{case_id:04d}_tgt_mm_Deformed.vtk"
-            cur_tgt = simpleVTKPolyDataPointsParser(cur_preop_tgt_results_dir)
-
-            cur_gt_tgt_m = cur_gt_tgt[0] # m
-            cur_gt_tgt = [] # mm
-            for elem in cur_gt_tgt_m:
-                cur_gt_tgt.append(elem * 1000)
-            cur_tgt = cur_tgt[0]
-            print(cur_preop_tgt_results_dir)
-            print(cur_tgt)
-            cur_dist = computeDistance(cur_tgt, cur_gt_tgt)
-            logging.info(f"TRE for fids {idx_eval} in {cur_dir}: {cur_dist} mm.")
-            with open(cur_case_results_dir / "TRE.csv", "a") as save_f:
-                save_f.write(f"{cur_gt_tgt[0]}, {cur_gt_tgt[1]}, {cur_gt_tgt[2]}, {cur_tgt[0]}, {cur_tgt[1]}, {cur_tgt[2]}, {cur_dist}\n")
-
-            cur_case_tres.append(cur_dist)
-        
-        cur_case_mean = mean(cur_case_tres)
-        cur_case_std = 0 
-        if len(all_tgts_dirs) >= 2:
-            cur_case_std = std_dev(cur_case_tres)
-        logging.info(f"TRE for {cur_case_dir.name}: mean {cur_case_mean} mm, std {cur_case_std} mm.\n")
-        with open(tre_dir / f"TRE_all_{run_name}.csv", "a") as save_f:
-            save_f.write(f"{cur_case_mean}, {cur_case_std}, {max(cur_case_tres)}, {min(cur_case_tres)}, {run_name}, {case_id}\n")
-
-        all_cases_tres.append(cur_case_tres)
-    logging.info(f"\nSummarized TREs for all cases saved at {tre_dir / 'TRE_all.csv'}")
+                prepared_workspaces = {}  # workspace -> nCP its modes are computed for (None: the case's own)
+                for pipe_parameters in sweep_grid or [None]:
+                    if pipe_parameters is None:
+                        fold_key = fold_cache.foldKey(case_digest, idx_eval, fold_parameters, code_version)
+                        fold_results_dir = cur_case_results_dir
+                        fold_note = ""
+                    else:
+                        # The mode step is part of the key: without it, every nCP point had the same modes
+                        sweep_parameters = dict(fold_parameters, pipe_parameters=pipe_parameters, regenerate_modes=regenerate_modes)
+                        fold_key = fold_cache.foldKey(case_digest, idx_eval, sweep_parameters, code_version)
+                        fold_results_dir = cur_case_results_dir / pipeParametersTag(pipe_parameters)
+                        fold_note = f" with {pipeParametersTag(pipe_parameters)}"
+                    cur_fold_results_dir = fold_results_dir / f"PreOperative_{idx_eval}"
+                    if foldStamp(cur_fold_results_dir) == fold_key:
+                        logging.info(f"Fold {idx_eval} of {cur_case_dir.name}{fold_note} already done, skipped")
+                        continue
+                    if fold_cache.restore(fold_key, cur_fold_results_dir):
+                        logging.info(f"Fold {idx_eval} of {cur_case_dir.name}{fold_note} unchanged, results taken from the cache")
+                        continue
+                    fold_tasks.append({
+                        "case_dir": cur_case_dir, "case_id": case_id, "idx_eval": idx_eval, "results_dir": fold_results_dir,
+                        "icp_refine": args.icpRefine, "key": fold_key, "cache_dir": fold_cache.cache_dir,
+                        "workspace": workspaces_dir / f"{cur_case_dir.name}_{idx_eval}"})
+                    if pipe_parameters is not None:
+                        # Starts from the shared prepared fold, in a workspace (and LIBR.cfg) of its own
+                        mode_nCP = pipe_parameters["nCP"] if regenerate_modes else None
+                        prepared_workspace = workspaces_dir / (f"{cur_case_dir.name}_{idx_eval}" + (f"_nCP{mode_nCP}" if regenerate_modes else ""))
+                        prepared_workspaces[prepared_workspace] = mode_nCP
+                        fold_tasks[-1].update({"case_dir": prepared_workspace / cur_case_dir.name, "pipe_parameters": pipe_parameters,
+                                               "workspace": workspaces_dir / f"{cur_case_dir.name}_{idx_eval}_{pipeParametersTag(pipe_parameters)}"})
+                for prepared_workspace, mode_nCP in prepared_workspaces.items():
+                    prepare_case_dir = cur_case_dir
+                    if mode_nCP is not None:
+                        if mode_nCP not in mode_workspaces:
+                            mode_workspaces[mode_nCP] = workspaces_dir / f"{cur_case_dir.name}_modes_nCP{mode_nCP}"
+                            mode_tasks.append({"case_dir": cur_case_dir, "case_id": case_id, "idx_eval": None,
+                                               "workspace": mode_workspaces[mode_nCP], "nCP": mode_nCP})
+                        prepare_case_dir = mode_workspaces[mode_nCP] / cur_case_dir.name
+                    prepare_tasks.append({"case_dir": prepare_case_dir, "case_id": case_id, "idx_eval": idx_eval, "workspace": prepared_workspace})
+    fold_cache.saveDigests()
+
+    jobs = min(args.jobs if args.jobs > 0 else os.cpu_count() or 1, max(len(fold_tasks), 1))
+    folds_done = []
+
+    def logProgress(task, result):
+        folds_done.append(result)
+        fold_note = "" if task.get("pipe_parameters") is None else f" with {pipeParametersTag(task['pipe_parameters'])}"
+        logging.info(f"Fold {result[1]} of {result[0]}{fold_note} {'done' if result[2] is None else 'FAILED'} ({len(folds_done)}/{len(fold_tasks)})")
+
+    failed_folds = {}
+    failed_prepares = {}  # workspace -> error of its preparation, or of the one it starts from
+    for prepare_kind, cur_tasks, task_function in (("mode", mode_tasks, mode_workspace_task), ("fold", prepare_tasks, prepare_fold_task)):
+        for task in cur_tasks:
+            if Path(task["case_dir"]).parent in failed_prepares:
+                failed_prepares[task["workspace"]] = failed_prepares[Path(task["case_dir"]).parent]
+        cur_tasks = [task for task in cur_tasks if task["workspace"] not in failed_prepares]
+        if not cur_tasks:
+            continue
+        cur_jobs = min(jobs, len(cur_tasks))
+        logging.info(f"Preparing {len(cur_tasks)} {prepare_kind} workspace(s) for {len(sweep_grid)} sweep point(s) with {cur_jobs} job(s)")
+        with stage(f"prepare {prepare_kind}s", n_tasks=len(cur_tasks), jobs=cur_jobs):
+            prepare_results = run_fold_tasks(cur_tasks, solver_options, cur_jobs, task_function=task_function)
+        for task, (_, _, error, _) in zip(cur_tasks, prepare_results):
+            if error is not None:
+                failed_prepares[task["workspace"]] = error
+    for fold_task in fold_tasks:
+        if fold_task["case_dir"].parent in failed_prepares:
+            failed_folds[(fold_task["results_dir"], fold_task["idx_eval"])] = failed_prepares[fold_task["case_dir"].parent]
+    fold_tasks = [task for task in fold_tasks if task["case_dir"].parent not in failed_prepares]
+
+    logging.info(f"Running {len(fold_tasks)} fold(s) with {jobs} job(s)")
+    with stage("run folds", n_tasks=len(fold_tasks), jobs=jobs):
+        fold_results = run_fold_tasks(fold_tasks, solver_options, jobs, on_done=logProgress)
+    failed_folds.update({(task["results_dir"], idx_eval): error for task, (_, idx_eval, error, _) in zip(fold_tasks, fold_results) if error is not None})
+    fold_seconds = {(task["results_dir"], idx_eval): seconds for task, (_, idx_eval, error, seconds) in zip(fold_tasks, fold_results) if error is None}
+    # Workspaces of failed folds (and failed preparations) are kept for inspection
+    for task in prepare_tasks + mode_tasks:
+        if task["workspace"] not in failed_prepares:
+            shutil.rmtree(task["workspace"], ignore_errors=True)
+    for empty_dir in (workspaces_dir, workspaces_dir.parent):
+        if os.path.isdir(empty_dir) and not os.listdir(empty_dir):
+            os.rmdir(empty_dir)
+    for (fold_results_dir, idx_eval), error in sorted(failed_folds.items()):
+        logging.error(f"Fold {idx_eval} of {fold_results_dir} failed, left out of the TREs:\n{error}")
+
+    # 3. Compute Target error, case by case in a fixed order whatever order the folds finished in
+    # Collected in memory and written once; the TRE files are rebuilt from every fold folder,
+    # so a resumed run does not append twice. A sweep gives one table of all its points.
+    tre_parts = []
+    case_tre_all = []
+    for pipe_parameters in sweep_grid or [None]:
+        tre_results = TREResults(run_name, dict(pipe_parameters or fold_parameters["pipe_parameters"], solver=args.solver,
+                                                rigid=fold_parameters["RUN_RIGID"], icp_refine=args.icpRefine))
+        fold_note = "" if pipe_parameters is None else f" with {pipeParametersTag(pipe_parameters)}"
+        for cur_case_dir in data_folders:
+            case_id = extractInteger(cur_case_dir.name)
+            cur_case_results_dir = case_results_dirs[cur_case_dir]
+            if pipe_parameters is not None:
+                cur_case_results_dir = cur_case_results_dir / pipeParametersTag(pipe_parameters)
+            logging.info(f"\nComupting and saving TREs for specimen {cur_case_dir.name}{fold_note}...")
+            cur_case_stats = collect_case_tres(tre_results, cur_case_results_dir, case_id,
+                                               [idx_eval for results_dir, idx_eval in failed_folds if results_dir == cur_case_results_dir],
+                                               {idx_eval: seconds for (results_dir, idx_eval), seconds in fold_seconds.items() if results_dir == cur_case_results_dir})
+            if cur_case_stats is None:
+                logging.warning(f"No TRE for {cur_case_dir.name}{fold_note}: all of its folds failed")
+                continue
+            case_tre_all.append(report_case_tres(cur_case_stats, cur_case_dir.name, case_id, run_name, fold_note))
+        tre_parts.append(tre_results.columns())
+
+    save_run_tres(tre_dir, run_name, tre_parts, case_tre_all, sweep_grid is not None)
+    DEFAULT_CACHE.logStats()
+    if fold_cache.cache_dir is not None:
+        fold_cache.logStats()
+    if tracePath() is not None:
+        mergeWorkerTraces(saveTrace())
+        logging.info(f"Trace of the run saved at {tracePath()}")
 
 
     # curPath = Path(r"D:\Projects\Head_Neck_Marker_Alignment\deformed_model_processing\deformation_models_server\TRE\Pt_0000022\0022_fids.vtk")
     # curPath = Path(r"D:\Projects\Head_Neck_Marker_Alignment\deformed_model_processing\deformation_models_server\TRE\Pt_000003_oldIntra\Pt_000003_2\0003_tgt_mm.vtk")
     # curPath = Path(r"D:\Projects\Head_Neck_Marker_Alignment\deformed_model_processing\deformation_models_server\TRE\Pt_0000022\1022_fids_transformed.vtk")
-    # curPts = simpleVTKPolyDataPointsParser(curPath)
+    # curPts = cachedVTKPolyDataPointsParser(curPath)
     # simpleVTKPolyDataPointsWriter(curPath.parent / "temp.vtk", curPts)
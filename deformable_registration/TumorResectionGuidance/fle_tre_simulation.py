@@ -0,0 +1,184 @@
+from pathlib import Path
+import os
+import argparse
+import logging
+
+import numpy as np
+
+from case_bundle import BUNDLE_SUFFIXES, openCase
+from point_set_registration import registerPointSets, transformPoints
+
+# Trials solved per batched call; bounds the (batch, K, 3) temporaries.
+DEFAULT_BATCH_TRIALS = 10_000
+SUMMARY_HEADER = "case_id, target, n_fids, n_trials, mean_mm, rms_mm, median_mm, p95_mm, p99_mm, max_mm\n"
+# Summary row of the per-vertex RMS TRE field: its columns are stats over the bel vertices of
+# each vertex's RMS TRE (e.g. mean_mm is the mean vertex RMS), not of the per-trial errors
+RMS_FIELD_TARGET = "bel_vertex_rms_tre"
+
+
+def noiseCovariance(fle):
+    """
+    3x3 covariance of the fiducial localization error.
+
+    Args:
+        fle (float | array-like): isotropic std (scalar), per-axis stds (3,) or a full (3, 3)
+            covariance, in the units of the points
+    """
+    fle = np.asarray(fle, dtype=np.float64)
+    if fle.ndim == 0:
+        return np.eye(3) * fle ** 2
+    if fle.shape == (3,):
+        return np.diag(fle ** 2)
+    if fle.shape == (3, 3):
+        return fle
+    raise ValueError(f"FLE must be a scalar, (3,) stds or a (3, 3) covariance, got shape {fle.shape}")
+
+
+def simulateRegistrationErrors(preop_fids, intraop_fids, fle_preop, fle_intraop=None, n_trials=50_000, scaling=False,
+                               seed=0, batch_trials=DEFAULT_BATCH_TRIALS):
+    """
+    Monte Carlo of the registration error caused by fiducial localization error (FLE).
+
+    The noise-free intraop fiducials are the preop ones mapped by the least-squares
+    registration of the two sets. Each trial perturbs both sets with Gaussian noise of
+    the given covariances and re-registers them; the trial's error transform is the
+    difference between its registration and the noise-free one.
+
+    Args:
+        preop_fids (array-like): (K, 3) preop fiducials
+        intraop_fids (array-like): (K, 3) intraop fiducials, only used for the noise-free pose
+        fle_preop, fle_intraop: see noiseCovariance; fle_intraop defaults to fle_preop
+        n_trials (int): number of trials
+        scaling (bool): simulate the similarity registration instead of the rigid one
+        seed (int): seed of the noise
+        batch_trials (int): trials per batched registration call
+
+    Returns:
+        np.ndarray: (n_trials, 3, 4) error transforms D; a preop point p is off by D @ [p, 1]
+    """
+    preop_fids = np.asarray(preop_fids, dtype=np.float64)
+    T_true, _ = registerPointSets(preop_fids, intraop_fids, scaling=scaling)
+    true_intraop_fids = transformPoints(T_true, preop_fids)
+    chol_preop = np.linalg.cholesky(noiseCovariance(fle_preop))
+    chol_intraop = np.linalg.cholesky(noiseCovariance(fle_preop if fle_intraop is None else fle_intraop))
+
+    rng = np.random.default_rng(seed)
+    errors = np.empty((n_trials, 3, 4))
+    for start in range(0, n_trials, batch_trials):
+        n = min(batch_trials, n_trials - start)
+        noisy_preop = preop_fids + rng.standard_normal((n,) + preop_fids.shape) @ chol_preop.T
+        noisy_intraop = true_intraop_fids + rng.standard_normal((n,) + preop_fids.shape) @ chol_intraop.T
+        T, _ = registerPointSets(noisy_preop, noisy_intraop, scaling=scaling)
+        errors[start:start + n] = (T - T_true)[:, :3, :]
+    return errors
+
+
+def targetErrors(errors, points):
+    """(n_trials, N) TRE of every trial at every point, in the units of the points."""
+    points_h = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+    return np.linalg.norm(errors @ points_h.T, axis=1)
+
+
+def rmsErrorField(errors, points):
+    """
+    RMS TRE over all trials at each point, without materializing the (n_trials, N) errors.
+
+    E|D [p, 1]|^2 = [p, 1]^T E[D^T D] [p, 1], so one 4x4 second-moment matrix gives the
+    field at any number of points (e.g. every bel vertex).
+    """
+    moment = np.einsum("tij,tik->jk", errors, errors) / len(errors)
+    points_h = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+    return np.sqrt(np.maximum(np.einsum("nj,jk,nk->n", points_h, moment, points_h), 0.0))
+
+
+def summarizeTRE(tre_mm):
+    """(mean, rms, median, p95, p99, max) of a 1D TRE sample."""
+    p50, p95, p99 = np.percentile(tre_mm, [50, 95, 99])
+    return tre_mm.mean(), np.sqrt(np.mean(tre_mm ** 2)), p50, p95, p99, tre_mm.max()
+
+
+def writeErrorField(mesh, field, file_name, array_name="TRE_RMS_mm"):
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk
+
+    out = mesh.NewInstance()
+    out.ShallowCopy(mesh)
+    array = numpy_to_vtk(np.ascontiguousarray(field), deep=True)
+    array.SetName(array_name)
+    out.GetPointData().AddArray(array)
+    out.GetPointData().SetActiveScalars(array_name)
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(str(file_name))
+    writer.SetInputData(out)
+    writer.Write()
+
+
+def simulateCase(case, fle_preop, fle_intraop=None, n_trials=50_000, scaling=False, seed=0):
+    """
+    FLE -> TRE simulation of one case (CaseDirectory or CaseBundle).
+
+    Returns:
+        rows (list of tuples): summary rows (target, n_fids, n_trials, mean, rms, median,
+            p95, p99, max), in mm; one per tgt_mm target, over the trials, plus one
+            RMS_FIELD_TARGET row of stats over the bel vertices of the RMS field
+        field (np.ndarray | None): (V,) RMS TRE in mm at every bel vertex, if the case has one
+    """
+    preop_fids = case.points("preop_fids", "m")
+    intraop_fids = case.points("intraop_fids", "m") if "intraop_fids" in case else preop_fids
+    errors = simulateRegistrationErrors(preop_fids, intraop_fids, fle_preop, fle_intraop, n_trials, scaling, seed)
+
+    rows = []
+    if "preop_tgt_mm" in case:
+        tre_mm = 1000 * targetErrors(errors, case.points("preop_tgt_mm", "m"))
+        for idx_tgt in range(tre_mm.shape[1]):
+            rows.append((str(idx_tgt), len(preop_fids), n_trials) + summarizeTRE(tre_mm[:, idx_tgt]))
+
+    field = None
+    if "bel" in case:
+        field = 1000 * rmsErrorField(errors, case.points("bel", "m"))
+        rows.append((RMS_FIELD_TARGET, len(preop_fids), n_trials) + summarizeTRE(field))
+    return rows, field
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Predict TRE from fiducial localization error (FLE) with a Monte Carlo simulation")
+    parser.add_argument("--DataBasePath", type=str, default=".", help="Folder of Pt_XXXX case directories or bundles")
+    parser.add_argument("--outPath", type=str, default="./FLE_TRE", help="Where the summary table and per-vertex fields are saved")
+    parser.add_argument("--fle", type=float, nargs="+", default=[0.5], help="Preop FLE std in mm: one value (isotropic) or three (x y z)")
+    parser.add_argument("--intraopFle", type=float, nargs="+", default=None, help="Intraop FLE std in mm (default: same as --fle)")
+    parser.add_argument("--nTrials", type=int, default=50_000)
+    parser.add_argument("--scaling", action="store_true", help="Simulate the similarity registration of the rigid evaluation path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    def fleFromArgs(values):
+        if values is None:
+            return None
+        if len(values) not in (1, 3):
+            parser.error("FLE takes one or three values")
+        return np.asarray(values if len(values) == 3 else values[0]) * 1e-3  # mm -> m
+
+    data_base_path = Path(args.DataBasePath)
+    out_path = Path(args.outPath)
+    os.makedirs(out_path, exist_ok=True)
+    summary_path = out_path / "FLE_TRE_summary.csv"
+    cases = sorted(data_base_path / f for f in os.listdir(data_base_path)
+                   if f.startswith("Pt_") and (os.path.isdir(data_base_path / f) or f.lower().endswith(BUNDLE_SUFFIXES)))
+    with open(summary_path, "w") as save_f:
+        save_f.write(SUMMARY_HEADER)
+        for case_path in cases:
+            with openCase(case_path) as case:
+                logging.info(f"Simulating {args.nTrials} registrations for case {case.case_id}...")
+                rows, field = simulateCase(case, fleFromArgs(args.fle), fleFromArgs(args.intraopFle), args.nTrials, args.scaling, args.seed)
+                for row in rows:
+                    save_f.write(f"{case.case_id}, " + ", ".join(str(v) for v in row) + "\n")
+                    if row[0] == RMS_FIELD_TARGET:
+                        logging.info(f"RMS TRE over the bel vertices: mean {row[3]:.3f} mm, median {row[5]:.3f} mm, max {row[8]:.3f} mm")
+                    else:
+                        logging.info(f"Target {row[0]}: mean {row[3]:.3f} mm, RMS {row[4]:.3f} mm, 95th percentile {row[6]:.3f} mm")
+                if field is not None:
+                    field_path = out_path / f"{case.case_id:04d}_bel_TRE_RMS.vtk"
+                    writeErrorField(case.polydata("bel"), field, field_path)
+                    logging.info(f"Per-vertex RMS TRE saved at {field_path}")
+    logging.info(f"Summary saved at {summary_path}")
@@ -0,0 +1,194 @@
+from pathlib import Path
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+from fold_workspace import SKIPPED_PATTERNS, matchesPatterns, promoteDirectory
+from stage_trace import traced
+
+FOLD_CACHE_VERSION = 1
+# Written into every promoted PreOperative_<idx> folder; a resumed run keeps the folds
+# whose stamp matches their current key.
+FOLD_KEY_FILE_NAME = ".fold_key"
+CODE_SUFFIXES = (".py", ".sh", ".m")
+# pipe_directories.txt entries holding the LIBR/SPMESH executables and the libraries they load
+TOOLCHAIN_DIR_KEYS = ("NONRIGID_APPS_DIR", "SPMESH_LIB_DIR", "SPMESH_INCLUDE_DIR")
+
+
+def fileDigest(file_name, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FoldResultCache:
+    """
+    Results of evaluation folds stored under a content hash of everything they depend on.
+
+    The key of a fold (foldKey) covers the content of every file of its case (what
+    its workspace is built from), the held-out fiducial, the solver parameters and
+    the code version, so any change to one of them produces a new key rather than a
+    stale hit. Entries are complete PreOperative_<idx> folders, added and restored
+    with atomic renames.
+
+    File digests are remembered per (mtime, size) in digests.json, so unchanged
+    files, including large meshes, are hashed only once. Without a cache_dir the
+    instance only computes keys (e.g. for the folds' stamps): digests are kept in
+    memory and nothing is written, stored or restored.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self._index_path = None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._index_path = self.cache_dir / "digests.json"
+        self._digests = None  # loaded on first use; workers that only store entries never need it
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, file_name):
+        if self._digests is None:
+            try:
+                self._digests = {} if self._index_path is None else json.loads(self._index_path.read_text())
+            except (OSError, ValueError):
+                self._digests = {}
+        st = os.stat(file_name)
+        key = os.path.abspath(file_name)
+        entry = self._digests.get(key)
+        if entry is not None and entry[:2] == [st.st_mtime_ns, st.st_size]:
+            return entry[2]
+        digest = fileDigest(file_name)
+        self._digests[key] = [st.st_mtime_ns, st.st_size, digest]
+        self._dirty = True
+        return digest
+
+    def saveDigests(self):
+        if not self._dirty or self._index_path is None:
+            return
+        tmp_path = self._index_path.with_name(f"{self._index_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self._digests, indent=1))
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    @traced("fold cache tree digest")
+    def treeDigest(self, root, suffixes=None, skipped_patterns=SKIPPED_PATTERNS):
+        """Digest of the relative names and contents of the files under root (optionally only some suffixes)."""
+        root = Path(root)
+        h = hashlib.blake2b(digest_size=16)
+        if not os.path.isdir(root):
+            return h.hexdigest()
+        for cur_dir, dir_names, file_names in os.walk(root):
+            rel_dir = Path(cur_dir).relative_to(root)
+            dir_names[:] = sorted(d for d in dir_names if not matchesPatterns(rel_dir / d, skipped_patterns))
+            for file_name in sorted(file_names):
+                rel_path = rel_dir / file_name
+                if matchesPatterns(rel_path, skipped_patterns) or (suffixes is not None and not file_name.endswith(suffixes)):
+                    continue
+                h.update(f"{rel_path.as_posix()}\0{self.digest(Path(cur_dir) / file_name)}\n".encode())
+        return h.hexdigest()
+
+    def codeVersion(self, code_dirs):
+        """Digest of the sources (.py, .sh, .m) under code_dirs, e.g. this folder and the MATLAB folder."""
+        h = hashlib.blake2b(digest_size=16)
+        for code_dir in code_dirs:
+            h.update(self.treeDigest(code_dir, CODE_SUFFIXES).encode())
+        return h.hexdigest()
+
+    def foldKey(self, case_digest, idx_eval, parameters, code_version):
+        """
+        Args:
+            case_digest (str): treeDigest of the canonical case directory
+            idx_eval (int): held-out fiducial
+            parameters (dict): JSON-serializable settings the fold's outputs depend on
+                (solver backend and nCP/seWeight/kEpsilon, RUN_RIGID, ICP refinement...)
+            code_version (str): see codeVersion
+        """
+        description = json.dumps({"version": FOLD_CACHE_VERSION, "case": case_digest, "idx_eval": idx_eval,
+                                  "parameters": parameters, "code": code_version}, sort_keys=True, default=str)
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def _entry(self, key):
+        return self.cache_dir / key[:2] / key
+
+    @traced("fold cache restore")
+    def restore(self, key, dst_dir):
+        """Copy the cached fold `key` to dst_dir (atomically); returns False on a miss."""
+        if self.cache_dir is None:
+            return False
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return False
+        staging = Path(dst_dir).parent / f".{Path(dst_dir).name}.{os.getpid()}.cache"
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        shutil.copytree(entry, staging)
+        promoteDirectory(staging, dst_dir)
+        self.hits += 1
+        return True
+
+    @traced("fold cache store")
+    def store(self, key, src_dir):
+        """Add a finished fold folder to the cache (copied, the source stays in place)."""
+        if self.cache_dir is None:
+            return
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        staging = entry.parent / f".{key}.{os.getpid()}.tmp"
+        os.makedirs(entry.parent, exist_ok=True)
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        shutil.copytree(src_dir, staging)
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            # Another process stored the same fold in the meantime
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def logStats(self):
+        logging.info(f"Fold cache {self.cache_dir}: {self.hits} hits, {self.misses} misses")
+
+
+def stampFold(results_dir, key):
+    with open(Path(results_dir) / FOLD_KEY_FILE_NAME, "w") as key_f:
+        key_f.write(key)
+
+
+def foldStamp(results_dir):
+    """Key a promoted fold folder was computed with, or None if absent or incomplete."""
+    try:
+        return (Path(results_dir) / FOLD_KEY_FILE_NAME).read_text().strip()
+    except OSError:
+        return None
+
+
+def toolchainStamps(pipe_directories_path, env_dirs):
+    """
+    What pipe.sh runs with, outside the code folders codeVersion covers: the content of
+    pipe_directories.txt and the (mtime, size) stamps of the files in the directories it
+    points to for the LIBR/SPMESH binaries (TOOLCHAIN_DIR_KEYS), so a rebuilt binary or a
+    moved toolchain changes the fold keys.
+
+    Args:
+        pipe_directories_path (Path): the pipe_directories.txt of the run
+        env_dirs (dict): its parsed NAME -> path entries
+    """
+    stamps = {"pipe_directories": fileDigest(pipe_directories_path), "binaries": {}}
+    for tool_dir in sorted({env_dirs[k] for k in TOOLCHAIN_DIR_KEYS if env_dirs.get(k)}):
+        try:
+            file_names = sorted(f for f in os.listdir(tool_dir) if os.path.isfile(os.path.join(tool_dir, f)))
+        except OSError:
+            stamps["binaries"][tool_dir] = None # not on this machine, e.g. with the fake solver
+            continue
+        stamps["binaries"][tool_dir] = {}
+        for file_name in file_names:
+            st = os.stat(os.path.join(tool_dir, file_name))
+            stamps["binaries"][tool_dir][file_name] = [st.st_mtime_ns, st.st_size]
+    return stamps
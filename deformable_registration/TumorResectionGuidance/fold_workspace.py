@@ -0,0 +1,156 @@
+from pathlib import Path
+import os
+import time
+import fnmatch
+import shutil
+import logging
+
+from data_cache import SIDECAR_PATTERNS
+from stage_trace import traced
+
+# Inputs that no fold step writes, relative to the case directory. Only these are
+# linked into a workspace; every other file is copied. A hardlink or symlink shares
+# its data with the canonical case, and the fold's writers (vtk_points_io, MATLAB,
+# pipe.sh/LIBR) truncate and rewrite files in place, so never list a file here that
+# tumorProcessingWTarget, nonrigidRegisterTumorCavity or deformTargetsTumorCavity
+# may (re)write.
+LINKED_PATTERNS = (
+    "PreOperative/*_mesh.vtk",
+    "PreOperative/*_bel.vtk",
+    "PreOperative/*_alphashape.vtk",
+    "PreOperative/*.out",
+    "PreOperative/LIBR/*",
+    "IntraOperative/*_sparsedata.vtk",
+    "*.prop",
+)
+# Inputs of a workspace in which pipe.sh's calcKModes regenerates the mode files (an nCP
+# sweep): the PreOperative tables and LIBR files it rewrites are copied instead.
+MODE_LINKED_PATTERNS = tuple(p for p in LINKED_PATTERNS if p not in ("PreOperative/*.out", "PreOperative/LIBR/*"))
+# Never part of a workspace: results of earlier runs, and binary sidecars of text files,
+# which are rebuilt from the workspace's own files when needed (and change no digest).
+SKIPPED_PATTERNS = ("Results_*",) + SIDECAR_PATTERNS
+
+
+def matchesPatterns(rel_path, patterns):
+    # fnmatch on the posix relative path; '*' also matches across folders
+    name = rel_path.as_posix()
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def linkFile(src, dst):
+    """
+    Hardlink dst to src, or symlink it when hardlinks are not possible (other file
+    system, no permission), or copy it as a last resort.
+
+    Returns:
+        str: "hardlink", "symlink" or "copy"
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink"
+    except (OSError, NotImplementedError):
+        shutil.copy2(src, dst)
+        return "copy"
+
+
+def promoteDirectory(src, dst):
+    """
+    Move a finished directory to dst in one step, so that dst is either absent or complete.
+
+    The directory is first moved (or, across file systems, copied) to a hidden
+    temporary name next to dst, then renamed over it. A crash leaves at most a
+    .<name>.<pid>.tmp folder behind, never a half-written dst.
+    """
+    src, dst = Path(src), Path(dst)
+    os.makedirs(dst.parent, exist_ok=True)
+    tmp = dst.parent / f".{dst.name}.{os.getpid()}.tmp"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    try:
+        os.rename(src, tmp)
+    except OSError:
+        shutil.copytree(src, tmp, symlinks=False)
+        shutil.rmtree(src)
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    os.replace(tmp, dst)
+    return dst
+
+
+class FoldWorkspace:
+    """
+    Private, disposable copy of a case directory for one evaluation fold.
+
+    The workspace mirrors the case's folder tree; read-only inputs (LINKED_PATTERNS)
+    are hardlinked or symlinked and everything else is copied, so setting it up costs
+    a few small copies and the canonical case is never modified. The fold writes its
+    outputs to `results_dir` and promotes them with `promote` once they are complete.
+
+    Used as a context manager, the workspace is created on entry and removed on a
+    clean exit; it is kept for inspection when the fold raised.
+
+    Attributes:
+        case_dir (Path): the fold's case directory; keeps the case's folder name, since
+            pipe.sh takes the case id from its last 4 characters
+        results_dir (Path): staging folder for the fold's results
+        stats (dict): number of files per "hardlink", "symlink" and "copy", and the
+            "seconds" the set-up took
+    """
+
+    def __init__(self, source_case_dir, workspace_dir, linked_patterns=LINKED_PATTERNS, skipped_patterns=SKIPPED_PATTERNS):
+        self.source_case_dir = Path(source_case_dir).resolve()
+        self.workspace_dir = Path(workspace_dir).absolute()
+        self.case_dir = self.workspace_dir / self.source_case_dir.name
+        self.results_dir = self.workspace_dir / "results"
+        self.linked_patterns = tuple(linked_patterns)
+        self.skipped_patterns = tuple(skipped_patterns)
+        self.stats = {"hardlink": 0, "symlink": 0, "copy": 0, "seconds": 0.0}
+
+    @traced("workspace create")
+    def create(self):
+        start = time.perf_counter()
+        if os.path.isdir(self.workspace_dir):
+            shutil.rmtree(self.workspace_dir)
+        os.makedirs(self.results_dir)
+        for cur_dir, dir_names, file_names in os.walk(self.source_case_dir):
+            rel_dir = Path(cur_dir).relative_to(self.source_case_dir)
+            dir_names[:] = [d for d in dir_names if not matchesPatterns(rel_dir / d, self.skipped_patterns)]
+            os.makedirs(self.case_dir / rel_dir, exist_ok=True)
+            for file_name in file_names:
+                rel_path = rel_dir / file_name
+                src, dst = Path(cur_dir) / file_name, self.case_dir / rel_path
+                if matchesPatterns(rel_path, self.skipped_patterns):
+                    continue
+                if matchesPatterns(rel_path, self.linked_patterns):
+                    self.stats[linkFile(src, dst)] += 1
+                else:
+                    shutil.copy2(src, dst)
+                    self.stats["copy"] += 1
+        self.stats["seconds"] = time.perf_counter() - start
+        logging.debug(f"Workspace {self.workspace_dir} ready in {1000 * self.stats['seconds']:.1f} ms: {self.stats}")
+        return self
+
+    @traced("workspace promote")
+    def promote(self, name, dst_dir):
+        """Atomically move results_dir/name to dst_dir/name (replacing it)."""
+        return promoteDirectory(self.results_dir / name, Path(dst_dir) / name)
+
+    @traced("workspace remove")
+    def remove(self):
+        if os.path.isdir(self.workspace_dir):
+            shutil.rmtree(self.workspace_dir)
+
+    def __enter__(self):
+        return self.create()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.remove()
+        else:
+            logging.warning(f"Keeping the workspace of the failed fold for inspection: {self.workspace_dir}")
+        return False
@@ -0,0 +1,136 @@
+import numpy as np
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+from point_set_registration import transformPoints
+
+
+def similarityMatrix(R=None, t=None, scale=1.0):
+    """4x4 matrix of x -> scale * R @ x + t."""
+    T = np.eye(4)
+    if R is not None:
+        T[:3, :3] = R
+    T[:3, :3] *= scale
+    if t is not None:
+        T[:3, 3] = t
+    return T
+
+
+def scaleMatrix(scale_factor):
+    """4x4 matrix of an isotropic (scalar) or per-axis (3,) scaling, e.g. 0.001 for mm -> m."""
+    T = np.eye(4)
+    T[:3, :3] = np.diag(np.broadcast_to(np.asarray(scale_factor, dtype=np.float64), 3))
+    return T
+
+
+def _normalMatrix(T):
+    # Normals follow the inverse transpose of the linear part; they are renormalized afterwards.
+    return np.linalg.inv(T[:3, :3]).T
+
+
+def _vectorArrays(attributes, names):
+    # Active vectors plus any explicitly named 3-component arrays, each once.
+    arrays = []
+    if attributes.GetVectors() is not None:
+        arrays.append(attributes.GetVectors())
+    for name in names:
+        array = attributes.GetArray(name)
+        if array is not None and array.GetNumberOfComponents() == 3 and all(array is not a for a in arrays):
+            arrays.append(array)
+    return arrays
+
+
+def _applyLinear(array, A, normalize=False):
+    view = vtk_to_numpy(array)
+    values = view @ A.T
+    if normalize:
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        np.divide(values, norms, out=values, where=norms > 0)
+    view[:] = values
+    array.Modified()
+
+
+def transformMeshInPlace(mesh, T, vector_arrays=()):
+    """
+    Apply a 4x4 affine (rigid, similarity or scaling) transform to a VTK point set in place.
+
+    Works on the vtk_to_numpy view of the point coordinates, so no per-point Python
+    calls and no copy of the mesh. Point and cell normals are transformed with the
+    inverse transpose and renormalized; the active vectors (e.g. displacements) and
+    any 3-component arrays named in `vector_arrays` are transformed without the
+    translation.
+
+    Args:
+        mesh (vtk.vtkPointSet): vtkPolyData or vtkUnstructuredGrid
+        T (array-like): (4, 4) transform
+        vector_arrays (iterable of str): extra point/cell data arrays to treat as vectors
+
+    Returns:
+        mesh, for chaining
+    """
+    T = np.asarray(T, dtype=np.float64)
+    points = mesh.GetPoints()
+    if points is None or points.GetNumberOfPoints() == 0:
+        return mesh
+    view = vtk_to_numpy(points.GetData())
+    view[:] = transformPoints(T, view)
+    points.Modified()
+
+    A = T[:3, :3]
+    for attributes in (mesh.GetPointData(), mesh.GetCellData()):
+        if attributes.GetNormals() is not None:
+            _applyLinear(attributes.GetNormals(), _normalMatrix(T), normalize=True)
+        for array in _vectorArrays(attributes, vector_arrays):
+            _applyLinear(array, A)
+    mesh.Modified()
+    return mesh
+
+
+def scaleMeshInPlace(mesh, scale_factor):
+    """Scale a VTK point set in place about the origin, e.g. scale_factor=0.001 for mm -> m."""
+    return transformMeshInPlace(mesh, scaleMatrix(scale_factor))
+
+
+def transformedMeshes(mesh, transforms, vector_arrays=()):
+    """
+    Apply a batch of transforms to one mesh, producing one output mesh per transform.
+
+    All point sets are computed with a single broadcast matrix product. Each output
+    is a shallow copy of `mesh` (topology and untouched arrays are shared) with its
+    own points, normals and vectors, and `mesh` itself is left unchanged.
+
+    Args:
+        mesh (vtk.vtkPointSet): vtkPolyData or vtkUnstructuredGrid
+        transforms (array-like): (B, 4, 4) transforms
+        vector_arrays (iterable of str): extra point/cell data arrays to treat as vectors
+
+    Returns:
+        list of B meshes of the same type as `mesh`
+    """
+    transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+    points = vtk_to_numpy(mesh.GetPoints().GetData())
+    all_points = transformPoints(transforms, points)  # (B, N, 3)
+
+    outputs = []
+    for T, cur_points in zip(transforms, all_points):
+        out = mesh.NewInstance()
+        out.ShallowCopy(mesh)
+        vtk_points = out.GetPoints().NewInstance()
+        vtk_points.SetData(numpy_to_vtk(cur_points.astype(points.dtype), deep=True))
+        out.SetPoints(vtk_points)
+        for attributes in (out.GetPointData(), out.GetCellData()):
+            active_vectors = attributes.GetVectors()
+            arrays = [(attributes.GetNormals(), _normalMatrix(T), True)] if attributes.GetNormals() is not None else []
+            arrays += [(array, T[:3, :3], False) for array in _vectorArrays(attributes, vector_arrays)]
+            for array, A, is_normals in arrays:
+                # Shared with the input through the shallow copy: replace rather than modify
+                copy = array.NewInstance()
+                copy.DeepCopy(array)
+                _applyLinear(copy, A, normalize=is_normals)
+                if is_normals:
+                    attributes.SetNormals(copy)
+                elif array is active_vectors:
+                    attributes.SetVectors(copy)
+                else:
+                    attributes.AddArray(copy)
+        outputs.append(out)
+    return outputs
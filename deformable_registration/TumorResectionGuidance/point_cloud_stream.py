@@ -0,0 +1,282 @@
+import os
+import re
+import mmap
+import shutil
+
+import numpy as np
+
+from data_cache import DEFAULT_CACHE
+from vtk_points_io import VTK_BINARY_DTYPES, _FILE_TYPE_RE, _POINTS_RE, _SECTION_RE
+
+DEFAULT_CHUNK_POINTS = 1 << 20
+
+_COLORS_RE = re.compile(rb"COLOR_SCALARS[ \t]+\S+[ \t]+(\d+)[ \t]*\r?\n", re.IGNORECASE)
+_SCALARS_RE = re.compile(rb"SCALARS[ \t]+\S+[ \t]+unsigned_char[ \t]+(\d+)[^\n]*\n(LOOKUP_TABLE[^\n]*\n)?", re.IGNORECASE)
+
+
+class _ASCIIValueReader:
+    """Sequential reader of whitespace-separated numbers from an offset of a text file."""
+
+    def __init__(self, file_name, start, stop):
+        self.f = open(file_name, "rb")
+        self.f.seek(start)
+        self.remaining = stop - start
+        self.pending = np.empty(0)
+        self.carry = b""
+        self.bytes_per_value = 16.0
+
+    def read(self, count):
+        parts = [self.pending]
+        have = len(self.pending)
+        while have < count:
+            block = self.f.read(min(self.remaining, max(1 << 16, int((count - have) * self.bytes_per_value * 1.1))))
+            self.remaining -= len(block)
+            text = self.carry + block
+            if not block:
+                self.carry = b""
+            else:
+                # a number may straddle the block boundary; keep the tail for the next read
+                cut = max(text.rfind(b" "), text.rfind(b"\n"))
+                text, self.carry = (text[:cut], text[cut:]) if cut >= 0 else (b"", text)
+            values = np.fromstring(text, dtype=np.float64, sep=" ") if text.strip() else np.empty(0)
+            if len(values):
+                self.bytes_per_value = max(1.0, len(text) / len(values))
+            parts.append(values)
+            have += len(values)
+            if not block:
+                break
+        values = np.concatenate(parts)
+        if len(values) < count:
+            raise ValueError(f"Unexpected end of data: wanted {count} values, got {len(values)}")
+        self.pending = values[count:]
+        return values[:count]
+
+    def close(self):
+        self.f.close()
+
+
+class _BinaryValueReader:
+    def __init__(self, file_name, start, dtype):
+        self.f = open(file_name, "rb")
+        self.f.seek(start)
+        self.dtype = dtype
+
+    def read(self, count):
+        values = np.fromfile(self.f, dtype=self.dtype, count=count)
+        if len(values) < count:
+            raise ValueError(f"Unexpected end of data: wanted {count} values, got {len(values)}")
+        return values
+
+    def close(self):
+        self.f.close()
+
+
+class VTKPointCloudStream:
+    """
+    Iterate over a legacy VTK point cloud (e.g. frame*_PC.vtk from save_data) in fixed-size chunks.
+
+    Only the headers are located up front (through a read-only memory map); point and
+    color values are then read sequentially, so memory use depends on `chunk_size`
+    and not on the size of the cloud.
+
+    Yields:
+        (points, colors): (k, 3) float64 points and (k, 3) uint8 colors, or None when
+        the file has no RGB point data
+    """
+
+    def __init__(self, file_name, chunk_size=DEFAULT_CHUNK_POINTS):
+        self.file_name = str(file_name)
+        self.chunk_size = chunk_size
+        with open(self.file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            file_type = _FILE_TYPE_RE.search(buf)
+            points_header = _POINTS_RE.search(buf)
+            if file_type is None or points_header is None:
+                raise ValueError(f"{self.file_name} is not a legacy VTK file with a POINTS section")
+            self.binary = file_type.group(1).upper() == b"BINARY"
+            self.n_points = int(points_header.group(1))
+            self.points_dtype = points_header.group(2).lower()
+            self.points_offset = points_header.end()
+
+            self.points_stop = self._sectionEnd(buf, self.points_offset)
+            point_data = buf.find(b"POINT_DATA", self.points_stop)
+            self.colors_offset = None
+            self.colors_as_float = False
+            if point_data >= 0:
+                colors = _COLORS_RE.search(buf, point_data)
+                scalars = _SCALARS_RE.search(buf, point_data)
+                if colors is not None and int(colors.group(1)) == 3:
+                    self.colors_offset = colors.end()
+                    self.colors_as_float = not self.binary  # ASCII COLOR_SCALARS are written in [0, 1]
+                elif scalars is not None and int(scalars.group(1)) == 3:
+                    self.colors_offset = scalars.end()
+            if self.colors_offset is not None:
+                self.colors_stop = self._sectionEnd(buf, self.colors_offset, 1)
+
+    def _sectionEnd(self, buf, offset, itemsize=None):
+        # Binary blocks have a known length; ASCII blocks end at the next keyword line.
+        if self.binary:
+            itemsize = itemsize or VTK_BINARY_DTYPES[self.points_dtype].itemsize
+            return offset + 3 * self.n_points * itemsize
+        section = _SECTION_RE.search(buf, offset)
+        return section.start() if section is not None else len(buf)
+
+    @property
+    def has_colors(self):
+        return self.colors_offset is not None
+
+    def _reader(self, offset, stop, dtype):
+        if self.binary:
+            return _BinaryValueReader(self.file_name, offset, dtype)
+        return _ASCIIValueReader(self.file_name, offset, stop)
+
+    def __iter__(self):
+        points_reader = self._reader(self.points_offset, self.points_stop, VTK_BINARY_DTYPES.get(self.points_dtype))
+        colors_reader = self._reader(self.colors_offset, self.colors_stop, np.uint8) if self.has_colors else None
+        try:
+            for start in range(0, self.n_points, self.chunk_size):
+                k = min(self.chunk_size, self.n_points - start)
+                points = points_reader.read(3 * k).astype(np.float64).reshape(k, 3)
+                colors = None
+                if colors_reader is not None:
+                    colors = colors_reader.read(3 * k)
+                    if self.colors_as_float:
+                        colors = np.rint(colors * 255)
+                    colors = colors.astype(np.uint8).reshape(k, 3)
+                yield points, colors
+        finally:
+            points_reader.close()
+            if colors_reader is not None:
+                colors_reader.close()
+
+
+class StreamingVTKPointCloudWriter:
+    """
+    Write a point cloud chunk by chunk as legacy VTK, without knowing the final count up front.
+
+    Points (and optional colors) are spooled to temporary files next to the output; on
+    close() the header is written with the final count and the pieces are concatenated.
+    The output is moved into place atomically. Same layout as save_data's PC files:
+    float points plus a "Colors" RGB array, no vertex cells.
+    """
+
+    def __init__(self, file_name, with_colors=False, file_format="binary"):
+        if file_format not in ("ascii", "binary"):
+            raise ValueError(f"file_format must be 'ascii' or 'binary', got '{file_format}'")
+        self.file_name = str(file_name)
+        self.with_colors = with_colors
+        self.binary = file_format == "binary"
+        self.n_points = 0
+        self._points_tmp = open(self.file_name + ".points.tmp", "wb")
+        self._colors_tmp = open(self.file_name + ".colors.tmp", "wb") if with_colors else None
+
+    def write(self, points, colors=None):
+        if len(points) == 0:
+            return
+        if self.binary:
+            self._points_tmp.write(np.asarray(points, dtype=">f4").tobytes())
+        else:
+            self._points_tmp.write((("%.9g %.9g %.9g\n" * len(points)) % tuple(np.ravel(points).tolist())).encode("ascii"))
+        if self.with_colors:
+            colors = np.asarray(colors, dtype=np.uint8)
+            if self.binary:
+                self._colors_tmp.write(colors.tobytes())
+            else:
+                self._colors_tmp.write((("%.6g %.6g %.6g\n" * len(colors)) % tuple((colors.ravel() / 255.0).tolist())).encode("ascii"))
+        self.n_points += len(points)
+
+    def close(self):
+        self._points_tmp.close()
+        if self._colors_tmp is not None:
+            self._colors_tmp.close()
+        out_tmp = self.file_name + ".tmp"
+        with open(out_tmp, "wb") as out:
+            file_type = "BINARY" if self.binary else "ASCII"
+            out.write(f"# vtk DataFile Version 3.0\nvtk output\n{file_type}\nDATASET POLYDATA\nPOINTS {self.n_points} float\n".encode("ascii"))
+            with open(self._points_tmp.name, "rb") as f:
+                shutil.copyfileobj(f, out)
+            if self.with_colors:
+                out.write(f"\nPOINT_DATA {self.n_points}\nCOLOR_SCALARS Colors 3\n".encode("ascii"))
+                with open(self._colors_tmp.name, "rb") as f:
+                    shutil.copyfileobj(f, out)
+            out.write(b"\n")
+        os.remove(self._points_tmp.name)
+        if self._colors_tmp is not None:
+            os.remove(self._colors_tmp.name)
+        DEFAULT_CACHE.invalidate(self.file_name)
+        os.replace(out_tmp, self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for tmp in (self._points_tmp, self._colors_tmp):
+                if tmp is not None:
+                    tmp.close()
+                    os.remove(tmp.name)
+
+
+# Chunk operations: op(points, colors) -> (points, colors). They may drop points but
+# must apply the same selection to colors (which can be None).
+
+def rigidTransformOp(T):
+    T = np.asarray(T, dtype=np.float64)
+    def op(points, colors):
+        return points @ T[:3, :3].T + T[:3, 3], colors
+    return op
+
+
+def scaleOp(scale_factor):
+    def op(points, colors):
+        return points * scale_factor, colors
+    return op
+
+
+def _select(points, colors, mask):
+    return points[mask], (colors[mask] if colors is not None else None)
+
+
+def cropOp(lower, upper):
+    lower, upper = np.asarray(lower, dtype=np.float64), np.asarray(upper, dtype=np.float64)
+    def op(points, colors):
+        return _select(points, colors, np.all((points >= lower) & (points <= upper), axis=1))
+    return op
+
+
+def finiteOp():
+    def op(points, colors):
+        return _select(points, colors, np.isfinite(points).all(axis=1))
+    return op
+
+
+def filterOp(predicate):
+    """Keep the points where predicate(points, colors) is True."""
+    def op(points, colors):
+        return _select(points, colors, np.asarray(predicate(points, colors), dtype=bool))
+    return op
+
+
+def streamTransformPointCloud(in_file, out_file, ops=(), chunk_size=DEFAULT_CHUNK_POINTS, file_format="binary"):
+    """
+    Apply `ops` to a legacy VTK point cloud chunk by chunk and write the result.
+
+    Args:
+        in_file (str | Path): input cloud (ASCII or BINARY legacy VTK)
+        out_file (str | Path): output cloud; may be the same path as in_file
+        ops (sequence of callables): chunk operations applied in order, e.g.
+            [scaleOp(0.001), rigidTransformOp(T), cropOp(lo, hi)]
+        chunk_size (int): points per chunk; peak memory is proportional to it
+        file_format (str): "binary" or "ascii" legacy VTK output
+
+    Returns:
+        int: number of points written
+    """
+    stream = VTKPointCloudStream(in_file, chunk_size)
+    with StreamingVTKPointCloudWriter(out_file, with_colors=stream.has_colors, file_format=file_format) as writer:
+        for points, colors in stream:
+            for op in ops:
+                points, colors = op(points, colors)
+            writer.write(points, colors)
+    return writer.n_points
@@ -0,0 +1,159 @@
+import itertools
+
+import numpy as np
+
+ROBUST_MIN_THRESHOLD = 0.003 # m, fiducials closer than this to the fit are never flagged
+ROBUST_MIN_POINTS = 6 # below this, robustRegisterPointSets returns the plain fit
+
+
+def transformPoints(T, points):
+    """
+    Apply one or a stack of 4x4 transforms to matching stacks of points.
+
+    Args:
+        T (np.ndarray): (..., 4, 4) homogeneous transforms
+        points (np.ndarray): (..., K, 3) points; leading dimensions broadcast against T's
+
+    Returns:
+        np.ndarray: (..., K, 3) transformed points
+    """
+    T = np.asarray(T, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    return points @ np.swapaxes(T[..., :3, :3], -1, -2) + T[..., None, :3, 3]
+
+
+def registerPointSets(source, target, weights=None, scaling=False):
+    """
+    Least-squares rigid (or similarity) registration of source onto target, for one or many point sets at once.
+
+    Umeyama's closed form, solved for the whole stack with one batched SVD: the
+    returned T minimizes sum_k w_k |T(source_k) - target_k|^2, with det(R) = +1
+    enforced (reflections are corrected) and an isotropic scale when `scaling`.
+
+    Args:
+        source (array-like): (K, 3) or (B, K, 3) points
+        target (array-like): same shape as source, corresponding points
+        weights (array-like, optional): (K,) or (B, K) non-negative per-point weights;
+            zero weights drop points, which lets subsets of different sizes share a stack
+        scaling (bool): also estimate an isotropic scale factor
+
+    Returns:
+        T (np.ndarray): (4, 4) or (B, 4, 4) transforms mapping source to target
+        residuals (np.ndarray): (K,) or (B, K) distances |T(source_k) - target_k|
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if source.shape != target.shape or source.shape[-1] != 3:
+        raise ValueError(f"source and target must both be (..., K, 3), got {source.shape} and {target.shape}")
+    single = source.ndim == 2
+    if single:
+        source, target = source[None], target[None]
+
+    if weights is None:
+        w = np.full(source.shape[:2], 1.0 / source.shape[1])
+    else:
+        w = np.broadcast_to(np.asarray(weights, dtype=np.float64), source.shape[:2])
+        w = w / w.sum(axis=1, keepdims=True)
+
+    mu_source = np.einsum("bk,bki->bi", w, source)
+    mu_target = np.einsum("bk,bki->bi", w, target)
+    source_centered = source - mu_source[:, None]
+    target_centered = target - mu_target[:, None]
+
+    H = np.einsum("bk,bki,bkj->bij", w, source_centered, target_centered)
+    U, S, Vt = np.linalg.svd(H)
+    # Flip the axis of the smallest singular value when U V^T would be a reflection
+    d = np.ones_like(S)
+    d[:, -1] = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    d[d[:, -1] == 0, -1] = 1.0
+    R = np.swapaxes(Vt, 1, 2) @ (d[:, :, None] * np.swapaxes(U, 1, 2))
+
+    if scaling:
+        var_source = np.einsum("bk,bki,bki->b", w, source_centered, source_centered)
+        scale = np.sum(d * S, axis=1) / var_source
+    else:
+        scale = np.ones(len(source))
+
+    T = np.tile(np.eye(4), (len(source), 1, 1))
+    T[:, :3, :3] = scale[:, None, None] * R
+    T[:, :3, 3] = mu_target - np.einsum("bij,bj->bi", T[:, :3, :3], mu_source)
+
+    residuals = np.linalg.norm(transformPoints(T, source) - target, axis=-1)
+    if single:
+        return T[0], residuals[0]
+    return T, residuals
+
+
+def subsetIndices(nPoints, subsetSize):
+    """(C, subsetSize) array of all subsetSize-combinations of range(nPoints), in lexicographic order."""
+    return np.array(list(itertools.combinations(range(nPoints), subsetSize)), dtype=np.intp).reshape(-1, subsetSize)
+
+
+def leaveOneOutIndices(nPoints):
+    """(nPoints, nPoints - 1) array; row i holds every index except i."""
+    return subsetIndices(nPoints, nPoints - 1)[::-1]
+
+
+def robustRegisterPointSets(source, target, scaling=False, min_threshold=ROBUST_MIN_THRESHOLD, max_hypotheses=2000, seed=0):
+    """
+    Outlier-resistant version of registerPointSets for small fiducial sets (RANSAC / LQS).
+
+    Every minimal 3-point sample (or `max_hypotheses` random ones when there are more)
+    is solved in one batched call and scored on all points at once by its h-th smallest
+    residual, h = floor((K + 3) / 2) + 1, so that a sample cannot score on its own
+    points; the least score wins. Points within max(min_threshold, 2.5 * that score) of
+    the hypothesis are inliers, the transform is refitted on them until the inlier set
+    is stable, and a flagged point is kept if the fit including it brings it back within
+    the threshold. With fewer than ROBUST_MIN_POINTS points one outlier cannot be told
+    apart from noise, and the plain least-squares fit is returned.
+
+    Args:
+        source (array-like): (K, 3) points
+        target (array-like): (K, 3) corresponding points
+        scaling (bool): also estimate an isotropic scale factor
+        min_threshold (float): smallest inlier distance, in the units of the points
+            (default ROBUST_MIN_THRESHOLD, for points in m); keeps normal localization
+            noise from being flagged on near-perfect fits
+        max_hypotheses (int): cap on the number of minimal samples scored
+        seed (int): seed of the random sampling, used only above max_hypotheses samples
+
+    Returns:
+        T (np.ndarray): (4, 4) transform refitted on the inliers
+        outliers (np.ndarray): sorted indices of the points flagged as outliers
+        residuals (np.ndarray): (K,) distances |T(source_k) - target_k| for all points
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    nPoints = len(source)
+    inliers = np.ones(nPoints, dtype=bool)
+    if nPoints >= ROBUST_MIN_POINTS:
+        samples = subsetIndices(nPoints, 3)
+        if len(samples) > max_hypotheses:
+            samples = samples[np.random.default_rng(seed).choice(len(samples), max_hypotheses, replace=False)]
+        T_samples, _ = registerPointSets(source[samples], target[samples], scaling=scaling)
+        sq_residuals = np.sum((transformPoints(T_samples, source) - target) ** 2, axis=-1)  # (H, K)
+        # h-th smallest residual, h = floor((K + 3) / 2) + 1: the sample's own 3 near-zero
+        # residuals never reach it, so at least h - 3 >= 2 other points score every hypothesis
+        h = (nPoints + 3) // 2 + 1
+        score_sq = np.partition(sq_residuals, h - 1, axis=1)[:, h - 1]
+        best = np.argmin(score_sq)
+        threshold = max(min_threshold, 2.5 * np.sqrt(score_sq[best]))
+        inliers = np.sqrt(sq_residuals[best]) <= threshold
+        for _ in range(nPoints):
+            T, _ = registerPointSets(source[inliers], target[inliers], scaling=scaling)
+            refined = np.linalg.norm(transformPoints(T, source) - target, axis=-1) <= threshold
+            if refined.sum() < 3 or np.array_equal(refined, inliers):
+                break
+            inliers = refined
+        # A flagged point on a thin configuration can be far from the fit that leaves it
+        # out only because it alone pins a direction; keep it if the fit with it agrees
+        for k in np.flatnonzero(~inliers):
+            with_k = inliers.copy()
+            with_k[k] = True
+            T, _ = registerPointSets(source[with_k], target[with_k], scaling=scaling)
+            if np.linalg.norm(transformPoints(T, source[k]) - target[k]) <= threshold:
+                inliers[k] = True
+
+    T, _ = registerPointSets(source[inliers], target[inliers], scaling=scaling)
+    residuals = np.linalg.norm(transformPoints(T, source) - target, axis=-1)
+    return T, np.flatnonzero(~inliers), residuals
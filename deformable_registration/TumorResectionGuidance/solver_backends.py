@@ -0,0 +1,419 @@
+from pathlib import Path
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from command_runner import CommandError, CommandTimeout, runCommand
+from displacement_interpolation import deformTargets
+from point_cloud_stream import rigidTransformOp, streamTransformPointCloud
+from point_set_registration import registerPointSets, transformPoints
+from stage_trace import stage
+from vtk_points_io import cachedVTKPolyDataPointsParser, simpleVTKPolyDataPointsWriter
+
+try:
+    import matlab.engine
+except ImportError:
+    matlab = None
+
+# External steps of an evaluation, in the order they run. calcKModes (pipe.sh) regenerates
+# the mode files and only runs when a sweep changes nCP, once per case and nCP; then each
+# fold runs the MATLAB initial registration (tumorProcessingWTarget) and the two pipe.sh
+# (LIBR) functions.
+SOLVER_STEPS = ("calcKModes", "tumorProcessingWTarget", "nonrigidRegisterTumorCavity", "deformTargetsTumorCavity")
+# pipe.sh parameters used by the evaluation: number of control points, strain energy
+# weight exponent and Kelvinlet epsilon
+DEFAULT_PIPE_PARAMETERS = {"nCP": 45, "seWeight": 11, "kEpsilon": 0.01}
+
+
+def pipeParameterGrid(nCP=None, seWeight=None, kEpsilon=None):
+    """
+    Every combination of the given pipe.sh parameter values, as a list of
+    {"nCP", "seWeight", "kEpsilon"} dicts; a parameter left None keeps its default.
+    """
+    values = {"nCP": nCP, "seWeight": seWeight, "kEpsilon": kEpsilon}
+    grid = [{}]
+    for name, default in DEFAULT_PIPE_PARAMETERS.items():
+        grid = [dict(p, **{name: v}) for p in grid for v in dict.fromkeys(values[name] or [default])]
+    return grid
+
+
+def pipeParametersTag(pipe_parameters):
+    """Folder-name friendly label of a parameter set, e.g. nCP45_seWeight11_kEpsilon0.01."""
+    return "_".join(f"{name}{pipe_parameters[name]:g}" for name in DEFAULT_PIPE_PARAMETERS)
+
+
+class SolverError(CommandError):
+    pass
+
+
+class SolverTimeout(SolverError, CommandTimeout):
+    pass
+
+
+def _runCommand(cmd, name, timeout=None, log_dir=None):
+    # Streams the output (see command_runner.runCommandAsync) and, on timeout, kills
+    # what the shell started too (MATLAB, LIBR)
+    try:
+        return runCommand(cmd, name=name, timeout=timeout, log_dir=log_dir)["returncode"]
+    except CommandTimeout as e:
+        raise SolverTimeout(str(e), e.result) from None
+    except CommandError as e:
+        raise SolverError(str(e), e.result) from None
+
+
+class SolverBackend:
+    """
+    Runs the external steps of a fold (SOLVER_STEPS) on a case directory.
+
+    Subclasses implement one method per step, named after it, with the signature
+    step(case_dir, case_id, timeout), reading the pipe.sh parameters from
+    self.pipe_parameters. Expensive set-up (e.g. starting MATLAB) goes in `start`, which
+    SolverPool calls once per worker, so it is paid once and not per fold.
+    """
+
+    name = None
+
+    def __init__(self, pipe_parameters=None):
+        self.pipe_parameters = dict(DEFAULT_PIPE_PARAMETERS, **(pipe_parameters or {}))
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def run(self, step, case_dir, case_id, timeout=None, pipe_parameters=None):
+        """
+        Run a step; pipe_parameters (e.g. {"nCP": 30}) override the backend's for this
+        call only, so one warm backend serves every point of a parameter sweep.
+        """
+        if step not in SOLVER_STEPS:
+            raise ValueError(f"step must be one of {SOLVER_STEPS}, got '{step}'")
+        if not pipe_parameters:
+            return getattr(self, step)(Path(case_dir), case_id, timeout)
+        backend_parameters = self.pipe_parameters
+        self.pipe_parameters = dict(backend_parameters, **pipe_parameters)
+        try:
+            return getattr(self, step)(Path(case_dir), case_id, timeout)
+        finally:
+            self.pipe_parameters = backend_parameters
+
+
+class SubprocessBackend(SolverBackend):
+    """
+    One fresh process per step: `matlab -wait ...` and `bash pipe.sh ...`, as the
+    evaluation script always ran them. With log_dir, the output of every step goes to
+    <log_dir>/<case folder>_<step>.jsonl (see command_runner).
+    """
+
+    name = "subprocess"
+
+    def __init__(self, matlab_path, pipe_base_dir=None, pipe_parameters=None, log_dir=None):
+        super().__init__(pipe_parameters)
+        self.matlab_path = Path(matlab_path)
+        self.pipe_base_dir = pipe_base_dir
+        self.log_dir = log_dir
+
+    def jobName(self, case_dir, step):
+        return f"{case_dir.resolve().parent.name}_{step}"
+
+    def matlabPaths(self):
+        return [self.matlab_path.resolve(), (self.matlab_path / "MeshUtils").resolve(), (self.matlab_path / "IO").resolve()]
+
+    def tumorProcessingWTarget(self, case_dir, case_id, timeout=None):
+        add_paths = " ".join(f"addpath('{p}');" for p in self.matlabPaths())
+        # Note: nojvm is useful for stuff such as
+        matlab_cmd = f"matlab -wait -nodisplay -nojvm -nosplash -nodesktop -r \"{add_paths} tumorProcessingWTarget('{case_dir.resolve()}','{case_id:04d}'), exit\""
+        return _runCommand(matlab_cmd, self.jobName(case_dir, "tumorProcessingWTarget"), timeout, self.log_dir)
+
+    def _pipe(self, case_dir, function_name, timeout):
+        p = self.pipe_parameters
+        cmd = f"bash {self.pipe_base_dir}/pipe.sh {case_dir} {p['nCP']} {p['seWeight']} {p['kEpsilon']} {function_name}"
+        logging.info(cmd)
+        return _runCommand(cmd, self.jobName(case_dir, function_name), timeout, self.log_dir)
+
+    def calcKModes(self, case_dir, case_id, timeout=None):
+        return self._pipe(case_dir, "calcKModes", timeout)
+
+    def nonrigidRegisterTumorCavity(self, case_dir, case_id, timeout=None):
+        return self._pipe(case_dir, "nonrigidRegisterTumorCavity", timeout)
+
+    def deformTargetsTumorCavity(self, case_dir, case_id, timeout=None):
+        return self._pipe(case_dir, "deformTargetsTumorCavity", timeout)
+
+
+class MatlabEngineBackend(SubprocessBackend):
+    """
+    Keeps one MATLAB session alive (MATLAB Engine API for Python) for the MATLAB step;
+    the pipe.sh steps run as in SubprocessBackend. A timed out call is cancelled and
+    the session restarted.
+    """
+
+    name = "matlab-engine"
+
+    def __init__(self, matlab_path, pipe_base_dir=None, pipe_parameters=None, log_dir=None):
+        if matlab is None:
+            raise ImportError("The matlab-engine backend needs the MATLAB Engine API for Python (matlabengine)")
+        super().__init__(matlab_path, pipe_base_dir, pipe_parameters, log_dir)
+        self.engine = None
+
+    def start(self):
+        if self.engine is None:
+            with stage("matlab start", category="solver"):
+                self.engine = matlab.engine.start_matlab("-nodisplay -nojvm -nosplash -nodesktop")
+                for p in self.matlabPaths():
+                    self.engine.addpath(str(p), nargout=0)
+
+    def close(self):
+        if self.engine is not None:
+            try:
+                self.engine.quit()
+            except Exception:
+                logging.exception("Could not quit MATLAB cleanly")
+            self.engine = None
+
+    def tumorProcessingWTarget(self, case_dir, case_id, timeout=None):
+        self.start()
+        call = self.engine.tumorProcessingWTarget(str(case_dir.resolve()), f"{case_id:04d}", nargout=0, background=True)
+        try:
+            call.result(timeout=timeout)
+        except matlab.engine.TimeoutError:
+            call.cancel()
+            self.close()
+            raise SolverTimeout(f"tumorProcessingWTarget timed out after {timeout} s on {case_dir}")
+        return 0
+
+
+class FakeBackend(SolverBackend):
+    """
+    Pure-Python stand-in for MATLAB and LIBR that reads and writes the same files.
+
+    - calcKModes writes nCP mesh nodes as <id>_KControlPoints.out.
+    - tumorProcessingWTarget rigidly registers the intraop fiducials onto the preop
+      ones and writes the *_transformed fiducials, target and (if present) sparse
+      data, plus the bel in m as <id>_bel_deformed_initial.vtk.
+    - nonrigidRegisterTumorCavity writes LIBR.cfg, NonrigidRunInfo.txt and a
+      displacement of the mesh nodes: the similarity transform from the preop
+      fiducials to the transformed intraop ones, standing in for the Kelvinlet fit.
+    - deformTargetsTumorCavity applies that displacement field to the preop fids and
+      targets (mm) and writes the *_Deformed files, interpolating it on the
+      tetrahedral <id>_mesh.vtk as LIBR does (displacement_interpolation) when the
+      case has one.
+
+    The registrations are not the real models, but every file the evaluation and
+    the TRE computation read is produced where the real tools put it, so runs,
+    scheduling and caching can be exercised and timed without MATLAB or LIBR.
+    startup_delay and step_delay (s) emulate solver start-up and run times; with
+    cold=True the start-up is paid on every step, as with SubprocessBackend.
+    """
+
+    name = "fake"
+
+    # Extra kwargs (matlab_path, pipe_base_dir) are ignored, so every backend takes the same options
+    def __init__(self, pipe_parameters=None, startup_delay=0.0, step_delay=0.0, cold=False, **kwargs):
+        super().__init__(pipe_parameters)
+        self.startup_delay = startup_delay
+        self.step_delay = step_delay
+        self.cold = cold
+        self.started = False
+        self.n_starts = 0
+
+    def start(self):
+        if not self.started:
+            with stage("fake solver start", category="solver"):
+                time.sleep(self.startup_delay)
+            self.started = True
+            self.n_starts += 1
+
+    def close(self):
+        self.started = False
+
+    def _work(self):
+        if self.cold:
+            self.close()
+        self.start()
+        time.sleep(self.step_delay)
+
+    @staticmethod
+    def _meshNodes(case_dir, case_id):
+        mesh_dir = case_dir / "PreOperative" / f"{case_id:04d}_mesh.vtk" # m
+        if os.path.exists(mesh_dir):
+            return np.asarray(cachedVTKPolyDataPointsParser(mesh_dir), dtype=np.float64)
+        bel_dir = case_dir / "PreOperative" / f"{case_id:04d}_bel.vtk" # mm
+        return np.asarray(cachedVTKPolyDataPointsParser(bel_dir), dtype=np.float64) * 0.001
+
+    def calcKModes(self, case_dir, case_id, timeout=None):
+        self._work()
+        nodes = self._meshNodes(case_dir, case_id)
+        control_points = nodes[np.linspace(0, len(nodes) - 1, min(self.pipe_parameters["nCP"], len(nodes))).astype(int)]
+        np.savetxt(case_dir / "PreOperative" / f"{case_id:04d}_KControlPoints.out", control_points, fmt="%.9e")
+        return 0
+
+    def tumorProcessingWTarget(self, case_dir, case_id, timeout=None):
+        self._work()
+        surface_dir = case_dir / "IntraOperative"
+        mesh_dir = case_dir / "PreOperative"
+        intraop_fids = cachedVTKPolyDataPointsParser(surface_dir / f"1{case_id:03d}_fids.vtk") # m
+        preop_fids = cachedVTKPolyDataPointsParser(mesh_dir / f"{case_id:04d}_fids.vtk") # m
+        T, _ = registerPointSets(intraop_fids, preop_fids)
+        simpleVTKPolyDataPointsWriter(surface_dir / f"1{case_id:03d}_fids_transformed.vtk", transformPoints(T, intraop_fids))
+        intraop_tgt_dir = surface_dir / f"1{case_id:03d}_tgt.vtk"
+        if os.path.exists(intraop_tgt_dir):
+            intraop_tgt = cachedVTKPolyDataPointsParser(intraop_tgt_dir)
+            simpleVTKPolyDataPointsWriter(surface_dir / f"1{case_id:03d}_tgt_transformed.vtk", transformPoints(T, intraop_tgt))
+        sparse_data_dir = surface_dir / f"1{case_id:03d}_sparsedata.vtk"
+        if os.path.exists(sparse_data_dir):
+            sparse_data_transformed_dir = surface_dir / f"1{case_id:03d}_sparsedata_transformed.vtk"
+            streamTransformPointCloud(sparse_data_dir, sparse_data_transformed_dir, [rigidTransformOp(T)])
+            streamTransformPointCloud(sparse_data_transformed_dir, mesh_dir / sparse_data_transformed_dir.name)
+        bel_dir = mesh_dir / f"{case_id:04d}_bel.vtk"
+        if os.path.exists(bel_dir):
+            import vtk
+            from mesh_transform import scaleMeshInPlace
+            reader = vtk.vtkPolyDataReader()
+            reader.SetFileName(str(bel_dir))
+            reader.Update()
+            writer = vtk.vtkPolyDataWriter()
+            writer.SetFileName(str(surface_dir / f"{case_id:04d}_bel_deformed_initial.vtk"))
+            writer.SetInputData(scaleMeshInPlace(reader.GetOutput(), 0.001))
+            writer.Write()
+        return 0
+
+    def nonrigidRegisterTumorCavity(self, case_dir, case_id, timeout=None):
+        self._work()
+        surface_dir = case_dir / "IntraOperative"
+        p = self.pipe_parameters
+        with open(surface_dir / "LIBR.cfg", "w") as cfg_f:
+            cfg_f.write(f"OUTPUT_DIR: {case_dir}/IntraOperative/\nCASE_PREFIX: {case_id:04d}\n"
+                        f"K_MODE_FILES: {case_dir}/PreOperative/{case_id:04d}_KControlPoints.out 2100 0.45 {p['kEpsilon']} 1e-{p['seWeight']} 0.1\n"
+                        f"# fake backend, nCP {p['nCP']}\n")
+        preop_fids = cachedVTKPolyDataPointsParser(case_dir / "PreOperative" / f"{case_id:04d}_fids.vtk") # m
+        intraop_fids = cachedVTKPolyDataPointsParser(surface_dir / f"1{case_id:03d}_fids_transformed.vtk") # m
+        T, residuals = registerPointSets(preop_fids, intraop_fids, scaling=True)
+        nodes = self._meshNodes(case_dir, case_id)
+        np.savetxt(surface_dir / f"{case_id:04d}_displacement.out", transformPoints(T, nodes) - nodes, fmt="%.9e")
+        with open(case_dir / "NonrigidRunInfo.txt", "w") as info_f:
+            info_f.write(f"Fake nonrigid registration: {len(nodes)} nodes, fiducial RMS {np.sqrt(np.mean(residuals ** 2)) * 1000:.4f} mm\n")
+        return 0
+
+    def deformTargetsTumorCavity(self, case_dir, case_id, timeout=None):
+        self._work()
+        if os.path.exists(case_dir / "PreOperative" / f"{case_id:04d}_mesh.vtk"):
+            deformTargets(case_dir, case_id)
+            return 0
+        nodes = self._meshNodes(case_dir, case_id)
+        displacement = np.loadtxt(case_dir / "IntraOperative" / f"{case_id:04d}_displacement.out", ndmin=2)
+        # The fake displacement is a similarity field, which a fit over the nodes recovers exactly
+        T, _ = registerPointSets(nodes, nodes + displacement, scaling=True)
+        output_dir = case_dir / "IntraOperative" / "PreOperative"
+        os.makedirs(output_dir, exist_ok=True)
+        for name in (f"{case_id:04d}_fids_mm", f"{case_id:04d}_tgt_mm"):
+            points_mm = cachedVTKPolyDataPointsParser(case_dir / "PreOperative" / f"{name}.vtk")
+            simpleVTKPolyDataPointsWriter(output_dir / f"{name}_Deformed.vtk", transformPoints(T, np.asarray(points_mm) * 0.001) * 1000)
+        return 0
+
+
+SOLVER_BACKENDS = {backend.name: backend for backend in (SubprocessBackend, MatlabEngineBackend, FakeBackend)}
+
+
+def makeSolverBackend(name, **kwargs):
+    """Backend by name ("subprocess", "matlab-engine" or "fake"); kwargs go to its constructor."""
+    if name not in SOLVER_BACKENDS:
+        raise ValueError(f"Unknown solver backend '{name}', expected one of {tuple(SOLVER_BACKENDS)}")
+    return SOLVER_BACKENDS[name](**kwargs)
+
+
+class SolverPool:
+    """
+    Queue of solver steps served by long-lived worker threads, one backend each.
+
+    Each worker starts its backend on its first job and keeps it warm for every later
+    job, across folds and cases. A failed or timed out step is retried up to `retries`
+    times, each time on a restarted backend. The workers are threads: the steps run
+    in external processes (or MATLAB), so they do not hold the GIL.
+
+    Use it as a context manager, or call close() to stop the workers.
+    """
+
+    def __init__(self, backend_factory, workers=1, timeout=None, retries=0):
+        """
+        Args:
+            backend_factory (callable): returns a new SolverBackend, called once per worker
+            workers (int): number of backends running steps at once
+            timeout (float, optional): seconds allowed per attempt of a step
+            retries (int): extra attempts of a failed step
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self._jobs = queue.Queue()
+        self._threads = [threading.Thread(target=self._serve, args=(backend_factory,), daemon=True) for _ in range(max(workers, 1))]
+        for thread in self._threads:
+            thread.start()
+
+    def _serve(self, backend_factory):
+        backend = None
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, step, case_dir, case_id, pipe_parameters = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            for attempt in range(self.retries + 1):
+                try:
+                    if backend is None:
+                        backend = backend_factory()
+                    backend.start()
+                    start = time.perf_counter()
+                    with stage(step, category="solver", case_dir=str(case_dir), attempt=attempt):
+                        result = backend.run(step, case_dir, case_id, self.timeout, pipe_parameters)
+                    logging.debug(f"{step} on {case_dir} took {time.perf_counter() - start:.2f} s")
+                    future.set_result(result)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        future.set_exception(e)
+                        break
+                    logging.warning(f"{step} on {case_dir} failed ({e}), retrying {attempt + 1}/{self.retries}")
+                    if backend is not None:
+                        try:
+                            backend.restart()
+                        except Exception:
+                            logging.exception("Could not restart the solver backend")
+                            backend = None
+        if backend is not None:
+            backend.close()
+
+    def submit(self, step, case_dir, case_id, pipe_parameters=None):
+        """Queue a step (see SolverBackend.run); returns a concurrent.futures.Future of its result."""
+        if step not in SOLVER_STEPS:
+            raise ValueError(f"step must be one of {SOLVER_STEPS}, got '{step}'")
+        future = Future()
+        self._jobs.put((future, step, case_dir, case_id, pipe_parameters))
+        return future
+
+    def run(self, step, case_dir, case_id, pipe_parameters=None):
+        """Run a step and wait for it; raises its SolverError (or other exception) on failure."""
+        return self.submit(step, case_dir, case_id, pipe_parameters).result()
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,248 @@
+from pathlib import Path
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import logging
+import argparse
+import functools
+import threading
+import multiprocessing
+
+# Set to a file name to trace any tool that imports this module (e.g. the SVO extraction
+# or Blender, which have no --trace option); the trace is written at exit.
+TRACE_ENV_VAR = "STAGE_TRACE"
+
+# Tracer of this process, None when tracing is disabled. Every entry point checks only
+# this, so disabled stages cost a global lookup and a call.
+_TRACER = None
+
+
+class _NullStage:
+    # Shared, stateless stand-in returned by stage() when tracing is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.stack = self.tracer._stack()
+        self.parent = self.stack[-1] if self.stack else None
+        self.stack.append(self.name)
+        self.cpu_ns = time.thread_time_ns()
+        self.wall_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall_ns = time.perf_counter_ns() - self.wall_ns
+        cpu_ns = time.thread_time_ns() - self.cpu_ns
+        self.stack.pop()
+        args = dict(self.args, cpu_ms=cpu_ns / 1e6)
+        if self.parent is not None:
+            args["parent"] = self.parent
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        self.tracer.events.append({"name": self.name, "cat": self.category, "ph": "X", "ts": self.wall_ns / 1000,
+                                   "dur": wall_ns / 1000, "pid": self.tracer.pid, "tid": threading.get_ident(), "args": args})
+        return False
+
+
+class Tracer:
+    """
+    Collects the stages of one process as Chrome trace "complete" events.
+
+    Timestamps come from time.perf_counter_ns, a system-wide monotonic clock, so the
+    traces of worker processes line up with the main process once merged. Each event
+    holds the stage's wall time (dur) and the CPU time of its thread (args.cpu_ms);
+    time spent in child processes (MATLAB, pipe.sh) shows as wall time only.
+    """
+
+    def __init__(self, path=None, process_name=None):
+        self.path = None if path is None else Path(path)
+        self.pid = os.getpid()
+        self.events = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+                        "args": {"name": process_name or f"{Path(sys.argv[0]).name} ({self.pid})"}}]
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def stage(self, name, category="stage", **args):
+        return _Stage(self, name, category, args)
+
+    def save(self, path=None):
+        """Write the events as a Chrome trace (chrome://tracing, ui.perfetto.dev); returns the path."""
+        path = Path(path) if path is not None else self.path
+        if path is None:
+            return None
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms"}))
+        os.replace(tmp_path, path)
+        return path
+
+
+def enableTracing(path=None, process_name=None):
+    """
+    Start tracing this process (replacing any earlier tracer); the trace is written to
+    path, if given, by saveTrace() and at exit. Processes of a pool exit without
+    running atexit, so their tasks should call saveTrace() themselves.
+    """
+    global _TRACER
+    _TRACER = Tracer(path, process_name)
+    return _TRACER
+
+
+def disableTracing():
+    global _TRACER
+    _TRACER = None
+
+
+def tracingEnabled():
+    return _TRACER is not None
+
+
+def stage(name, category="stage", **args):
+    """
+    Context manager timing a stage, e.g. `with stage("parse fids", case=13): ...`.
+
+    Stages nest: a stage opened inside another one is drawn below it, and its
+    parent's name is recorded in its args. Extra keyword arguments are shown with
+    the event and must be JSON-serializable.
+    """
+    if _TRACER is None:
+        return _NULL_STAGE
+    return _TRACER.stage(name, category, **args)
+
+
+def traced(name=None, category="stage"):
+    """
+    Decorator timing every call of a function as a stage (named after the function by default).
+
+        @traced()
+        def save_data(...): ...
+    """
+    def decorator(fn):
+        stage_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _TRACER is None:
+                return fn(*args, **kwargs)
+            with _TRACER.stage(stage_name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def tracePath():
+    """File this process's trace goes to, None when disabled or kept in memory only."""
+    return None if _TRACER is None else _TRACER.path
+
+
+def saveTrace(path=None):
+    """Write this process's trace (to path or the path tracing was enabled with); no-op when disabled."""
+    if _TRACER is None:
+        return None
+    return _TRACER.save(path)
+
+
+def workerTracePath(path, pid=None):
+    """Trace file of a worker process of the run traced to path: <stem>.<pid><suffix>."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{os.getpid() if pid is None else pid}{path.suffix}")
+
+
+def mergeWorkerTraces(path):
+    """
+    Fold the traces of worker processes (workerTracePath files next to path) into the
+    trace at path, and delete them. If this process is being traced to path, the
+    workers' events join its tracer, so that later saves keep them.
+    """
+    path = Path(path)
+    worker_re = re.compile(re.escape(path.stem) + r"\.\d+" + re.escape(path.suffix) + "$")
+    worker_paths = sorted(p for p in path.parent.glob(f"{path.stem}.*{path.suffix}") if worker_re.fullmatch(p.name))
+    if not worker_paths:
+        return path
+    if _TRACER is not None and _TRACER.path is not None and os.path.abspath(_TRACER.path) == os.path.abspath(path):
+        events = _TRACER.events
+    else:
+        events = json.loads(path.read_text())["traceEvents"] if os.path.exists(path) else []
+    for worker_path in worker_paths:
+        events.extend(json.loads(worker_path.read_text())["traceEvents"])
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+    os.replace(tmp_path, path)
+    for worker_path in worker_paths:
+        os.remove(worker_path)
+    return path
+
+
+def summarizeTrace(events):
+    """
+    Count, total wall and CPU time and self time (wall minus nested stages of the same
+    thread) per stage name.
+
+    Returns:
+        dict: name -> {"count", "wall_s", "cpu_s", "self_s"}
+    """
+    stages = sorted((e for e in events if e.get("ph") == "X"), key=lambda e: (e["pid"], e["tid"], e["ts"], -e["dur"]))
+    summary = {}
+    open_stages = []  # (thread, end, entry) of the enclosing stages
+    for e in stages:
+        thread = (e["pid"], e["tid"])
+        while open_stages and (open_stages[-1][0] != thread or open_stages[-1][1] <= e["ts"]):
+            open_stages.pop()
+        if open_stages:
+            open_stages[-1][2]["self_s"] -= e["dur"] / 1e6
+        entry = summary.setdefault(e["name"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "self_s": 0.0})
+        entry["count"] += 1
+        entry["wall_s"] += e["dur"] / 1e6
+        entry["cpu_s"] += e.get("args", {}).get("cpu_ms", 0.0) / 1e3
+        entry["self_s"] += e["dur"] / 1e6
+        open_stages.append((thread, e["ts"] + e["dur"], entry))
+    return summary
+
+
+def _resetInChild():
+    # A forked child starts untraced instead of inheriting (and re-writing) the parent's events
+    global _TRACER
+    _TRACER = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_resetInChild)
+atexit.register(saveTrace)
+if os.environ.get(TRACE_ENV_VAR):
+    # Spawned worker processes import this module too; they write next to the main trace
+    enableTracing(os.environ[TRACE_ENV_VAR] if multiprocessing.parent_process() is None else workerTracePath(os.environ[TRACE_ENV_VAR]))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Summarize a stage trace: time per stage, slowest first")
+    parser.add_argument("trace", type=str, help="Chrome trace JSON written with --trace or STAGE_TRACE")
+    parser.add_argument("--top", type=int, default=30)
+    args = parser.parse_args()
+
+    summary = summarizeTrace(json.loads(Path(args.trace).read_text())["traceEvents"])
+    print(f"{'stage':48s} {'count':>7s} {'wall (s)':>10s} {'self (s)':>10s} {'cpu (s)':>10s}")
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]["wall_s"])[:args.top]:
+        print(f"{name[:48]:48s} {entry['count']:7d} {entry['wall_s']:10.3f} {entry['self_s']:10.3f} {entry['cpu_s']:10.3f}")
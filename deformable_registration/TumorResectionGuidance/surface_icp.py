@@ -0,0 +1,218 @@
+import os
+import logging
+import functools
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
+
+from point_set_registration import registerPointSets, transformPoints
+from vtk_points_io import cachedVTKPolyDataPointsParser
+
+ICP_MODES = ("point_to_point", "point_to_plane")
+# Points per coarse-to-fine level; the last level is capped by the size of the source.
+DEFAULT_SAMPLE_SIZES = (2_000, 20_000, 100_000)
+# Neighbors per PCA normal, and points per chunk when estimating normals
+_NORMAL_NEIGHBORS = 12
+_NORMAL_CHUNK = 100_000
+# Singular values of the point-to-plane system below this fraction of the largest are ignored
+_POINT_TO_PLANE_RCOND = 1e-2
+# Floor of the query bound, as a fraction of the source's extent (exact correspondences trim to 0)
+_MIN_BOUND_FRACTION = 1e-3
+ICP_MAX_DISTANCE = 0.01 # m, sparse data farther than this from the bel mesh is ignored by ICP
+ICP_FIDUCIAL_RMS_SLACK = 0.002 # m, ICP results whose fiducial RMS exceeds the seed's by more are rejected
+
+
+def estimateNormals(points, tree, k=_NORMAL_NEIGHBORS, workers=-1):
+    """Unoriented normals of a point cloud: smallest principal axis of each point's k neighbors."""
+    normals = np.empty_like(points)
+    for i in range(0, len(points), _NORMAL_CHUNK):
+        chunk = points[i:i + _NORMAL_CHUNK]
+        _, idx = tree.query(chunk, k=min(k, len(points)), workers=workers)
+        neighbors = points[idx]
+        neighbors -= neighbors.mean(axis=1, keepdims=True)
+        _, vecs = np.linalg.eigh(np.einsum("nki,nkj->nij", neighbors, neighbors))
+        normals[i:i + _NORMAL_CHUNK] = vecs[:, :, 0]
+    return normals
+
+
+class ICPTarget:
+    """
+    Fixed surface of an ICP registration: points, a KD-tree over them and (lazily) normals.
+
+    Build it once per surface and reuse it across registrations; loadICPTarget caches
+    instances per file.
+    """
+
+    def __init__(self, points, normals=None):
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        # Unbalanced trees without compacted nodes build several times faster and query as fast
+        self.tree = cKDTree(self.points, balanced_tree=False, compact_nodes=False)
+        self._normals = None if normals is None else np.ascontiguousarray(normals, dtype=np.float64)
+
+    @property
+    def normals(self):
+        if self._normals is None:
+            self._normals = estimateNormals(self.points, self.tree)
+        return self._normals
+
+    @classmethod
+    def fromPolyData(cls, polydata, scale=1.0):
+        """Target from a vtkPolyData; surface meshes get VTK point normals, point clouds PCA normals."""
+        import vtk
+        from vtk.util.numpy_support import vtk_to_numpy
+
+        points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float64) * scale
+        normals = None
+        if polydata.GetNumberOfPolys() > 0:
+            normals_filter = vtk.vtkPolyDataNormals()
+            normals_filter.SetInputData(polydata)
+            normals_filter.ComputePointNormalsOn()
+            normals_filter.SplittingOff()  # keep one normal per input point
+            normals_filter.Update()
+            normals = vtk_to_numpy(normals_filter.GetOutput().GetPointData().GetNormals()).astype(np.float64)
+        return cls(points, normals)
+
+
+@functools.lru_cache(maxsize=8)
+def _loadICPTarget(path, mtime_ns, size, scale):
+    import vtk
+    reader = vtk.vtkXMLPolyDataReader() if path.lower().endswith(".vtp") else vtk.vtkPolyDataReader()
+    reader.SetFileName(path)
+    reader.Update()
+    return ICPTarget.fromPolyData(reader.GetOutput(), scale)
+
+
+def loadICPTarget(file_name, scale=1.0):
+    """ICPTarget of a .vtk/.vtp surface, cached until the file changes (e.g. scale=0.001 for a bel.vtk in mm)."""
+    path = os.path.abspath(file_name)
+    st = os.stat(path)
+    return _loadICPTarget(path, st.st_mtime_ns, st.st_size, scale)
+
+
+def _pointToPlaneStep(source, target, normals, max_step):
+    # Linearized point-to-plane least squares (small-angle rotation) for the increment
+    # minimizing sum ((R p + t - q) . n)^2. The rotation is about the centroid and its
+    # columns are scaled by the cloud's radius so that all six unknowns are in meters;
+    # directions the surface barely constrains (rotation about the axis of a near-
+    # rotationally-symmetric patch) fall under the rcond cutoff and are left unchanged.
+    center = source.mean(axis=0)
+    centered = source - center
+    radius = max(np.sqrt(np.mean(np.einsum("ij,ij->i", centered, centered))), np.finfo(float).tiny)
+    A = np.hstack([np.cross(centered, normals) / radius, normals])
+    b = -np.einsum("ij,ij->i", source - target, normals)
+    x = np.linalg.lstsq(A, b, rcond=_POINT_TO_PLANE_RCOND)[0]
+    # Clamp the step: no point of the cloud moves farther than max_step
+    displacement = np.linalg.norm(x[:3]) + np.linalg.norm(x[3:])
+    if displacement > max_step:
+        x *= max_step / displacement
+    R = Rotation.from_rotvec(x[:3] / radius).as_matrix()
+    T = np.eye(4)
+    T[:3, :3] = R
+    T[:3, 3] = x[3:] + center - R @ center
+    return T
+
+
+def icp(source, target, T_init=None, mode="point_to_plane", sample_sizes=DEFAULT_SAMPLE_SIZES, max_iterations=30,
+        trim_fraction=0.1, max_distance=None, tolerance=1e-4, workers=-1, seed=0):
+    """
+    Rigidly align a source point cloud onto a target surface with trimmed ICP.
+
+    Runs coarse-to-fine on random subsamples of the source (sample_sizes). Each
+    iteration finds the closest target points with one multithreaded KD-tree query,
+    drops the worst trim_fraction of the correspondences (and any farther than
+    max_distance), then solves the point-to-point (Umeyama) or point-to-plane
+    (linearized, truncated least squares) update; point-to-plane steps are clamped to
+    twice the RMS distance of the kept correspondences. Queries are bounded by twice the
+    previous trimming distance, which prunes most of the tree search once the alignment
+    is close.
+
+    Args:
+        source (array-like): (N, 3) moving points, e.g. the intraop sparse data
+        target (ICPTarget | array-like): fixed surface, or its (M, 3) points
+        T_init (array-like, optional): (4, 4) initial source -> target transform,
+            typically the fiducial registration
+        mode (str): "point_to_point" or "point_to_plane"
+        sample_sizes (sequence of int): source points used per level
+        max_iterations (int): iterations per level
+        trim_fraction (float): fraction of the farthest correspondences ignored
+        max_distance (float, optional): correspondences farther than this are ignored
+        tolerance (float): a level stops when the update moves points less than this
+            fraction of the source's extent
+        workers (int): threads for the KD-tree queries, -1 for all cores
+        seed (int): seed of the subsampling
+
+    Returns:
+        T (np.ndarray): (4, 4) source -> target transform
+        info (dict): "rmse" of the kept correspondences at the last iteration,
+            "inlier_fraction" and total "iterations"
+    """
+    if mode not in ICP_MODES:
+        raise ValueError(f"mode must be one of {ICP_MODES}, got '{mode}'")
+    if not isinstance(target, ICPTarget):
+        target = ICPTarget(target)
+    source = np.asarray(source, dtype=np.float64)
+    T = np.eye(4) if T_init is None else np.array(T_init, dtype=np.float64)
+    normals = target.normals if mode == "point_to_plane" else None
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(source))
+    extent = np.linalg.norm(np.ptp(source, axis=0)) if len(source) else 1.0
+    bound = np.inf if max_distance is None else max_distance
+    min_bound = _MIN_BOUND_FRACTION * extent
+    iterations = 0
+    rmse, inlier_fraction = np.inf, 0.0
+    for sample_size in sample_sizes:
+        # Nested prefixes of one permutation: each level refines with a superset of the previous points
+        sample = source[order[:min(sample_size, len(source))]]
+        for _ in range(max_iterations):
+            moved = transformPoints(T, sample)
+            dist, idx = target.tree.query(moved, distance_upper_bound=bound, workers=workers)
+            keep = np.isfinite(dist)  # misses beyond the bound come back as inf
+            if trim_fraction > 0 and keep.any():
+                cutoff = np.quantile(dist[keep], 1.0 - trim_fraction)
+                keep &= dist <= cutoff
+                bound = max(2 * cutoff, min_bound) if max_distance is None else min(max_distance, max(2 * cutoff, min_bound))
+            if keep.sum() < 6:
+                raise RuntimeError(f"ICP lost its correspondences ({keep.sum()} left); check T_init and max_distance")
+            rmse = np.sqrt(np.mean(dist[keep] ** 2))
+            inlier_fraction = keep.mean()
+
+            if mode == "point_to_point":
+                step, _ = registerPointSets(moved[keep], target.points[idx[keep]])
+            else:
+                step = _pointToPlaneStep(moved[keep], target.points[idx[keep]], normals[idx[keep]], max(2 * rmse, min_bound))
+            T = step @ T
+            iterations += 1
+            # Largest displacement the update causes anywhere on the cloud's bounding sphere
+            if np.linalg.norm(step[:3, 3]) + np.linalg.norm(step[:3, :3] - np.eye(3), 2) * extent < tolerance * extent:
+                break
+    return T, {"rmse": rmse, "inlier_fraction": inlier_fraction, "iterations": iterations}
+
+
+def refine_registration_with_surface_icp(case_base_dir, case_id, T, mode="point_to_plane", fiducials=None):
+    # Seeded by the fiducial transform T (preop -> intraop), align the intraop sparse surface
+    # data onto the bel mesh and return the refined preop -> intraop transform
+    sparse_data_dir = case_base_dir / "IntraOperative" / f"1{case_id:03d}_sparsedata_transformed.vtk" # m
+    bel_dir = case_base_dir / "PreOperative" / f"{case_id:04d}_bel.vtk" # mm
+    sparse_data = cachedVTKPolyDataPointsParser(sparse_data_dir)
+    bel = loadICPTarget(bel_dir, scale=0.001)
+    return refine_with_surface_icp(sparse_data, bel, case_id, T, mode, fiducials)
+
+
+def refine_with_surface_icp(sparse_data, bel, case_id, T, mode="point_to_plane", fiducials=None):
+    # sparse_data (m) and bel (ICPTarget, m) in the frames T maps between. With fiducials
+    # (preop, intraop; m), T is kept when ICP fits them much worse than T does.
+    preop_T_intraop, info = icp(sparse_data, bel, np.linalg.inv(T), mode=mode, max_distance=ICP_MAX_DISTANCE)
+    logging.info(f"Surface ICP ({mode}) for case {case_id}: {info['iterations']} iterations, "
+                 f"RMS {info['rmse'] * 1000:.3f} mm over {100 * info['inlier_fraction']:.1f}% of the sparse data")
+    T_icp = np.linalg.inv(preop_T_intraop)
+    if fiducials is not None:
+        preop_fids, intraop_fids = (np.asarray(f, dtype=np.float64) for f in fiducials)
+        seed_rms, icp_rms = (np.sqrt(np.mean(np.sum((transformPoints(cur_T, preop_fids) - intraop_fids) ** 2, axis=1)))
+                             for cur_T in (T, T_icp))
+        if icp_rms > seed_rms + ICP_FIDUCIAL_RMS_SLACK:
+            logging.warning(f"Surface ICP for case {case_id} rejected: fiducial RMS {icp_rms * 1000:.3f} mm "
+                            f"vs {seed_rms * 1000:.3f} mm for the fiducial registration")
+            return T
+    return T_icp
@@ -0,0 +1,252 @@
+from pathlib import Path
+import os
+import argparse
+import hashlib
+import logging
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TRE_RESULTS_VERSION = 1
+# One row per evaluated fold (held-out fiducial). Coordinates and TRE in mm, fold time in s.
+TRE_COLUMNS = {
+    "run": np.str_,
+    "case_id": np.int64,
+    "fold": np.int64,
+    "gt_x_mm": np.float64,
+    "gt_y_mm": np.float64,
+    "gt_z_mm": np.float64,
+    "tgt_x_mm": np.float64,
+    "tgt_y_mm": np.float64,
+    "tgt_z_mm": np.float64,
+    "tre_mm": np.float64,
+    "fold_seconds": np.float64,
+    "solver": np.str_,
+    "nCP": np.int64,
+    "seWeight": np.float64,
+    "kEpsilon": np.float64,
+    "rigid": np.bool_,
+    "icp_refine": np.bool_,
+}
+TRE_PERCENTILES = (50, 90, 95)
+
+
+class TREResults:
+    """
+    TREs of one run, collected in memory and written once as a typed columnar table.
+
+    Args:
+        run_name (str): name of the run, repeated on every row so runs can be concatenated
+        parameters (dict, optional): per-run columns of TRE_COLUMNS (solver, nCP, seWeight,
+            kEpsilon, rigid, icp_refine); missing ones are left empty/NaN
+    """
+
+    def __init__(self, run_name, parameters=None):
+        self.run_name = run_name
+        self.parameters = dict(parameters or {})
+        self._case_ids = []
+        self._folds = []
+        self._gt = []
+        self._tgt = []
+        self._seconds = []
+
+    def __len__(self):
+        return len(self._folds)
+
+    def add(self, case_id, fold, gt_mm, tgt_mm, seconds=np.nan):
+        """Add one fold: ground truth and registered (deformed) target, in mm."""
+        self._case_ids.append(case_id)
+        self._folds.append(fold)
+        self._gt.append(np.asarray(gt_mm, dtype=np.float64).reshape(3))
+        self._tgt.append(np.asarray(tgt_mm, dtype=np.float64).reshape(3))
+        self._seconds.append(np.nan if seconds is None else seconds)
+
+    def columns(self):
+        """dict of column name -> (N,) array, in TRE_COLUMNS order."""
+        n = len(self)
+        gt = np.reshape(self._gt, (n, 3))
+        tgt = np.reshape(self._tgt, (n, 3))
+        values = {
+            "run": np.full(n, self.run_name),
+            "case_id": self._case_ids,
+            "fold": self._folds,
+            "gt_x_mm": gt[:, 0], "gt_y_mm": gt[:, 1], "gt_z_mm": gt[:, 2],
+            "tgt_x_mm": tgt[:, 0], "tgt_y_mm": tgt[:, 1], "tgt_z_mm": tgt[:, 2],
+            "tre_mm": np.linalg.norm(tgt - gt, axis=1),
+            "fold_seconds": self._seconds,
+        }
+        for name, dtype in TRE_COLUMNS.items():
+            if name not in values:
+                default = {np.str_: "", np.bool_: False, np.int64: -1}.get(dtype, np.nan)
+                values[name] = np.full(n, self.parameters.get(name, default))
+        return {name: np.asarray(values[name]).astype(dtype) for name, dtype in TRE_COLUMNS.items()}
+
+    def save(self, stem):
+        """Write <stem>.npz, <stem>.csv and, with pyarrow installed, <stem>.parquet; returns the paths."""
+        return saveColumns(self.columns(), stem)
+
+
+def saveColumns(columns, stem):
+    stem = Path(stem)
+    os.makedirs(stem.parent, exist_ok=True)
+    paths = [stem.with_suffix(".npz"), stem.with_suffix(".csv")]
+    np.savez(paths[0], __version__=TRE_RESULTS_VERSION, **columns)
+    writeColumnsCSV(columns, paths[1])
+    if pyarrow is not None:
+        paths.append(stem.with_suffix(".parquet"))
+        pyarrow.parquet.write_table(pyarrow.table({name: pyarrow.array(values) for name, values in columns.items()}), paths[2])
+    return paths
+
+
+def writeColumnsCSV(columns, file_name):
+    names = list(columns)
+    values = [np.asarray(columns[name]) for name in names]
+    with open(file_name, "w") as save_f:
+        save_f.write(", ".join(names) + "\n")
+        for row in zip(*[v.tolist() for v in values]):
+            save_f.write(", ".join(str(v) for v in row) + "\n")
+
+
+def loadColumns(paths):
+    """Concatenate the columns of TRE tables (.npz or .parquet), e.g. every run of a sweep."""
+    parts = []
+    for path in paths:
+        path = Path(path)
+        if path.suffix == ".parquet":
+            if pyarrow is None:
+                raise ImportError(f"Reading {path.name} needs pyarrow")
+            table = pyarrow.parquet.read_table(path)
+            parts.append({name: table.column(name).to_numpy() for name in table.column_names})
+        else:
+            with np.load(path) as data:
+                parts.append({name: data[name] for name in data.files if name != "__version__"})
+    return concatColumns(parts)
+
+
+def concatColumns(parts):
+    """Rows of several column dicts (e.g. TREResults.columns() of the points of a sweep) as one."""
+    if not parts:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in TRE_COLUMNS.items()}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def groupIndex(columns, by):
+    """
+    Group rows by the columns in `by`.
+
+    Returns:
+        keys (dict): column name -> (G,) key values of each group, sorted
+        inverse (np.ndarray): (N,) group of each row
+    """
+    records = np.rec.fromarrays([np.asarray(columns[name]) for name in by], names=list(by))
+    unique, inverse = np.unique(records, return_inverse=True)
+    return {name: unique[name] for name in by}, inverse.ravel()
+
+
+def groupStats(values, inverse, n_groups, percentiles=TRE_PERCENTILES):
+    """
+    Count, mean, std (sample, 0 for single values), RMS, min, max and percentiles of
+    `values` per group, all groups at once.
+
+    Percentiles interpolate linearly, as np.percentile does, from one lexsort of
+    (group, value) instead of a sort per group.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(inverse, minlength=n_groups)
+    mean = np.bincount(inverse, values, n_groups) / counts
+    ss = np.bincount(inverse, (values - mean[inverse]) ** 2, n_groups)
+    std = np.sqrt(np.divide(ss, counts - 1, out=np.zeros(n_groups), where=counts > 1))
+    rms = np.sqrt(np.bincount(inverse, values ** 2, n_groups) / counts)
+
+    sorted_values = values[np.lexsort((values, inverse))]
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts - 1
+    stats = {"n": counts, "mean_mm": mean, "std_mm": std, "rms_mm": rms,
+             "min_mm": sorted_values[starts], "max_mm": sorted_values[ends]}
+    for q in percentiles:
+        position = starts + q / 100 * (counts - 1)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, ends)
+        fraction = position - lower
+        stats[f"p{q:g}_mm"] = sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+    return stats
+
+
+def groupSeed(keys, group, seed=0):
+    """Seed of one group's random draws, from its key values: the same whatever other groups exist."""
+    key = "\0".join(str(values[group]) for values in keys.values())
+    return [seed, int.from_bytes(hashlib.sha256(key.encode()).digest()[:16], "little")]
+
+
+def bootstrapMeanCI(values, inverse, keys, n_boot=2000, level=0.95, seed=0, batch=250):
+    """
+    Percentile bootstrap confidence interval of the mean of every group.
+
+    Each group is resampled from its own random stream, seeded from its key values
+    (groupSeed), so that its interval does not depend on which other groups (runs,
+    cases) are in the table; the resamples are drawn `batch` at a time as one
+    (batch, n) matrix of indices.
+
+    Args:
+        keys (dict): column name -> (G,) key values of each group, as from groupIndex
+
+    Returns:
+        lower, upper (np.ndarray): (G,) bounds of the interval
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_groups = len(next(iter(keys.values())))
+    order = np.argsort(inverse, kind="stable")
+    sorted_values = values[order]
+    counts = np.bincount(inverse, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+
+    means = np.empty((n_boot, n_groups))
+    for group in range(n_groups):
+        rng = np.random.default_rng(groupSeed(keys, group, seed))
+        group_values = sorted_values[starts[group]:starts[group] + counts[group]]
+        for b in range(0, n_boot, batch):
+            n = min(batch, n_boot - b)
+            means[b:b + n, group] = group_values[rng.integers(0, counts[group], (n, counts[group]))].mean(axis=1)
+    alpha = 100 * (1 - level) / 2
+    lower, upper = np.percentile(means, [alpha, 100 - alpha], axis=0)
+    return lower, upper
+
+
+def summarizeColumns(columns, by=("run", "case_id"), percentiles=TRE_PERCENTILES, n_boot=2000, level=0.95, seed=0):
+    """
+    Summary table of the TREs per group, e.g. by=("run", "case_id") for one row per case
+    of each run, ("run",) per run, or ("case_id", "fold") for a per-fiducial breakdown
+    across runs.
+
+    Returns:
+        dict: the key columns, then n, mean, std, RMS, min, max, percentiles and the
+        bootstrap CI of the mean (ci_low_mm, ci_high_mm), one row per group
+    """
+    keys, inverse = groupIndex(columns, by)
+    n_groups = len(next(iter(keys.values())))
+    summary = dict(keys)
+    summary.update(groupStats(columns["tre_mm"], inverse, n_groups, percentiles))
+    if n_boot > 0:
+        summary["ci_low_mm"], summary["ci_high_mm"] = bootstrapMeanCI(columns["tre_mm"], inverse, keys, n_boot, level, seed)
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Summarize TRE tables (TRE_<run>.npz/.parquet) of one or many runs")
+    parser.add_argument("tables", type=str, nargs="+", help="TRE tables written by evalAllTRE3FidsOrScaling.py")
+    parser.add_argument("--by", type=str, nargs="+", default=["run", "case_id"], help=f"Columns to group by, among {list(TRE_COLUMNS)}")
+    parser.add_argument("--nBoot", type=int, default=2000, help="Bootstrap resamples for the CI of the mean (0 to skip)")
+    parser.add_argument("--out", type=str, default="TRE_summary.csv")
+    args = parser.parse_args()
+
+    columns = loadColumns(args.tables)
+    logging.info(f"{len(columns['tre_mm'])} TREs from {len(args.tables)} table(s)")
+    summary = summarizeColumns(columns, args.by, n_boot=args.nBoot)
+    writeColumnsCSV(summary, args.out)
+    logging.info(f"{len(summary['n'])} groups summarized in {args.out}")
@@ -0,0 +1,208 @@
+import mmap
+import re
+
+import numpy as np
+
+from data_cache import DEFAULT_CACHE
+
+# Legacy VTK stores binary payloads big-endian, whatever the host is.
+VTK_BINARY_DTYPES = {
+    b"float": np.dtype(">f4"),
+    b"double": np.dtype(">f8"),
+}
+
+_FILE_TYPE_RE = re.compile(rb"^(ASCII|BINARY)[ \t]*\r?$", re.MULTILINE | re.IGNORECASE)
+_POINTS_RE = re.compile(rb"^POINTS[ \t]+(\d+)[ \t]+(\w+)[ \t]*\r?\n", re.MULTILINE | re.IGNORECASE)
+# First line of the next section (VERTICES, POLYGONS, POINT_DATA, ...) closes an ASCII block;
+# a line starting with nan/inf is still data.
+_SECTION_RE = re.compile(rb"\n[ \t]*(?![Nn][Aa][Nn]|[Ii][Nn][Ff])[A-Za-z]")
+
+
+def simpleVTKPolyDataPointsParser(file_name):
+    # Original line-by-line parser, kept as the dependency-free reference implementation.
+    with open(file_name, "r") as vtkFile:
+        points_started = False
+        points_stopped = False
+        nPoints = 0
+        pts1D = []
+        for line in vtkFile:
+            if line.upper().startswith("POINTS"):
+                points_started = True
+                nPoints = int(re.search(r"POINTS (\d+) float", line).group(1))
+            elif points_started == False:
+                continue
+            else:
+                if not points_stopped:
+                    if re.match(r"^[A-Za-z\n ]", line) or len(line) == 0:
+                        points_stopped = True
+                        break
+                    else:
+                        curLineList = line.strip(" ").strip("\n").strip(" ").split(" ")
+                        for elem in curLineList:
+                            pts1D.append(float(elem))
+        assert(nPoints == len(pts1D) / 3)
+        pts = [pts1D[i:i+3] for i in range(0, len(pts1D), 3)]
+        return pts
+
+
+def _parseVTKPointsBlock(buf, file_name):
+    """
+    Locate the POINTS block of a legacy VTK file held in `buf` and parse it in bulk.
+
+    Args:
+        buf (bytes-like): file contents, typically an mmap
+        file_name (str): used for error messages only
+
+    Returns:
+        np.ndarray: (N, 3) float64 array of points
+    """
+    file_type = _FILE_TYPE_RE.search(buf)
+    points_header = _POINTS_RE.search(buf)
+    if file_type is None or points_header is None:
+        raise ValueError(f"{file_name} is not a legacy VTK file with a POINTS section")
+
+    nPoints = int(points_header.group(1))
+    data_type = points_header.group(2).lower()
+    start = points_header.end()
+    if nPoints == 0:
+        return np.empty((0, 3), dtype=np.float64)
+
+    if file_type.group(1).upper() == b"BINARY":
+        if data_type not in VTK_BINARY_DTYPES:
+            raise ValueError(f"Unsupported POINTS data type '{data_type.decode()}' in {file_name}")
+        pts1D = np.frombuffer(buf, dtype=VTK_BINARY_DTYPES[data_type], count=3 * nPoints, offset=start)
+    else:
+        section_end = _SECTION_RE.search(buf, start)
+        stop = section_end.start() if section_end is not None else len(buf)
+        pts1D = np.fromstring(buf[start:stop], dtype=np.float64, sep=" ")
+
+    assert(pts1D.size == 3 * nPoints)
+    # astype always copies, so the result stays valid after the mapping is closed.
+    return pts1D.astype(np.float64).reshape(nPoints, 3)
+
+
+def mmapVTKPolyDataPointsParser(file_name):
+    """
+    Vectorized replacement for simpleVTKPolyDataPointsParser.
+
+    Memory-maps the file, finds the POINTS block once and parses it in a single
+    NumPy call. Handles both ASCII and BINARY legacy VTK files.
+
+    Args:
+        file_name (str | Path): path to the legacy .vtk file
+
+    Returns:
+        np.ndarray: (N, 3) float64 array of points
+    """
+    with open(file_name, "rb") as vtkFile:
+        with mmap.mmap(vtkFile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _parseVTKPointsBlock(buf, file_name)
+
+
+def cachedVTKPolyDataPointsParser(file_name):
+    """
+    mmapVTKPolyDataPointsParser behind the process-wide file cache.
+
+    Repeated reads of an unchanged file are served from memory. The returned array
+    is read-only and shared between callers; copy it before modifying it.
+    """
+    return DEFAULT_CACHE.get(file_name, mmapVTKPolyDataPointsParser)
+
+
+VTK_POINTS_FILE_FORMATS = ("ascii", "binary", "vtp")
+# Rows formatted per call when writing ASCII; bounds the size of the temporary strings.
+_ASCII_CHUNK_ROWS = 65536
+
+
+def _writeASCIIPointsVTK(file_name, points, header):
+    if header == None:
+        headerList = ["# vtk DataFile Version 3.0\n", "vtk output\n", "ASCII\n", "DATASET POLYDATA\n", ]
+    else:
+        headerList = header.split("\n")
+
+    nPoints = len(points)
+    with open(file_name, "w") as vtk_out_file:
+        vtk_out_file.writelines(headerList)
+        vtk_out_file.write(f"POINTS {nPoints} float\n")
+        for i in range(0, nPoints, _ASCII_CHUNK_ROWS):
+            chunk = points[i:i + _ASCII_CHUNK_ROWS]
+            vtk_out_file.write(("%.12f %.12f %.12f\n" * len(chunk)) % tuple(chunk.ravel().tolist()))
+        vtk_out_file.write("\n\n")
+        vtk_out_file.write(f"VERTICES {nPoints} {nPoints * 2}\n")
+        for i in range(0, nPoints, _ASCII_CHUNK_ROWS):
+            ids = range(i, min(i + _ASCII_CHUNK_ROWS, nPoints))
+            vtk_out_file.write(("1 %d\n" * len(ids)) % tuple(ids))
+
+
+def pointsToVTKPolyData(points):
+    """
+    Wrap an (N, 3) array as vtkPolyData with one vertex cell per point.
+
+    The point coordinates are shared with `points` through numpy_to_vtk, not copied.
+    The caller must keep `points` alive for as long as the polydata is in use.
+
+    Args:
+        points (np.ndarray): (N, 3) C-contiguous float32/float64 array
+
+    Returns:
+        vtk.vtkPolyData
+    """
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+
+    nPoints = len(points)
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points, deep=False))
+
+    id_dtype = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
+    offsets = np.arange(nPoints + 1, dtype=id_dtype)
+    connectivity = np.arange(nPoints, dtype=id_dtype)
+    vertices = vtk.vtkCellArray()
+    vertices.SetData(numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_to_vtkIdTypeArray(connectivity, deep=True))
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    polydata.SetVerts(vertices)
+    return polydata
+
+
+def simpleVTKPolyDataPointsWriter(file_name, points, header=None, file_format=None):
+    """
+    Write a point set as polydata with one vertex cell per point.
+
+    Args:
+        file_name (str | Path): output path
+        points (array-like): (N, 3) points, list of lists or NumPy array
+        header (str, optional): replaces the default ASCII header lines
+        file_format (str, optional): "ascii" (legacy VTK, byte-identical to the
+            original writer so the MATLAB and LIBR tools keep reading it), "binary"
+            (legacy VTK) or "vtp" (zlib-compressed XML PolyData). Defaults to "vtp"
+            for a .vtp file name and "ascii" otherwise.
+    """
+    if file_format is None:
+        file_format = "vtp" if str(file_name).lower().endswith(".vtp") else "ascii"
+    if file_format not in VTK_POINTS_FILE_FORMATS:
+        raise ValueError(f"file_format must be one of {VTK_POINTS_FILE_FORMATS}, got '{file_format}'")
+
+    points = np.asarray(points)
+    points = np.ascontiguousarray(points, dtype=np.float32 if points.dtype == np.float32 else np.float64).reshape(-1, 3)
+
+    DEFAULT_CACHE.invalidate(file_name)
+    if file_format == "ascii":
+        _writeASCIIPointsVTK(file_name, points, header)
+        return
+
+    import vtk
+    polydata = pointsToVTKPolyData(points)
+    if file_format == "binary":
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileVersion(42)
+        writer.SetFileTypeToBinary()
+    else:
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetCompressorTypeToZLib()
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+    writer.SetFileName(str(file_name))
+    writer.SetInputData(polydata)
+    writer.Write()
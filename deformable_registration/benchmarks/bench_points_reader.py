@@ -0,0 +1,53 @@
+from pathlib import Path
+import sys
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "TumorResectionGuidance"))
+from vtk_points_io import mmapVTKPolyDataPointsParser, simpleVTKPolyDataPointsParser, simpleVTKPolyDataPointsWriter
+
+
+def write_binary_points_vtk(file_name, points):
+    header = f"# vtk DataFile Version 3.0\nvtk output\nBINARY\nDATASET POLYDATA\nPOINTS {len(points)} float\n"
+    with open(file_name, "wb") as vtk_out_file:
+        vtk_out_file.write(header.encode("ascii"))
+        vtk_out_file.write(np.asarray(points, dtype=">f4").tobytes())
+        vtk_out_file.write(b"\n")
+
+
+def time_call(fn, file_name, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = fn(file_name)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the line-by-line and mmap legacy-VTK point parsers")
+    parser.add_argument("--nPoints", type=int, nargs="+", default=[5, 10_000, 1_000_000])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for nPoints in args.nPoints:
+            points = rng.uniform(-0.2, 0.2, size=(nPoints, 3))
+            ascii_path = Path(tmp_dir) / f"ascii_{nPoints}.vtk"
+            binary_path = Path(tmp_dir) / f"binary_{nPoints}.vtk"
+            simpleVTKPolyDataPointsWriter(ascii_path, points)
+            write_binary_points_vtk(binary_path, points)
+
+            t_simple, pts_simple = time_call(simpleVTKPolyDataPointsParser, ascii_path, args.repeats)
+            t_mmap, pts_mmap = time_call(mmapVTKPolyDataPointsParser, ascii_path, args.repeats)
+            t_binary, pts_binary = time_call(mmapVTKPolyDataPointsParser, binary_path, args.repeats)
+
+            assert(np.allclose(np.asarray(pts_simple), pts_mmap))
+            assert(np.allclose(pts_binary, points, atol=1e-6))
+            print(f"{nPoints:>9d} pts | simple (ASCII) {t_simple * 1e3:10.2f} ms | "
+                  f"mmap (ASCII) {t_mmap * 1e3:9.2f} ms ({t_simple / t_mmap:6.1f}x) | "
+                  f"mmap (BINARY) {t_binary * 1e3:8.2f} ms ({t_simple / t_binary:6.1f}x)")
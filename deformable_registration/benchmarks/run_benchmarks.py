@@ -0,0 +1,273 @@
+from pathlib import Path
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import logging
+import platform
+import tempfile
+import subprocess
+import contextlib
+from types import SimpleNamespace
+from datetime import datetime
+
+import numpy as np
+import vtk
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+TUMOR_RESECTION_DIR = BENCHMARKS_DIR.parent / "TumorResectionGuidance"
+sys.path.append(str(TUMOR_RESECTION_DIR))
+sys.path.append(str(BENCHMARKS_DIR.parent))
+sys.path.append(str(BENCHMARKS_DIR.parent / "extract_target_point_cloud"))
+from point_set_registration import transformPoints
+from regMeshes import compute_rigid_transform, transform_vtk_mesh
+from synthetic_cases import loadGroundTruth, makeSyntheticCases
+from vtk_points_io import simpleVTKPolyDataPointsParser
+
+try:
+    from data_processing import save_data
+except ImportError: # needs the ZED SDK (pyzed) and open3d, as on the capture machine
+    save_data = None
+
+BENCHMARK_RESULTS_VERSION = 1
+
+
+def timeCall(fn, repeats, setup=None):
+    """Run fn (on setup()'s result, prepared outside the timing) `repeats` times; returns (seconds list, last result)."""
+    seconds = []
+    result = None
+    for _ in range(repeats):
+        args = () if setup is None else (setup(),)
+        t0 = time.perf_counter()
+        result = fn(*args)
+        seconds.append(time.perf_counter() - t0)
+    return seconds, result
+
+
+def summarizeTimes(seconds, size, **extra):
+    return dict({"size": size, "repeats": len(seconds), "seconds": seconds, "min_s": min(seconds),
+                 "median_s": float(np.median(seconds)), "mean_s": float(np.mean(seconds))}, **extra)
+
+
+def transformError(T, T_ref):
+    # Rotation angle (deg) and translation distance (mm) between two transforms in m; any scale is divided out
+    R = T[:3, :3] / np.cbrt(np.linalg.det(T[:3, :3])) @ (T_ref[:3, :3] / np.cbrt(np.linalg.det(T_ref[:3, :3]))).T
+    angle = np.degrees(np.arccos(np.clip((np.trace(R) - 1) / 2, -1, 1)))
+    return float(angle), float(np.linalg.norm(T[:3, 3] - T_ref[:3, 3]) * 1000)
+
+
+def benchPointsParser(case_dir, case_id, repeats):
+    cloud_dir = case_dir / "IntraOperative" / f"1{case_id:03d}_sparsedata.vtk"
+    seconds, points = timeCall(lambda: simpleVTKPolyDataPointsParser(cloud_dir), repeats)
+    return summarizeTimes(seconds, len(points), file_mb=os.path.getsize(cloud_dir) / 2 ** 20)
+
+
+def benchRigidTransform(case_dir, case_id, ground_truth, repeats):
+    # Fiducials as in the evaluation, and whole clouds of exact correspondences
+    preop_fids = np.asarray(simpleVTKPolyDataPointsParser(case_dir / "PreOperative" / f"{case_id:04d}_fids.vtk"))
+    intraop_fids = np.asarray(simpleVTKPolyDataPointsParser(case_dir / "IntraOperative" / f"1{case_id:03d}_fids.vtk"))
+    intraop_cloud = np.asarray(simpleVTKPolyDataPointsParser(case_dir / "IntraOperative" / f"1{case_id:03d}_sparsedata.vtk"))
+    preop_cloud = transformPoints(np.linalg.inv(ground_truth["intraop_T_preop"]), intraop_cloud)
+
+    fids_seconds, T_fids = timeCall(lambda: compute_rigid_transform(preop_fids, intraop_fids), repeats)
+    cloud_seconds, T_cloud = timeCall(lambda: compute_rigid_transform(preop_cloud, intraop_cloud), repeats)
+    fids_angle, fids_translation = transformError(T_fids, ground_truth["intraop_T_preop"])
+    cloud_angle, cloud_translation = transformError(T_cloud, ground_truth["intraop_T_preop"])
+    return {
+        "compute_rigid_transform_fids": summarizeTimes(fids_seconds, len(preop_fids), rotation_error_deg=fids_angle,
+                                                       translation_error_mm=fids_translation),
+        "compute_rigid_transform_cloud": summarizeTimes(cloud_seconds, len(preop_cloud), rotation_error_deg=cloud_angle,
+                                                        translation_error_mm=cloud_translation),
+    }
+
+
+def benchTransformMesh(case_dir, case_id, ground_truth, repeats):
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(str(case_dir / "PreOperative" / f"{case_id:04d}_bel.vtk"))
+    reader.Update()
+    bel = reader.GetOutput()
+
+    def freshMesh():
+        mesh = vtk.vtkPolyData()
+        mesh.DeepCopy(bel)
+        return mesh
+
+    seconds, _ = timeCall(lambda mesh: transform_vtk_mesh(mesh, ground_truth["intraop_T_preop"]), repeats, setup=freshMesh)
+    return summarizeTimes(seconds, bel.GetNumberOfPoints())
+
+
+class ReplayedFrame:
+    """
+    Camera and point cloud arguments of data_processing.save_data serving a prerecorded
+    organized XYZRGBA frame, so that save_data runs as on a live ZED camera.
+    """
+
+    def __init__(self, xyzrgba):
+        self.xyzrgba = xyzrgba
+        h, w = xyzrgba.shape[:2]
+        self.camera_information = SimpleNamespace(camera_configuration=SimpleNamespace(resolution=SimpleNamespace(height=h, width=w)))
+
+    def retrieve_measure(self, *args):
+        pass # the frame is already there
+
+    def get_camera_information(self):
+        return self.camera_information
+
+    def get_data(self):
+        return self.xyzrgba
+
+
+def benchSaveData(case_dir, case_id, repeats, work_dir, resolution=(1080, 1920)):
+    # ZED-like organized frame: the intraop cloud (and NaN holes) laid out on the image grid,
+    # colors packed as float32 bit patterns in the 4th channel
+    rng = np.random.default_rng(0)
+    h, w = resolution
+    cloud = np.asarray(simpleVTKPolyDataPointsParser(case_dir / "IntraOperative" / f"1{case_id:03d}_sparsedata.vtk"), dtype=np.float32)
+    n_points = min(len(cloud), h * w)
+    xyzrgba = np.full((h, w, 4), np.nan, dtype=np.float32)
+    pixels = rng.choice(h * w, size=n_points, replace=False)
+    xyzrgba.reshape(-1, 4)[pixels, :3] = cloud[:n_points]
+    xyzrgba.reshape(-1, 4)[pixels, 3] = rng.integers(0, 2 ** 24, n_points, dtype=np.uint32).view(np.float32)
+    data_list = [(int(p % w), int(p // w)) for p in pixels]
+
+    # A label without the Open3D preview (and its prompt); written to work_dir/frame_<id>/frame0000_PC.vtk
+    frame = ReplayedFrame(xyzrgba)
+    svo_path = Path(work_dir) / f"frame_{case_id:04d}.svo"
+    with contextlib.redirect_stdout(None):
+        seconds, _ = timeCall(lambda: save_data(frame, frame, None, data_list, str(svo_path), 0, "PC"), repeats)
+    return summarizeTimes(seconds, n_points)
+
+
+def benchRigidEvaluator(data_dir, repeats, work_dir, jobs=1, extra_args=()):
+    """End to end evalAllTRE3FidsOrScaling.py (rigid mode, fake solver, no fold cache) on a copy of the cases."""
+    seconds = []
+    tre_mm = None
+    for idx_repeat in range(repeats):
+        run_data_dir = Path(work_dir) / f"eval_data_{idx_repeat}"
+        tre_dir = Path(work_dir) / f"eval_tre_{idx_repeat}"
+        shutil.copytree(data_dir, run_data_dir)
+        cmd = [sys.executable, str(TUMOR_RESECTION_DIR / "evalAllTRE3FidsOrScaling.py"), "--RunName", "bench",
+               "--DataBasePath", str(run_data_dir), "--TREbasePath", str(tre_dir), "--solver", "fake", "--noCache", "--jobs", str(jobs), *extra_args]
+        t0 = time.perf_counter()
+        completed = subprocess.run(cmd, cwd=TUMOR_RESECTION_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        seconds.append(time.perf_counter() - t0)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Evaluation failed:\n{completed.stderr[-4000:]}")
+        with np.load(next(tre_dir.glob("TRE_bench_*.npz"))) as table:
+            tre_mm = table["tre_mm"]
+        shutil.rmtree(run_data_dir)
+        shutil.rmtree(tre_dir)
+    return summarizeTimes(seconds, int(len(tre_mm)), jobs=jobs, mean_tre_mm=float(np.mean(tre_mm)), max_tre_mm=float(np.max(tre_mm)))
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(data_dir, repeats=5, eval_repeats=1, jobs=1, skip=()):
+    """
+    Time the I/O, registration, mesh transform, save_data and end-to-end
+    rigid evaluation paths on the synthetic cases in data_dir (first case for the
+    single-case benchmarks).
+
+    Returns:
+        dict: benchmark name -> timings ("seconds", "min_s", "median_s", ...) and problem "size"
+    """
+    case_dir = sorted(Path(data_dir).glob("Pt_*"))[0]
+    ground_truth = loadGroundTruth(case_dir)
+    case_id = ground_truth["case_id"]
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        if "points_parser" not in skip:
+            results["simpleVTKPolyDataPointsParser"] = benchPointsParser(case_dir, case_id, repeats)
+        if "rigid_transform" not in skip:
+            results.update(benchRigidTransform(case_dir, case_id, ground_truth, repeats))
+        if "transform_mesh" not in skip:
+            results["transform_vtk_mesh"] = benchTransformMesh(case_dir, case_id, ground_truth, repeats)
+        if "save_data" not in skip:
+            if save_data is None:
+                logging.warning("Skipping the save_data benchmark: data_processing needs pyzed and open3d")
+            else:
+                results["save_data"] = benchSaveData(case_dir, case_id, repeats, work_dir)
+        if "evaluator" not in skip:
+            results["rigid_evaluator"] = benchRigidEvaluator(data_dir, eval_repeats, work_dir, jobs)
+            results["rigid_evaluator_in_memory"] = benchRigidEvaluator(data_dir, eval_repeats, work_dir, extra_args=("--inMemory",))
+        for name, result in results.items():
+            logging.info(f"{name:32s} size {result['size']:>9d} | median {result['median_s'] * 1e3:10.2f} ms | min {result['min_s'] * 1e3:10.2f} ms")
+    return results
+
+
+def compareResults(current, previous, tolerance=0.2):
+    """
+    Log the median time ratio of every benchmark run in both result files.
+
+    Returns:
+        list of str: benchmarks slower than (1 + tolerance) x their previous median
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        old = previous["results"].get(name)
+        if old is None:
+            continue
+        if old["size"] != result["size"]:
+            logging.info(f"{name:32s} not comparable: size {result['size']} vs {old['size']}")
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        logging.info(f"{name:32s} {ratio:6.2f}x the previous median ({old['median_s'] * 1e3:.2f} -> {result['median_s'] * 1e3:.2f} ms)"
+                     f"{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark the I/O, registration, mesh-transform and evaluation paths on synthetic cases")
+    parser.add_argument("--casesPath", type=str, default=None, help="Synthetic cases to use, generated there if none yet (default: a temporary folder)")
+    parser.add_argument("--nCases", type=int, default=2)
+    parser.add_argument("--nMeshVertices", type=int, default=20_000)
+    parser.add_argument("--nCloudPoints", type=int, default=100_000)
+    parser.add_argument("--nFids", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--evalRepeats", type=int, default=1, help="Repeats of the end-to-end evaluation")
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs of the end-to-end evaluation")
+    parser.add_argument("--skip", type=str, nargs="+", default=[], choices=["points_parser", "rigid_transform", "transform_mesh", "save_data", "evaluator"])
+    parser.add_argument("--out", type=str, default=None, help="Results JSON (default: benchmark_<timestamp>.json)")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results JSON to compare with; exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slow-down (fraction of the previous median) counted as a regression")
+    args = parser.parse_args()
+
+    case_settings = {"n_cases": args.nCases, "n_mesh_vertices": args.nMeshVertices, "n_cloud_points": args.nCloudPoints, "n_fids": args.nFids}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(args.casesPath) if args.casesPath is not None else Path(tmp_dir) / "cases"
+        if not list(data_dir.glob("Pt_*")):
+            t0 = time.perf_counter()
+            makeSyntheticCases(data_dir, args.nCases, n_mesh_vertices=args.nMeshVertices, n_cloud_points=args.nCloudPoints, n_fids=args.nFids)
+            logging.info(f"{args.nCases} synthetic case(s) generated in {time.perf_counter() - t0:.1f} s")
+        results = runBenchmarks(data_dir, args.repeats, args.evalRepeats, args.jobs, args.skip)
+
+    timestamp = datetime.now()
+    report = {
+        "version": BENCHMARK_RESULTS_VERSION,
+        "timestamp": timestamp.isoformat(timespec="seconds"),
+        "git_commit": gitCommit(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+                    "numpy": np.__version__, "vtk": vtk.vtkVersion.GetVTKVersion()},
+        "cases": case_settings,
+        "results": results,
+    }
+    out_path = Path(args.out) if args.out is not None else Path(f"benchmark_{timestamp.strftime('%Y%m%d_%H%M%S')}.json")
+    out_path.write_text(json.dumps(report, indent=1))
+    logging.info(f"Results saved at {out_path}")
+
+    if args.compare is not None:
+        regressions = compareResults(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if regressions:
+            logging.error(f"{len(regressions)} regression(s): {regressions}")
+            sys.exit(1)
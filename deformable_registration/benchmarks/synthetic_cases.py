@@ -0,0 +1,262 @@
+from pathlib import Path
+import sys
+import os
+import json
+import argparse
+import logging
+
+import numpy as np
+import vtk
+from scipy.spatial import ConvexHull, Delaunay, cKDTree
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray, vtk_to_numpy
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "TumorResectionGuidance"))
+from mesh_transform import similarityMatrix
+from point_set_registration import transformPoints
+from vtk_points_io import simpleVTKPolyDataPointsWriter
+
+# Written in every synthetic case: the transform the intraop data was made with and the sizes
+GROUND_TRUTH_FILE_NAME = "ground_truth.json"
+SPECIMEN_RADIUS_MM = 40.0
+# Semi-axes of the specimen relative to SPECIMEN_RADIUS_MM; a near-spherical specimen
+# would be the degenerate case of surface registration (rotations about its center)
+SPECIMEN_AXES = (1.0, 0.7, 0.45)
+
+
+def randomRotation(rng, max_angle_deg):
+    # Rotation about a random axis by up to max_angle_deg (Rodrigues)
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+    angle = np.deg2rad(rng.uniform(-max_angle_deg, max_angle_deg))
+    K = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * K + (1 - np.cos(angle)) * K @ K
+
+
+def specimenSurface(n_vertices, rng, radius_mm=SPECIMEN_RADIUS_MM):
+    """
+    Closed, bumpy, ellipsoidal triangle surface of n_vertices vertices, in mm.
+
+    The vertices start evenly spread on a sphere (Fibonacci lattice) and its convex
+    hull gives near-equilateral triangles, without the clustered poles of a
+    latitude-longitude sphere.
+
+    Returns:
+        vtkPolyData
+    """
+    n_vertices = max(n_vertices, 8)
+    z = 1 - (2 * np.arange(n_vertices) + 1) / n_vertices
+    azimuth = np.pi * (3 - np.sqrt(5)) * np.arange(n_vertices)
+    directions = np.stack([np.sqrt(1 - z ** 2) * np.cos(azimuth), np.sqrt(1 - z ** 2) * np.sin(azimuth), z], axis=1)
+    triangles = ConvexHull(directions).simplices
+    # Outward-facing triangles, as the hull's are not consistently ordered
+    a, b, c = (directions[triangles[:, i]] for i in range(3))
+    inward = np.einsum("ij,ij->i", np.cross(b - a, c - a), a + b + c) < 0
+    triangles[inward] = triangles[inward][:, [0, 2, 1]]
+
+    # A few low-frequency bumps on an ellipsoid, so that no rotation leaves the surface unchanged
+    bumps = rng.normal(size=(4, 3))
+    bumps /= np.linalg.norm(bumps, axis=1, keepdims=True)
+    radial = 1 + 0.15 * np.exp(-4 * (1 - directions @ bumps.T)).sum(axis=1)
+    points = radius_mm * directions * radial[:, None] * np.asarray(SPECIMEN_AXES)
+
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points.astype(np.float32), deep=True))
+    polys = vtk.vtkCellArray()
+    offsets = np.arange(0, 3 * len(triangles) + 1, 3, dtype=np.int64)
+    polys.SetData(numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_to_vtkIdTypeArray(triangles.astype(np.int64).ravel(), deep=True))
+    surface = vtk.vtkPolyData()
+    surface.SetPoints(vtk_points)
+    surface.SetPolys(polys)
+    return surface
+
+
+def enclosedPoints(surface, points):
+    """Boolean mask of the points (same units as the closed surface) inside it."""
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points, dtype=np.float64), deep=True))
+    cloud = vtk.vtkPolyData()
+    cloud.SetPoints(vtk_points)
+    select = vtk.vtkSelectEnclosedPoints()
+    select.SetInputData(cloud)
+    select.SetSurfaceData(surface)
+    select.Update()
+    return vtk_to_numpy(select.GetOutput().GetPointData().GetArray("SelectedPoints")).astype(bool)
+
+
+def tetQuality(nodes, tets):
+    """Volume of each tetrahedron over that of a regular one with the same RMS edge length: 1 regular, ~0 sliver (signed)."""
+    a, b, c, d = (nodes[tets[:, i]] for i in range(4))
+    volume = np.einsum("ij,ij->i", b - a, np.cross(c - a, d - a)) / 6
+    edges = np.stack([b - a, c - a, d - a, c - b, d - b, d - c], axis=1)
+    rms_edge = np.sqrt(np.mean(np.einsum("nij,nij->ni", edges, edges), axis=1))
+    return 6 * np.sqrt(2) * volume / rms_edge ** 3
+
+
+def tetrahedralMesh(surface_mm, seed=0, min_quality=0.1):
+    """
+    Tetrahedral FE mesh of the closed surface, in m.
+
+    The nodes are the surface's points plus interior nodes on a jittered body-centered
+    cubic lattice, at twice the surface's edge length and kept half a lattice step away
+    from it, so that the Delaunay tetrahedra are well shaped instead of slivers spanning
+    the specimen. Tetrahedra of the convex hull outside the surface are dropped, and
+    flat ones (tetQuality below min_quality) made of surface points alone are peeled off
+    the boundary.
+    """
+    surface_points = vtk_to_numpy(surface_mm.GetPoints().GetData()).astype(np.float64)
+    edges = vtk.vtkExtractEdges()
+    edges.SetInputData(surface_mm)
+    edges.Update()
+    lines = vtk_to_numpy(edges.GetOutput().GetLines().GetConnectivityArray()).reshape(-1, 2)
+    edge_points = vtk_to_numpy(edges.GetOutput().GetPoints().GetData()).astype(np.float64)
+    spacing = 2 * np.median(np.linalg.norm(edge_points[lines[:, 0]] - edge_points[lines[:, 1]], axis=1))
+
+    lo, hi = surface_points.min(axis=0), surface_points.max(axis=0)
+    grid = np.stack(np.meshgrid(*(np.arange(l, h, spacing) for l, h in zip(lo, hi)), indexing="ij"), axis=-1).reshape(-1, 3)
+    grid = np.vstack([grid, grid + spacing / 2])
+    grid += np.random.default_rng(seed).uniform(-0.1, 0.1, grid.shape) * spacing
+    clearance, _ = cKDTree(surface_points).query(grid)
+    grid = grid[clearance > 0.5 * spacing]
+    nodes = np.vstack([surface_points, grid[enclosedPoints(surface_mm, grid)]])
+
+    tets = Delaunay(nodes).simplices
+    tets = tets[enclosedPoints(surface_mm, nodes[tets].mean(axis=1))]
+    quality = tetQuality(nodes, tets)
+    flipped = quality < 0
+    tets[flipped] = tets[flipped][:, [0, 2, 1, 3]]
+    quality = np.abs(quality)
+    # Peel flat tetrahedra with a face on the boundary until none is left; buried ones stay
+    # rather than leave a void
+    peelable = (tets < len(surface_points)).all(axis=1) & (quality < min_quality)
+    while peelable.any():
+        faces = np.sort(tets[:, [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]], axis=2).astype(np.int64)
+        face_keys = (faces[..., 0] * len(nodes) + faces[..., 1]) * len(nodes) + faces[..., 2]
+        _, face_ids, face_counts = np.unique(face_keys.ravel(), return_inverse=True, return_counts=True)
+        on_boundary = (face_counts[face_ids.reshape(-1, 4)] == 1).any(axis=1)
+        peel = peelable & on_boundary
+        if not peel.any():
+            break
+        tets, peelable = tets[~peel], peelable[~peel]
+
+    points_m = vtk.vtkPoints()
+    points_m.SetData(numpy_to_vtk(nodes * 0.001, deep=True))
+    cells = vtk.vtkCellArray()
+    offsets = np.arange(0, 4 * len(tets) + 1, 4, dtype=np.int64)
+    cells.SetData(numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_to_vtkIdTypeArray(tets.astype(np.int64).ravel(), deep=True))
+    mesh = vtk.vtkUnstructuredGrid()
+    mesh.SetPoints(points_m)
+    mesh.SetCells(vtk.VTK_TETRA, cells)
+    return mesh
+
+
+def sampleSurface(surface_mm, n_points, rng):
+    """n_points points drawn uniformly (by area) on the triangles of the surface, in mm."""
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(surface_mm)
+    triangles.Update()
+    points = vtk_to_numpy(triangles.GetOutput().GetPoints().GetData()).astype(np.float64)
+    faces = vtk_to_numpy(triangles.GetOutput().GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    a, b, c = points[faces[:, 0]], points[faces[:, 1]], points[faces[:, 2]]
+    areas = 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1)
+    picks = rng.choice(len(faces), size=n_points, p=areas / areas.sum())
+    u, v = rng.random((2, n_points))
+    flip = u + v > 1
+    u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+    return a[picks] + u[:, None] * (b[picks] - a[picks]) + v[:, None] * (c[picks] - a[picks])
+
+
+def writeVTK(data, file_name):
+    writer = vtk.vtkUnstructuredGridWriter() if isinstance(data, vtk.vtkUnstructuredGrid) else vtk.vtkPolyDataWriter()
+    writer.SetFileName(str(file_name))
+    writer.SetInputData(data)
+    writer.Write()
+
+
+def makeSyntheticCase(root, case_id, n_mesh_vertices=20_000, n_cloud_points=100_000, n_fids=6,
+                      fle_mm=0.5, cloud_noise_mm=0.3, tet_mesh=True, seed=None):
+    """
+    Write a synthetic Pt_XXXXXXX case with the files of a real one and a known ground truth.
+
+    The intraoperative data is the preoperative specimen moved by a known rigid
+    transform intraop_T_preop, plus Gaussian noise: the fiducials with fle_mm per axis
+    (fiducial localization error), the sparse surface cloud with cloud_noise_mm.
+
+    Files (ids as in the real cases, <id> = case_id:04d, 1<id> = 1case_id:03d):
+        PreOperative/<id>_bel.vtk (mm), <id>_mesh.vtk (m, tetrahedra, if tet_mesh),
+            <id>_fids.vtk (m), <id>_fids_mm.vtk and <id>_tgt_mm.vtk (mm)
+        IntraOperative/1<id>_fids.vtk and 1<id>_sparsedata.vtk (m); the
+            *_transformed files are left to the tumorProcessingWTarget step, as in a
+            fresh real case
+        ground_truth.json: intraop_T_preop (m) and the generation settings
+
+    Returns:
+        Path: the case directory
+    """
+    rng = np.random.default_rng(case_id if seed is None else seed)
+    case_dir = Path(root) / f"Pt_{case_id:07d}"
+    preop_dir = case_dir / "PreOperative"
+    intraop_dir = case_dir / "IntraOperative"
+    os.makedirs(preop_dir, exist_ok=True)
+    os.makedirs(intraop_dir, exist_ok=True)
+
+    surface = specimenSurface(n_mesh_vertices, rng)
+    writeVTK(surface, preop_dir / f"{case_id:04d}_bel.vtk")
+    if tet_mesh:
+        writeVTK(tetrahedralMesh(surface), preop_dir / f"{case_id:04d}_mesh.vtk")
+
+    intraop_T_preop = similarityMatrix(randomRotation(rng, 20), rng.uniform(-0.02, 0.02, 3))
+    preop_fids = sampleSurface(surface, n_fids, rng) * 0.001 # m
+    intraop_fids = transformPoints(intraop_T_preop, preop_fids) + rng.normal(0, fle_mm * 0.001, preop_fids.shape)
+    simpleVTKPolyDataPointsWriter(preop_dir / f"{case_id:04d}_fids.vtk", preop_fids)
+    simpleVTKPolyDataPointsWriter(preop_dir / f"{case_id:04d}_fids_mm.vtk", preop_fids * 1000)
+    simpleVTKPolyDataPointsWriter(preop_dir / f"{case_id:04d}_tgt_mm.vtk", preop_fids[:1] * 1000)
+    simpleVTKPolyDataPointsWriter(intraop_dir / f"1{case_id:03d}_fids.vtk", intraop_fids)
+
+    cloud = sampleSurface(surface, n_cloud_points, rng) * 0.001 # m
+    cloud = transformPoints(intraop_T_preop, cloud) + rng.normal(0, cloud_noise_mm * 0.001, cloud.shape)
+    simpleVTKPolyDataPointsWriter(intraop_dir / f"1{case_id:03d}_sparsedata.vtk", cloud)
+
+    ground_truth = {"case_id": case_id, "intraop_T_preop": intraop_T_preop.tolist(), "units": "m",
+                    "n_mesh_vertices": surface.GetNumberOfPoints(), "n_cloud_points": n_cloud_points, "n_fids": n_fids,
+                    "fle_mm": fle_mm, "cloud_noise_mm": cloud_noise_mm}
+    (case_dir / GROUND_TRUTH_FILE_NAME).write_text(json.dumps(ground_truth, indent=1))
+    return case_dir
+
+
+def makeSyntheticCases(root, n_cases=2, first_case_id=1, **kwargs):
+    """
+    Write n_cases synthetic cases (see makeSyntheticCase) and a pipe_directories.txt
+    under root, laid out like the --DataBasePath of evalAllTRE3FidsOrScaling.py.
+
+    Returns:
+        list of Path: the case directories
+    """
+    os.makedirs(root, exist_ok=True)
+    pipe_directories = Path(root) / "pipe_directories.txt"
+    if not os.path.exists(pipe_directories):
+        pipe_directories.write_text(f'BASEDIR="{Path(__file__).resolve().parent.parent / "TumorResectionGuidance"}"\n')
+    return [makeSyntheticCase(root, case_id, **kwargs) for case_id in range(first_case_id, first_case_id + n_cases)]
+
+
+def loadGroundTruth(case_dir):
+    ground_truth = json.loads((Path(case_dir) / GROUND_TRUTH_FILE_NAME).read_text())
+    ground_truth["intraop_T_preop"] = np.array(ground_truth["intraop_T_preop"])
+    return ground_truth
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Generate synthetic Pt_XXXXXXX cases with known ground-truth transforms")
+    parser.add_argument("outputPath", type=str, help="Where the cases (and pipe_directories.txt) are written")
+    parser.add_argument("--nCases", type=int, default=2)
+    parser.add_argument("--firstCaseId", type=int, default=1)
+    parser.add_argument("--nMeshVertices", type=int, default=20_000, help="Vertices of the bel surface (mm)")
+    parser.add_argument("--nCloudPoints", type=int, default=100_000, help="Points of the intraop sparse data cloud")
+    parser.add_argument("--nFids", type=int, default=6)
+    parser.add_argument("--fleMM", type=float, default=0.5, help="Fiducial localization noise (mm, per axis)")
+    parser.add_argument("--noTetMesh", action="store_true", help="Skip the tetrahedral <id>_mesh.vtk")
+    args = parser.parse_args()
+
+    case_dirs = makeSyntheticCases(args.outputPath, args.nCases, args.firstCaseId, n_mesh_vertices=args.nMeshVertices,
+                                   n_cloud_points=args.nCloudPoints, n_fids=args.nFids, fle_mm=args.fleMM, tet_mesh=not args.noTetMesh)
+    logging.info(f"{len(case_dirs)} synthetic case(s) written to {args.outputPath}")
@@ -1,10 +1,16 @@
+from pathlib import Path
+import sys
 import numpy as np
 import vtk
 import open3d as o3d
 import os
 import pyzed.sl as sl
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / "TumorResectionGuidance"))
+from stage_trace import stage, traced
 
+
+@traced()
 def save_data(
     cam,
     dense_point_cloud,
@@ -35,7 +41,8 @@ def save_data(
     """
 
     # get XYZRGBA data from the ZED camera
-    cam.retrieve_measure(dense_point_cloud, sl.MEASURE.XYZRGBA, sl.MEM.CPU, image_size_dense)
+    with stage("retrieve_measure", file_name=file_name):
+        cam.retrieve_measure(dense_point_cloud, sl.MEASURE.XYZRGBA, sl.MEM.CPU, image_size_dense)
     cam_info = cam.get_camera_information().camera_configuration.resolution
     h, w = cam_info.height, cam_info.width
 
@@ -48,55 +55,58 @@ def save_data(
     # concatenate into (h, w, 6)
     xyzrgb = np.concatenate((xyz, rgb), axis=-1)
 
-    roi_points = []
-    for x, y in data_list:
-        if 0 <= x < w and 0 <= y < h:
-            point = xyzrgb[y, x]
-            if np.isfinite(point).all():
-                roi_points.append(point)
-
-    reference_points = []
-    if reference_PC:
-        for x, y in reference_PC:
+    with stage("gather points", file_name=file_name, n_pixels=len(data_list)):
+        roi_points = []
+        for x, y in data_list:
             if 0 <= x < w and 0 <= y < h:
                 point = xyzrgb[y, x]
                 if np.isfinite(point).all():
-                    reference_points.append(point)
+                    roi_points.append(point)
+
+        reference_points = []
+        if reference_PC:
+            for x, y in reference_PC:
+                if 0 <= x < w and 0 <= y < h:
+                    point = xyzrgb[y, x]
+                    if np.isfinite(point).all():
+                        reference_points.append(point)
 
-    roi_points = np.array(roi_points)
-    reference_points = np.array(reference_points)
+        roi_points = np.array(roi_points)
+        reference_points = np.array(reference_points)
 
     # convert to vtk structures
-    vtk_points = vtk.vtkPoints()
-    vertices = vtk.vtkCellArray()
-    vtk_colors = vtk.vtkUnsignedCharArray()
-    vtk_colors.SetNumberOfComponents(3)
-    vtk_colors.SetName("Colors")
-
-    # insert points into vtk structure
-    for point in roi_points:
-        x, y, z = point[:3]
-        r, g, b = point[3:6]
-        pid = vtk_points.InsertNextPoint(x, y, z)
-        vtk_colors.InsertNextTuple3(int(r), int(g), int(b))
-        vertices.InsertNextCell(1)
-        vertices.InsertCellPoint(pid)
-
-    # optionally visualize with open3d
+    with stage("vtk structures", file_name=file_name, n_points=len(roi_points)):
+        vtk_points = vtk.vtkPoints()
+        vertices = vtk.vtkCellArray()
+        vtk_colors = vtk.vtkUnsignedCharArray()
+        vtk_colors.SetNumberOfComponents(3)
+        vtk_colors.SetName("Colors")
+
+        # insert points into vtk structure
+        for point in roi_points:
+            x, y, z = point[:3]
+            r, g, b = point[3:6]
+            pid = vtk_points.InsertNextPoint(x, y, z)
+            vtk_colors.InsertNextTuple3(int(r), int(g), int(b))
+            vertices.InsertNextCell(1)
+            vertices.InsertCellPoint(pid)
+
+    # optionally visualize with open3d (its wall time is mostly the user looking at it)
     if file_name in {"fids", "SAM", "tgt", "arUco"}:
         pcd_fids = o3d.geometry.PointCloud()
         roi_xyz = roi_points[:, 0:3]
         pcd_fids.points = o3d.utility.Vector3dVector(roi_xyz)
         pcd_fids.colors = o3d.utility.Vector3dVector(np.tile([1, 0, 0], (len(roi_xyz), 1)))  # red
 
-        if file_name != "SAM":
-            pcd_target = o3d.geometry.PointCloud()
-            target_xyz = reference_points[:, 0:3]
-            pcd_target.points = o3d.utility.Vector3dVector(target_xyz)
-            pcd_target.colors = o3d.utility.Vector3dVector(np.tile([0, 0, 1], (len(target_xyz), 1)))  # blue
-            o3d.visualization.draw_geometries([pcd_fids, pcd_target])
-        else:
-            o3d.visualization.draw_geometries([pcd_fids])
+        with stage("open3d preview", file_name=file_name):
+            if file_name != "SAM":
+                pcd_target = o3d.geometry.PointCloud()
+                target_xyz = reference_points[:, 0:3]
+                pcd_target.points = o3d.utility.Vector3dVector(target_xyz)
+                pcd_target.colors = o3d.utility.Vector3dVector(np.tile([0, 0, 1], (len(target_xyz), 1)))  # blue
+                o3d.visualization.draw_geometries([pcd_fids, pcd_target])
+            else:
+                o3d.visualization.draw_geometries([pcd_fids])
 
         print(f"Visualized {len(roi_xyz)} points.")
         if_select = input("Re-Select? (T/F) ")
@@ -118,10 +128,11 @@ def save_data(
 
     vtk_path = os.path.join(dir_path, f"frame{frame_id:04d}_{file_name}.vtk")
 
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(vtk_path)
-    writer.SetInputData(polydata)
-    writer.Write()
+    with stage("vtk write", file_name=file_name):
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileName(vtk_path)
+        writer.SetInputData(polydata)
+        writer.Write()
     print(f"Saved frame {frame_id:04d} to {vtk_path}")
     return True
 
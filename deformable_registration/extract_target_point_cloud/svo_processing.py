@@ -1,11 +1,17 @@
+from pathlib import Path
 import os
+import sys
 import pyzed.sl as sl
 import cv2
 from segment_anything import sam_model_registry, SamPredictor
 from gui_utils import BoundingBoxGUI, SegmentAnythingGUI
 from data_processing import selectPointsBorder, save_data
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / "TumorResectionGuidance"))
+from stage_trace import stage, traced
 
+
+@traced()
 def process_svo(filepath, frame_id):
     """
     Process a single frame from the given SVO file:
@@ -15,6 +21,8 @@ def process_svo(filepath, frame_id):
     - Let user select fiducials, targets, borders, and arUco markers
     - Save point clouds and segmentation results as VTK files
 
+    Every step is a stage of the trace when tracing is on (STAGE_TRACE=trace.json).
+
     Args:
         filepath (str): path to the .svo file
         frame_id (int): frame index to process
@@ -29,7 +37,8 @@ def process_svo(filepath, frame_id):
                              depth_mode=sl.DEPTH_MODE.NEURAL,
                              coordinate_units=sl.UNIT.METER)
     cam = sl.Camera()
-    status = cam.open(init)
+    with stage("open svo"):
+        status = cam.open(init)
     if status != sl.ERROR_CODE.SUCCESS:
         print(f"Failed to open camera: {repr(status)}")
         exit()
@@ -49,17 +58,21 @@ def process_svo(filepath, frame_id):
     mat = sl.Mat()
 
     # Set SVO frame position and grab frame
-    cam.set_svo_position(frame_id)
-    if cam.grab(runtime) != sl.ERROR_CODE.SUCCESS:
+    with stage("grab frame", frame_id=frame_id):
+        cam.set_svo_position(frame_id)
+        grabbed = cam.grab(runtime)
+    if grabbed != sl.ERROR_CODE.SUCCESS:
         print(f"Failed to grab frame {frame_id}")
         cam.close()
         return
 
-    cam.retrieve_image(mat, sl.VIEW.LEFT)
+    with stage("retrieve_image"):
+        cam.retrieve_image(mat, sl.VIEW.LEFT)
 
     # Show GUI for user to select ROI bounding box
-    selectRegionGUI = BoundingBoxGUI(mat.get_data())
-    selectRegionGUI.run()
+    with stage("select ROI"):
+        selectRegionGUI = BoundingBoxGUI(mat.get_data())
+        selectRegionGUI.run()
     if not selectRegionGUI.bboxes:
         print("No bounding box selected. Exiting.")
         cam.close()
@@ -68,12 +81,13 @@ def process_svo(filepath, frame_id):
 
     # Create and set mask ROI in the camera
     print("Setting region of interest mask in the camera")
-    img_mask = sl.Mat(image_size_dense.width, image_size_dense.height, sl.MAT_TYPE.U8_C1)
-    img_mask.set_to(0)
-    for i in range(selectRegionROI[0], selectRegionROI[0] + selectRegionROI[2]):
-        for j in range(selectRegionROI[1], selectRegionROI[1] + selectRegionROI[3]):
-            img_mask.set_value(i, j, 1)
-    cam.set_region_of_interest(img_mask)
+    with stage("ROI mask"):
+        img_mask = sl.Mat(image_size_dense.width, image_size_dense.height, sl.MAT_TYPE.U8_C1)
+        img_mask.set_to(0)
+        for i in range(selectRegionROI[0], selectRegionROI[0] + selectRegionROI[2]):
+            for j in range(selectRegionROI[1], selectRegionROI[1] + selectRegionROI[3]):
+                img_mask.set_value(i, j, 1)
+        cam.set_region_of_interest(img_mask)
 
     # Crop the image to the selected ROI
     img_crop = mat.get_data()[selectRegionROI[1]:selectRegionROI[1] + selectRegionROI[3],
@@ -90,9 +104,11 @@ def process_svo(filepath, frame_id):
             if not os.path.exists(sam_checkpoint):
                 raise FileNotFoundError(f"SAM model checkpoint not found at {sam_checkpoint}. Please download it.")
 
-            sam_model = sam_model_registry["vit_h"](checkpoint=sam_checkpoint)
-            sam_gui = SegmentAnythingGUI(mat.get_data(), sam_model)
-            sam_gui.run()
+            with stage("SAM model load"):
+                sam_model = sam_model_registry["vit_h"](checkpoint=sam_checkpoint)
+            with stage("SAM segmentation"):
+                sam_gui = SegmentAnythingGUI(mat.get_data(), sam_model)
+                sam_gui.run()
 
             # Save the segmentation mask points
             reSelect_sam = save_data(cam, dense_point_cloud, image_size_dense,
@@ -103,41 +119,46 @@ def process_svo(filepath, frame_id):
     if ifSelectFids == "T":
         reSelect = False
         while not reSelect:
-            reSelect = selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
-                                         image_size_dense, filepath, "fids", frame_id,
-                                         sam_gui.mask_coordinates if sam_gui else [])
+            with stage("select fids"):
+                reSelect = selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
+                                             image_size_dense, filepath, "fids", frame_id,
+                                             sam_gui.mask_coordinates if sam_gui else [])
 
     # Select target points interactively
     ifSelectTgts = input("Select target points? (T/F) ").upper()
     if ifSelectTgts == "T":
         reSelect = False
         while not reSelect:
-            reSelect = selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
-                                         image_size_dense, filepath, "tgt", frame_id,
-                                         sam_gui.mask_coordinates if sam_gui else [])
+            with stage("select targets"):
+                reSelect = selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
+                                             image_size_dense, filepath, "tgt", frame_id,
+                                             sam_gui.mask_coordinates if sam_gui else [])
 
     # Select border points interactively
     ifSelectBorder = input("Select border? (T/F) ").upper()
     if ifSelectBorder == "T":
-        selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
-                           image_size_dense, filepath, "border", frame_id)
+        with stage("select border"):
+            selectPointsBorder(img_crop, cam, selectRegionROI, dense_point_cloud,
+                               image_size_dense, filepath, "border", frame_id)
 
     # Select arUco fiducial points interactively
     ifSelectAfids = input("Select arUco fiducials? (T/F) ").upper()
     if ifSelectAfids == "T":
         reSelect = False
         while not reSelect:
-            reSelect = selectPointsBorder(mat.get_data(), cam, selectRegionROI, dense_point_cloud,
-                                         image_size_dense, filepath, "arUco", frame_id,
-                                         sam_gui.mask_coordinates if sam_gui else [])
+            with stage("select arUco"):
+                reSelect = selectPointsBorder(mat.get_data(), cam, selectRegionROI, dense_point_cloud,
+                                             image_size_dense, filepath, "arUco", frame_id,
+                                             sam_gui.mask_coordinates if sam_gui else [])
 
     # Save the whole ROI point cloud
-    roi_list = []
-    for i in range(selectRegionROI[0], selectRegionROI[0] + selectRegionROI[2]):
-        for j in range(selectRegionROI[1], selectRegionROI[1] + selectRegionROI[3]):
-            roi_list.append((i, j))
+    with stage("save ROI point cloud"):
+        roi_list = []
+        for i in range(selectRegionROI[0], selectRegionROI[0] + selectRegionROI[2]):
+            for j in range(selectRegionROI[1], selectRegionROI[1] + selectRegionROI[3]):
+                roi_list.append((i, j))
 
-    save_data(cam, dense_point_cloud, image_size_dense, roi_list, filepath, frame_id, "PC")
+        save_data(cam, dense_point_cloud, image_size_dense, roi_list, filepath, frame_id, "PC")
 
     cam.close()
 
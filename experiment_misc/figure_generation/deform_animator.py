@@ -8,8 +8,8 @@ import vtk
 from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 import time
 
-sys.path.append("../../visual_guidance/blender_integration")
-from utils import loadMeshFile, loadMeshFileAndWriteAsPLY
+sys.path.append(str(Path(__file__).resolve().parents[2] / "deformable_registration" / "TumorResectionGuidance"))
+from case_bundle import openCase
 
 def get_lerped_pts_polydata(init_polydata:vtk.vtkPolyData, fin_polydata:vtk.vtkPolyData, alpha:float, output_polydata=None):
     np_lerped_pts = get_lerped_pts_vtk(init_polydata.GetPoints(), fin_polydata.GetPoints(), alpha)
@@ -110,36 +110,24 @@ class TimerCB:
 if __name__ == "__main__":
 
     #------------------------------- Specimen Data -------------------------------#
-    bel_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_bel.vtk")
-    bel_deformed_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_bel_deformed_initial.vtk")
-    
-    bel_mesh = loadMeshFile(bel_path)
-    bel_deformed_mesh = loadMeshFile(bel_deformed_path)
+    # A case directory, or a case packed with case_bundle.py (e.g. Pt_0000013.npz)
+    case = openCase(Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data"), case_id=13)
 
-    displacement_field_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_displacement.out")
-    displacements = np.genfromtxt(displacement_field_path, delimiter=" ")
+    bel_mesh = case.polydata("0013_bel.vtk")
+    bel_deformed_mesh = case.polydata("0013_bel_deformed_initial.vtk")
 
-    tgt_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_tgt.vtk")
-    tgt_pts = loadMeshFile(tgt_path)
-    
-    tgt_deformed_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\1013_tgt_transformed.vtk")
-    tgt_deformed_pts = loadMeshFile(tgt_deformed_path)
+    displacements = case.table("0013_displacement.out")
 
-    fids_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_fids.vtk")
-    fids_pts = loadMeshFile(fids_path)
+    tgt_pts = case.polydata("0013_tgt.vtk")
+    tgt_deformed_pts = case.polydata("1013_tgt_transformed.vtk")
 
-    fids_deformed_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\0013_fids_Deformed.vtk")
-    fids_deformed_pts = loadMeshFile(fids_deformed_path)
+    fids_pts = case.polydata("0013_fids.vtk")
+    fids_deformed_pts = case.polydata("0013_fids_Deformed.vtk")
 
     #------------------------------- Point Cloud Data -------------------------------#
-    pc_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\1013_sparsedata_transformed.vtk")
-    bed_pc = loadMeshFile(pc_path)
-
-    bed_fids_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\1013_fids_transformed.vtk")
-    bed_fids = loadMeshFile(bed_fids_path)
-
-    bed_tgt_path = Path(r"d:\Projects\Head_Neck_Marker_Alignment\data\miccai_2025_data\1013_tgt_transformed.vtk")
-    bed_tgt = loadMeshFile(bed_tgt_path)
+    bed_pc = case.polydata("1013_sparsedata_transformed.vtk")
+    bed_fids = case.polydata("1013_fids_transformed.vtk")
+    bed_tgt = case.polydata("1013_tgt_transformed.vtk")
 
 
     cb = TimerCB(
@@ -1,11 +1,21 @@
 from pathlib import Path
 import argparse
+import sys
 
 from scipy.spatial.transform import Rotation as R
 import numpy as np
 import vtk
 import mathutils
+
+# case_bundle, point_set_registration and stage_trace; checked first as main.py reloads this module
+TUMOR_RESECTION_DIR = str(Path(__file__).resolve().parents[2] / "deformable_registration" / "TumorResectionGuidance")
+if TUMOR_RESECTION_DIR not in sys.path:
+    sys.path.append(TUMOR_RESECTION_DIR)
 from utils import *
+from case_bundle import openCase
+from point_set_registration import registerPointSets, robustRegisterPointSets
+from frame_graph import FrameGraph
+from stage_trace import stage, traced
 
 def transform_obj(obj, euler_rot, translation):
     translation = np.array(translation)
@@ -20,39 +30,26 @@ def transform_obj(obj, euler_rot, translation):
     obj.location = mathutils.Vector(translation.tolist())
     obj.rotation_euler = euler
 
+def transform_obj_matrix(obj, T):
+    # Sets the full pose from a 4x4 matrix, without the Euler round trip of transform_obj
+    obj.matrix_world = mathutils.Matrix(np.asarray(T).tolist())
+
 
 # Arun's method
 def ptSetRegATB(a, b):
     # Produces a_T_b
-    a_avg = np.mean(b, axis = 0)
-    b_avg = np.mean(a, axis = 0)
-    H = np.array([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]).reshape([3,3])
-    # find H using a and b as described in Arun's method
-    for i in range(len(b)):
-        diff_a = np.subtract(b[i], a_avg).reshape([3,1])
-        diff_b = np.subtract(a[i], b_avg).reshape([1,3])
-        H = np.add(H, np.matmul(diff_a, diff_b))
-    # compute single value decomposition
-    u, s, vh = np.linalg.svd(H)
-    # compute R
-    R = np.matmul(vh.T, u.T)
-    # verify the determinant of R
-    det_R = np.linalg.det(R)
-    # as detailed in Arun's paper, correcting R if determinant is -1
-    if np.isclose(det_R, -1):
-        v = vh.T
-        v[:,2] = -1 * v[:,2]
-        R = np.matmul(v, u.T)
-        det_R = np.linalg.det(R)
-    if not (np.isclose(det_R, 1)):
-        print("Error: det(R) != 1, algorithm failed.")
-    # find p
-    p = np.subtract(b_avg, np.matmul(R, a_avg))
-
-    T = np.eye(4)
-    T[:3, :3] = R
-    T[:3, 3] = np.reshape(p, (3))
-    return T
+    a_T_b, _ = registerPointSets(b, a)
+    return a_T_b
+
+def ptSetRegATBRobust(a, b, name="", outliers=None):
+    # Same as ptSetRegATB, but mislocalized fiducials in b (or a) are flagged and left out
+    a_T_b, flagged, residuals = robustRegisterPointSets(b, a)
+    if len(flagged) > 0:
+        print(f"WARNING: {name} fiducial(s) {flagged.tolist()} flagged as outliers "
+              f"(residuals {np.round(residuals[flagged] * 1e3, 2).tolist()} mm) and left out of the registration")
+    if outliers is not None:
+        outliers[name] = flagged.tolist()
+    return a_T_b
 
 def rvec_tvec_to_mat(rvec, tvec):
     outMat = np.eye(4)
@@ -71,80 +68,115 @@ def matToEulerTvec(matT):
     rEuler = R.from_rotvec(rvec).as_euler("xyz", degrees=True)
     return rEuler, tvec
 
-def main(bedFidsPath, specimenFidsPath=None, undeformedFidsPath=None, targPath=None, gtPath=None):
+@traced()
+def loadFidPoints(fidsRef, case=None):
+    # fidsRef is a file path, or an artifact name (role, key or suffix) when a case is given
+    if case is not None:
+        return np.array(case.points(fidsRef))
+    return VTKObjToNPPoints(loadMeshFile(fidsRef))
+
+# Kept alive across Blender re-runs of main.py: transforms are only recomputed when
+# their fiducial files change. main.py reloads this module, which re-executes it in the
+# same namespace, so the existing instances are reused instead of rebuilt.
+FRAME_GRAPH = globals().get("FRAME_GRAPH")
+if FRAME_GRAPH is None:
+    FRAME_GRAPH = FrameGraph()
+FRAME_OUTLIERS = globals().get("FRAME_OUTLIERS")
+if FRAME_OUTLIERS is None:
+    FRAME_OUTLIERS = {} # edge name -> outlier indices found when the edge was last built
+
+ArucoFids = np.array([
+    [-0.01, 0.01, 0], # Top Left
+    [0.01, 0.01, 0], # Top Right
+    [0.01, -0.01, 0], # Bottom Right
+    [-0.01, -0.01, 0], # Bottom Left
+])
+
+def fidsSource(fidsRef, case=None):
+    # File whose changes invalidate the transforms computed from fidsRef
+    if case is None:
+        return fidsRef
+    if hasattr(case, "path"):
+        return case.path(fidsRef)
+    return case.path_on_disk
+
+def printTransform(name, T):
+    rEuler, tvec = matToEulerTvec(T)
+    print(f"{name}. Euler: {rEuler}, tvec: {tvec}")
+    return [rEuler, tvec]
+
+@traced("ModelAlignerV5.main")
+def main(bedFidsPath, specimenFidsPath=None, undeformedFidsPath=None, targPath=None, gtPath=None, case=None, robust=True, graph=None):
+    # case: optional CaseBundle/CaseDirectory (see case_bundle.openCase); the *Path
+    # arguments are then artifact names inside that case instead of file paths.
+    # robust: flag outlier fiducials (reported in outputData["outliers"]) and register without them
+    # graph: FrameGraph to declare the frames in, FRAME_GRAPH by default
+    # Traced (stage_trace) when Blender runs with STAGE_TRACE=trace.json
+    graph = FRAME_GRAPH if graph is None else graph
     outputData = {}
+    outputData["outliers"] = {}
+    outputData["matrices"] = {}
+    def solver(name):
+        def register(a, b):
+            if not robust:
+                FRAME_OUTLIERS[name] = []
+                return ptSetRegATB(a, b)
+            outliers = {}
+            a_T_b = ptSetRegATBRobust(a, b, name, outliers)
+            FRAME_OUTLIERS[name] = outliers[name]
+            return a_T_b
+        return register
+    def declare(a, b, a_points, b_points, sources):
+        name = f"{a}_T_{b}"
+        with stage(f"declare {name}"):
+            graph.addFiducialEdge(a, b, a_points, b_points, solver(name), sources=[fidsSource(f, case) for f in sources], key=robust)
+            T = graph.transform(a, b)
+        outputData["outliers"][name] = FRAME_OUTLIERS.get(name, [])
+        return T
     ## Step 1. Bed to Aruco
     # Load VTK fids
-    bedFidsVTKObj = loadMeshFile(bedFidsPath)
-    bedFids = VTKObjToNPPoints(bedFidsVTKObj)
+    bedFids = loadFidPoints(bedFidsPath, case)
     print(f"Surface PC Fids: {bedFids}")
     # deformedFids are in mm, undeformed are in m
     # Blender assumes m, so convert everything to m:
 
-    bedFidsAruco = bedFids[:4, :] # Aruco Corners
-    bedFidsSpecimen = bedFids[4:, :] # Specimen Corners
-
-    ArucoFids = np.array([
-        [-0.01, 0.01, 0], # Top Left
-        [0.01, 0.01, 0], # Top Right
-        [0.01, -0.01, 0], # Bottom Right
-        [-0.01, -0.01, 0], # Bottom Left
-    ])
     # TRANSFORMS
-    aruco_T_bed = ptSetRegATB(ArucoFids, bedFidsAruco)
-    rEuler, tvec = matToEulerTvec(aruco_T_bed)
-    print(f"aruco_T_bed. Euler: {rEuler}, tvec: {tvec}")
-    outputData["aruco_T_bed"] = [rEuler, tvec]
+    # bedFids[:4] are the Aruco corners, bedFids[4:] the specimen corners
+    aruco_T_bed = declare("aruco", "bed", lambda: ArucoFids, lambda: bedFids[:4, :], [bedFidsPath])
+    outputData["aruco_T_bed"] = printTransform("aruco_T_bed", aruco_T_bed)
+    outputData["matrices"]["aruco_T_bed"] = aruco_T_bed
 
     if not specimenFidsPath is None:
         ## Step 2: bed_T_deformed (undeformed_T_deformed, if needed)
-        deformedFidsVTKObj = loadMeshFile(specimenFidsPath) # loadMeshFileGrid
-        deformedFids = VTKObjToNPPoints(deformedFidsVTKObj) # np.array([deformedFidsVTKObj.GetPoint(i) for i in range(deformedFidsVTKObj.GetNumberOfPoints())])
-        deformedFids *= 1e-3    
+        bed_T_deformed = declare("bed", "deformed", lambda: bedFids[4:, :], lambda: loadFidPoints(specimenFidsPath, case) * 1e-3,
+                                 [bedFidsPath, specimenFidsPath])
+        printTransform("bed_T_deformed", bed_T_deformed)
 
-        # undeformedFidsVTKObj = loadMeshFile(undeformedFidsPath)
-        # undeformedFids = VTKObjToNPPoints(undeformedFidsVTKObj) # np.array([undeformedFidsVTKObj.GetPoint(i) for i in range(undeformedFidsVTKObj.GetNumberOfPoints())])
-
-        bed_T_deformed = ptSetRegATB(bedFidsSpecimen, deformedFids) # np.eye(4) # 
-        rEuler, tvec = matToEulerTvec(bed_T_deformed)
-        print(f"bed_T_deformed. Euler: {rEuler}, tvec: {tvec}")
-
-        aruco_T_deformed = aruco_T_bed @ bed_T_deformed
-        rEuler, tvec = matToEulerTvec(aruco_T_deformed)
-        print(f"aruco_T_deformed. Euler: {rEuler}, tvec: {tvec}")
-        outputData["aruco_T_deformed"] = [rEuler, tvec]
+        aruco_T_deformed = graph.transform("aruco", "deformed")
+        outputData["aruco_T_deformed"] = printTransform("aruco_T_deformed", aruco_T_deformed)
+        outputData["matrices"]["aruco_T_deformed"] = aruco_T_deformed
 
     if not undeformedFidsPath is None:
-        undeformedFidsVTKObj = loadMeshFile(specimenFidsPath)
-        undeformedFids = VTKObjToNPPoints(undeformedFidsVTKObj) 
-
-        bed_T_undeformed = ptSetRegATB(bedFidsSpecimen, undeformedFids)
-        rEuler, tvec = matToEulerTvec(bed_T_undeformed)
-        print(f"bed_T_undeformed. Euler: {rEuler}, tvec: {tvec}")
+        bed_T_undeformed = declare("bed", "undeformed", lambda: bedFids[4:, :], lambda: loadFidPoints(undeformedFidsPath, case),
+                                   [bedFidsPath, undeformedFidsPath])
+        printTransform("bed_T_undeformed", bed_T_undeformed)
 
-        aruco_T_undeformed = aruco_T_bed @ bed_T_undeformed
-        rEuler, tvec = matToEulerTvec(aruco_T_undeformed)
-        print(f"aruco_T_undeformed. Euler: {rEuler}, tvec: {tvec}")
-        outputData["aruco_T_undeformed"] = [rEuler, tvec]
+        aruco_T_undeformed = graph.transform("aruco", "undeformed")
+        outputData["aruco_T_undeformed"] = printTransform("aruco_T_undeformed", aruco_T_undeformed)
+        outputData["matrices"]["aruco_T_undeformed"] = aruco_T_undeformed
     
     if not targPath is None:
-        targFidsVTKObj = loadMeshFile(targPath) # loadMeshFileGrid
-        targFids = VTKObjToNPPoints(targFidsVTKObj) # np.array([deformedFidsVTKObj.GetPoint(i) for i in range(deformedFidsVTKObj.GetNumberOfPoints())])
+        targFids = loadFidPoints(targPath, case)
         targFids *= 1e-3
-        targFids4 = np.concatenate([targFids, np.ones([targFids.shape[0], 1])], axis=-1).T
-        
-        targInAruco = (aruco_T_deformed @ targFids4) [:-1, :].T
+        targInAruco = graph.mapPoints(targFids, "deformed", "aruco")
         print(f"\nTarget in Aruco: {targInAruco}")
-        # print((aruco_T_deformed @ targFids4).shape)
         outputData["target_in_aruco"] = [targInAruco]
 
         if not gtPath is None:
-            gtFidsVTKOBj = loadMeshFile(gtPath)
-            gtFids = VTKObjToNPPoints(gtFidsVTKOBj)
-            gtFids4 = np.concatenate([gtFids, np.ones([gtFids.shape[0], 1])], axis=-1).T
-            print(gtFids4)
+            gtFids = loadFidPoints(gtPath, case)
+            print(gtFids)
 
-            gtInAruco = (aruco_T_bed @ gtFids4) [:-1, :].T
+            gtInAruco = graph.mapPoints(gtFids, "bed", "aruco")
 
             Error = np.sqrt(np.sum((gtInAruco - targInAruco) ** 2)) * 1e3
             print(f"nGround truth in Aruco: {gtInAruco}; Error: {Error} mm")
@@ -188,16 +220,25 @@ if __name__ == "__main__":
                     help="undeformed fids path (default: None).")
     parser.add_argument("--gtFidsPath", type=str, default=None,
                     help="undeformed target path (default: None).")
+    parser.add_argument("--noRobust", action="store_true",
+                    help="Use every fiducial as is instead of flagging and leaving out outliers.")
+    parser.add_argument("--caseBundle", type=str, default=None,
+                    help="Packed case (.npz/.h5) or case directory; the other paths are then artifact names in it (default: None).")
     
     args = parser.parse_args()
     
-    modelBasePath = Path(args.basePath)
-    bedFidsPath = modelBasePath / args.bedFidsPath  
-    deformedFidsPath = modelBasePath / args.deformedFidsPath if not args.deformedFidsPath is None else None
-    undeformedFidsPath = modelBasePath / args.undeformedFidsPath if not args.undeformedFidsPath is None else None
-    targFidsPath = modelBasePath / args.targFidsPath if not args.targFidsPath is None else None
-    gtFidsPath = modelBasePath / args.gtFidsPath if not args.gtFidsPath is None else None
-    main(bedFidsPath=bedFidsPath, specimenFidsPath=deformedFidsPath, undeformedFidsPath=undeformedFidsPath, targPath=targFidsPath, gtPath=gtFidsPath)
+    if args.caseBundle is not None:
+        with openCase(args.caseBundle) as case:
+            main(bedFidsPath=args.bedFidsPath, specimenFidsPath=args.deformedFidsPath, undeformedFidsPath=args.undeformedFidsPath,
+                 targPath=args.targFidsPath, gtPath=args.gtFidsPath, case=case, robust=not args.noRobust)
+    else:
+        modelBasePath = Path(args.basePath)
+        bedFidsPath = modelBasePath / args.bedFidsPath  
+        deformedFidsPath = modelBasePath / args.deformedFidsPath if not args.deformedFidsPath is None else None
+        undeformedFidsPath = modelBasePath / args.undeformedFidsPath if not args.undeformedFidsPath is None else None
+        targFidsPath = modelBasePath / args.targFidsPath if not args.targFidsPath is None else None
+        gtFidsPath = modelBasePath / args.gtFidsPath if not args.gtFidsPath is None else None
+        main(bedFidsPath=bedFidsPath, specimenFidsPath=deformedFidsPath, undeformedFidsPath=undeformedFidsPath, targPath=targFidsPath, gtPath=gtFidsPath, robust=not args.noRobust)
    
     # python .\ModelAlignerV4.py --basePath "D:\Projects\Head_Neck_Marker_Alignment\data\EXP\20250205_dry_run" --bedFidsPath frame0004_fids.vtk --deformedFidsPath 0005_fids_mm_Deformed.vtk
     # python .\ModelAlignerV4.py --basePath "D:\Projects\Head_Neck_Marker_Alignment\data\EXP\20250205_dry_run\run0" --bedFidsPath 0005_cav/frame0005_fids.vtk --deformedFidsPath 0005_fids_mm_Deformed.vtk --evalFidsPath 0006_eval/frame0006_fids.vtk
\ No newline at end of file
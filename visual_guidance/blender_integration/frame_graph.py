@@ -0,0 +1,171 @@
+import os
+from collections import deque
+
+import numpy as np
+
+# Frames used by ModelAlignerV5; any other name works too.
+FRAMES = ("aruco", "bed", "deformed", "undeformed", "camera", "preop")
+
+
+def _stamp(file_name):
+    try:
+        st = os.stat(file_name)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def _invertTransform(T):
+    # Rigid/similarity inverse without a general 4x4 inversion
+    inv = np.eye(4)
+    A_inv = np.linalg.inv(T[:3, :3])
+    inv[:3, :3] = A_inv
+    inv[:3, 3] = -A_inv @ T[:3, 3]
+    return inv
+
+
+class _Edge:
+    def __init__(self, builder, sources, key):
+        self.builder = builder
+        self.sources = tuple(str(s) for s in sources)
+        self.key = key
+        self.stamps = None
+        self.T = None
+        self.version = 0
+
+    def refresh(self):
+        # Rebuild when never built or when one of the source files changed
+        stamps = tuple(_stamp(s) for s in self.sources)
+        if self.T is None or stamps != self.stamps:
+            self.T = np.array(self.builder(), dtype=np.float64)
+            self.stamps = stamps
+            self.version += 1
+        return self.version
+
+
+class FrameGraph:
+    """
+    Graph of coordinate frames joined by 4x4 transforms.
+
+    An edge a_T_b maps points from frame b into frame a. Edges are built lazily by a
+    builder (typically a fiducial registration) and rebuilt when one of their source
+    files changes. Transforms between any two connected frames are composed along the
+    shortest path, inverted where edges are walked backwards, and memoized until one
+    of the edges on the path is rebuilt. Keep one graph alive (e.g. at module level
+    in Blender) so that re-running a script with unchanged files recomputes nothing.
+    """
+
+    def __init__(self):
+        self._edges = {}  # (a, b) -> _Edge producing a_T_b
+        self._neighbors = {}
+        self._paths = {}  # (a, b) -> (a_T_b, ((edge, version), ...))
+
+    def addEdge(self, a, b, builder, sources=(), key=None):
+        """
+        Declare a_T_b = builder().
+
+        Re-declaring an edge with the same sources and key keeps its cached transform,
+        so scripts can declare their edges unconditionally on every run.
+
+        Args:
+            a, b (str): frame names
+            builder (callable): returns the (4, 4) transform from b to a
+            sources (iterable of str | Path): files the transform is computed from
+            key (hashable, optional): anything else the builder depends on (e.g. options)
+        """
+        if a == b:
+            raise ValueError(f"Edge from frame '{a}' to itself")
+        existing = self._edges.get((a, b))
+        sources = tuple(str(s) for s in sources)
+        if existing is not None and existing.sources == sources and existing.key == key:
+            existing.builder = builder
+            return
+        self._edges.pop((b, a), None)  # one edge per pair of frames
+        self._edges[(a, b)] = _Edge(builder, sources, key)
+        self._neighbors.setdefault(a, set()).add(b)
+        self._neighbors.setdefault(b, set()).add(a)
+        self._paths.clear()
+
+    def addTransform(self, a, b, a_T_b):
+        """Declare a fixed a_T_b."""
+        a_T_b = np.array(a_T_b, dtype=np.float64)
+        self.addEdge(a, b, lambda: a_T_b, key=a_T_b.tobytes())
+
+    def addFiducialEdge(self, a, b, a_points, b_points, solver, sources=(), key=None):
+        """
+        Declare a_T_b = solver(a_points(), b_points()), e.g. with ptSetRegATB.
+
+        a_points and b_points are callables so that the fiducial files are only read
+        when the edge is (re)built.
+        """
+        self.addEdge(a, b, lambda: solver(a_points(), b_points()), sources, key)
+
+    def frames(self):
+        return sorted(self._neighbors)
+
+    def _path(self, a, b):
+        # Breadth-first search for the shortest chain of frames from a to b
+        previous = {a: None}
+        queue = deque([a])
+        while queue:
+            cur = queue.popleft()
+            if cur == b:
+                break
+            for nxt in sorted(self._neighbors.get(cur, ())):
+                if nxt not in previous:
+                    previous[nxt] = cur
+                    queue.append(nxt)
+        if b not in previous:
+            raise KeyError(f"No chain of transforms from frame '{b}' to frame '{a}'")
+        path = [b]
+        while path[-1] != a:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def transform(self, a, b):
+        """(4, 4) a_T_b, mapping points in frame b into frame a."""
+        if a == b:
+            return np.eye(4)
+        cached = self._paths.get((a, b))
+        if cached is not None:
+            T, edge_versions = cached
+            if all(edge.refresh() == version for edge, version in edge_versions):
+                return T.copy()
+
+        path = self._path(a, b)
+        T = np.eye(4)
+        edge_versions = []
+        for frame_from, frame_to in zip(path[:-1], path[1:]):
+            edge = self._edges.get((frame_from, frame_to))
+            if edge is not None:
+                edge_versions.append((edge, edge.refresh()))
+                T = T @ edge.T
+            else:
+                edge = self._edges[(frame_to, frame_from)]
+                edge_versions.append((edge, edge.refresh()))
+                T = T @ _invertTransform(edge.T)
+        self._paths[(a, b)] = (T, tuple(edge_versions))
+        return T.copy()
+
+    def mapPoints(self, points, from_frame, to_frame):
+        """
+        Map points (or a stack of point sets) from one frame to another in one call.
+
+        Args:
+            points (array-like): (..., N, 3) points in from_frame, e.g. targets, fiducials
+                or the vertices of a whole mesh
+            from_frame, to_frame (str): frame names
+
+        Returns:
+            np.ndarray: (..., N, 3) points in to_frame
+        """
+        T = self.transform(to_frame, from_frame)
+        points = np.asarray(points, dtype=np.float64)
+        return points @ T[:3, :3].T + T[:3, 3]
+
+    def invalidate(self, a=None, b=None):
+        """Force the edge a_T_b (or every edge) to be rebuilt on next use."""
+        for (edge_a, edge_b), edge in self._edges.items():
+            if a is None or {a, b} == {edge_a, edge_b}:
+                edge.T = None
+        self._paths.clear()
@@ -47,7 +47,7 @@ bed_pc_suffix = "_PC.vtk"
 bed_pc_prefix = "frame"
 bed_pc_filenames = get_matching_filenames(DEFORM_DATA_BASE_PATH, prefix=bed_pc_prefix, suffix=bed_pc_suffix)
 bed_pc_path = DEFORM_DATA_BASE_PATH / bed_pc_filenames[0]
-bed_pc_ply_path = ma.loadMeshFileAndWriteAsPLY(bed_pc_path, out_path=None, ascii_file=True)
+bed_pc_ply_path = ma.loadMeshFileAndWriteAsPLY(bed_pc_path, out_path=None)
 tto.import_model(bed_pc_ply_path, surf_blender_name, global_scale=1.0)
 print(bed_pc_filenames)
 
@@ -63,7 +63,7 @@ bel_model_suffix = "_bel.vtk"
 bel_model_filenames = get_matching_filenames(DEFORM_DATA_BASE_PATH, suffix=bel_model_suffix)
 if RUN_MODE == "FULL":
     bel_path = DEFORM_DATA_BASE_PATH / bel_model_filenames[0]
-    bel_ply_path = ma.loadMeshFileAndWriteAsPLY(bel_path, out_path=None, ascii_file=True)
+    bel_ply_path = ma.loadMeshFileAndWriteAsPLY(bel_path, out_path=None)
     tto.import_model(bel_ply_path, bel_blender_name, global_scale=1.0)
 
 # Undeformed Specimen Bel Mesh
@@ -72,7 +72,7 @@ deformed_bel_model_suffix = "_bel_deformed_initial.vtk"
 deformed_bel_model_filenames = get_matching_filenames(DEFORM_DATA_BASE_PATH, suffix=deformed_bel_model_suffix)
 if RUN_MODE == "FULL":
     deformed_bel_path = DEFORM_DATA_BASE_PATH / deformed_bel_model_filenames[0]
-    deformed_bel_ply_path = ma.loadMeshFileAndWriteAsPLY(deformed_bel_path, out_path=None, ascii_file=True)
+    deformed_bel_ply_path = ma.loadMeshFileAndWriteAsPLY(deformed_bel_path, out_path=None)
     tto.import_model(deformed_bel_ply_path, deformed_bel_blender_name, global_scale=1.0)
 
 ######----------------- Fidicuals Paths -----------------######
@@ -148,7 +148,7 @@ else:
 
         print("Performing Surface PC Registration")
         outputTs = ma.main(bedFidsPath=bed_fids_path,specimenFidsPath=None,undeformedFidsPath=None,targPath=None)
-        ma.transform_obj(surf_pc, *(outputTs["aruco_T_bed"])) # target_in_aruco
+        ma.transform_obj_matrix(surf_pc, outputTs["matrices"]["aruco_T_bed"]) # target_in_aruco
     elif RUN_MODE.upper() == "FULL": # Deformed Model Regstration and Texture Transfer
         print("All specimen files specified, performing specimen to Aruco Registration and texture transfer")
         surf_pc = bpy.data.objects[surf_blender_name]
@@ -162,8 +162,8 @@ else:
         print("Performing Specimen Model Registrations")
         outputTs = ma.main(bedFidsPath=bed_fids_path,specimenFidsPath=deformed_fids_path,undeformedFidsPath=undeformed_fids_path,targPath=targ_path)
         # transform_obj(obj_bel, *(outputTs["aruco_T_undeformed"])) 
-        ma.transform_obj(obj_bel_deformed, *(outputTs["aruco_T_deformed"])) 
-        ma.transform_obj(surf_pc, *(outputTs["aruco_T_bed"])) 
+        ma.transform_obj_matrix(obj_bel_deformed, outputTs["matrices"]["aruco_T_deformed"])
+        ma.transform_obj_matrix(surf_pc, outputTs["matrices"]["aruco_T_bed"])
         if not targ_path is None:
             assert(targ_obj_name in bpy.data.objects)
             print("Positioning targetPath")
@@ -2,27 +2,98 @@ from scipy.spatial.transform import Rotation as R
 import numpy as np
 import vtk
 from pathlib import Path
+import json
+import os
+import shutil
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "deformable_registration" / "TumorResectionGuidance"))
+from data_cache import DEFAULT_CACHE
+from fold_cache import fileDigest
+
+PLY_CACHE_DIR_NAME = ".ply_cache"
+# Part of every cache key; bump it when the conversion itself changes so old PLYs are not reused.
+PLY_CONVERTER_VERSION = 1
+
+def _cachedFileDigest(filePath, cache_dir):
+    # Content hash of filePath, remembered per (mtime, size) in the cache index so
+    # that unchanged inputs are not even re-hashed.
+    index_path = cache_dir / "index.json"
+    try:
+        index = json.loads(index_path.read_text())
+    except (OSError, ValueError):
+        index = {}
+    st = os.stat(filePath)
+    key = os.path.abspath(filePath)
+    entry = index.get(key)
+    if entry is not None and entry[:2] == [st.st_mtime_ns, st.st_size]:
+        return entry[2]
+    digest = fileDigest(filePath)
+    index[key] = [st.st_mtime_ns, st.st_size, digest]
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(index, indent=1))
+    os.replace(tmp_path, index_path)
+    return digest
+
+def loadMeshFileAndWriteAsPLY(filepath: Path, out_path: Path=None, ascii_file=False, cache_dir: Path=None, use_cache=True):
+    """
+    Convert a legacy VTK polydata file to PLY, reusing an earlier conversion of the same content.
+
+    Conversions are stored in `cache_dir` (default: a .ply_cache directory next to the
+    input) under the content hash of the input, so an unchanged file is never
+    reconverted, whatever its name or timestamp. Binary little-endian PLY is the
+    default; per-point RGB colors are kept.
+
+    Returns:
+        Path: out_path if given (the cached PLY is copied there), else the cached PLY
+    """
+    filepath = Path(filepath)
+    if not use_cache:
+        if out_path is None:
+            out_path = filepath.parent / f"{filepath.name.split('.vt')[0]}.ply"
+        return writePLY(loadMeshFile(filePath=filepath), out_path, asciiFile=ascii_file)
+
+    cache_dir = Path(cache_dir) if cache_dir is not None else filepath.parent / PLY_CACHE_DIR_NAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    digest = _cachedFileDigest(filepath, cache_dir)
+    cached_path = cache_dir / f"{digest}_{'ascii' if ascii_file else 'binary'}_v{PLY_CONVERTER_VERSION}.ply"
+    if not cached_path.exists():
+        tmp_path = cached_path.with_name(f"{cached_path.stem}.{os.getpid()}.tmp.ply")  # vtkPLYWriter enforces the suffix
+        writePLY(loadMeshFile(filePath=filepath), tmp_path, asciiFile=ascii_file)
+        os.replace(tmp_path, cached_path)
 
-def loadMeshFileAndWriteAsPLY(filepath: Path, out_path: Path=None, ascii_file=True):
-    readMesh = loadMeshFile(filePath=filepath)
     if out_path is None:
-        out_path = filepath.parent / f"{filepath.name.split('.vt')[0]}.ply"
-    return writePLY(readMesh, out_path, asciiFile=ascii_file)
+        return cached_path
+    # Copied rather than hard-linked: a writer truncating out_path later must not corrupt the cache
+    shutil.copyfile(cached_path, out_path)
+    return Path(out_path)
 
-def loadMeshFile(filePath):
+def readMeshFile(filePath):
     # Load the VTK mesh file
     meshReader = vtk.vtkPolyDataReader()
-    meshReader.SetFileName(filePath)
+    meshReader.SetFileName(str(filePath))
     meshReader.Update()
     return meshReader.GetOutput()
 
-def loadMeshFileGrid(filePath):
-# Load the VTK mesh file
+def readMeshFileGrid(filePath):
+    # Load the VTK mesh file
     meshReader = vtk.vtkUnstructuredGridReader()
-    meshReader.SetFileName(filePath)
+    meshReader.SetFileName(str(filePath))
     meshReader.Update()
     return meshReader.GetOutput()
 
+# The cached loaders return shallow copies that share points with the cache (and with
+# each other): DeepCopy before editing coordinates in place, or pass use_cache=False.
+def loadMeshFile(filePath, use_cache=True):
+    if use_cache:
+        return DEFAULT_CACHE.get(filePath, readMeshFile)
+    return readMeshFile(filePath)
+
+def loadMeshFileGrid(filePath, use_cache=True):
+    if use_cache:
+        return DEFAULT_CACHE.get(filePath, readMeshFileGrid)
+    return readMeshFileGrid(filePath)
+
 def writePLY(pd: vtk.vtkPolyData, outPath: str | Path, asciiFile=False):
     w = vtk.vtkPLYWriter()
     w.SetFileName(str(outPath))
@@ -31,7 +102,10 @@ def writePLY(pd: vtk.vtkPolyData, outPath: str | Path, asciiFile=False):
         w.SetFileTypeToASCII()
     else:
         w.SetFileTypeToBinary()
-    # Optional: if you have uchar RGB in point data named "RGB" or "Colors", PLYWriter will include it.
+    # PLYWriter only writes colors when told which array holds them (e.g. "Colors" from save_data)
+    scalars = pd.GetPointData().GetScalars()
+    if scalars is not None and scalars.GetDataType() == vtk.VTK_UNSIGNED_CHAR and scalars.GetNumberOfComponents() in (3, 4):
+        w.SetArrayName(scalars.GetName())
     w.Write()
     return outPath
 